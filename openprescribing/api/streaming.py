@@ -0,0 +1,101 @@
+"""
+Helpers for streaming API responses which are too large to comfortably build
+in memory (e.g. practice level data over all dates, or the entire Drug Tariff)
+
+These produce the same output as passing the equivalent list to DRF's
+`Response` and rendering it with our JSON or CSV renderers, but they consume
+the data incrementally and render it row by row.
+"""
+import itertools
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework_csv.renderers import CSVStreamingRenderer
+
+
+# Formats for which we can stream responses (the browsable API is always
+# rendered in the normal way)
+STREAMING_FORMATS = ("json", "csv")
+
+# Rendered rows are buffered into chunks of roughly this many bytes so that we
+# don't pay the per-chunk overhead of the server for every row
+CHUNK_SIZE = 64 * 1024
+
+
+def can_stream(request):
+    return request.accepted_renderer.format in STREAMING_FORMATS
+
+
+def streaming_response(request, rows, filename=None):
+    """
+    Return a response which streams the iterable of dicts `rows` as either a
+    JSON array or CSV, depending on the requested format
+
+    CSV columns are taken from the first row, so all rows must have the same
+    keys.
+    """
+    if request.accepted_renderer.format == "csv":
+        response = StreamingHttpResponse(
+            in_chunks(iter_csv(rows)), content_type="text/csv; charset=utf-8"
+        )
+        if filename:
+            response["content-disposition"] = "attachment; filename={}".format(filename)
+    else:
+        response = StreamingHttpResponse(
+            in_chunks(iter_json_array(rows)), content_type="application/json"
+        )
+    return response
+
+
+def render_json(value):
+    return JSONRenderer().render(value)
+
+
+def iter_json_array(items):
+    """
+    Yield the JSON encoding of a list of `items` in pieces
+    """
+    renderer = JSONRenderer()
+    yield b"["
+    for n, item in enumerate(items):
+        if n > 0:
+            yield b","
+        yield renderer.render(item)
+    yield b"]"
+
+
+def iter_csv(rows):
+    """
+    Yield the CSV encoding (as UTF-8 bytes) of the iterable of dicts `rows`
+    line by line
+    """
+    rows = iter(rows)
+    first_row = next(rows, None)
+    # This matches the behaviour of the non-streaming renderer, which returns
+    # an empty document (rather than just a header) when there's no data
+    if first_row is None:
+        return
+    renderer = CSVStreamingRenderer()
+    header = sorted(next(renderer.flatten_data([first_row])).keys())
+    # The renderer treats anything other than a list or a generator as a
+    # single row, hence the generator expression
+    data = (row for row in itertools.chain([first_row], rows))
+    yield from renderer.render(data, renderer_context={"header": header})
+
+
+def in_chunks(pieces, chunk_size=CHUNK_SIZE):
+    """
+    Join an iterable of bytestrings into chunks of at least `chunk_size`
+    bytes (except for the last)
+    """
+    buffer = []
+    buffer_size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffer_size += len(piece)
+        if buffer_size >= chunk_size:
+            yield b"".join(buffer)
+            buffer = []
+            buffer_size = 0
+    if buffer:
+        yield b"".join(buffer)
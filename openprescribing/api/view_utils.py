@@ -29,6 +29,34 @@ def execute_query(query, params):
     return data
 
 
+def iter_query(query, params, chunk_size=2000):
+    """
+    As `execute_query` but yields rows one at a time, fetching them from the
+    database in chunks rather than all at once
+    """
+    cursor = connection.chunked_cursor()
+    try:
+        if isinstance(params, dict):
+            cursor.execute(query, params)
+        elif params:
+            cursor.execute(query, tuple(itertools.chain.from_iterable(params)))
+        else:
+            cursor.execute(query)
+        columns = None
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            # Server-side cursors only have a description once we've fetched
+            # from them
+            if columns is None:
+                columns = [col[0] for col in cursor.description]
+            for row in rows:
+                yield dict(zip(columns, row))
+    finally:
+        cursor.close()
+
+
 def get_practice_ids_from_org(org_codes):
     # Convert CCG codes to lists of practices.
     from frontend.models import Practice
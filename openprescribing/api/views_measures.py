@@ -1,5 +1,7 @@
+import itertools
 import re
 
+from django.http import StreamingHttpResponse
 from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.exceptions import APIException
 from rest_framework.response import Response
@@ -15,6 +17,7 @@ from frontend.models import Presentation
 from matrixstore.db import get_db, get_row_grouper
 
 from . import view_utils as utils
+from .streaming import in_chunks, iter_json_array, render_json
 
 
 class MissingParameter(APIException):
@@ -288,9 +291,28 @@ def _measure_by_org(request, org_type):
     )
 
     # Because we access the `name` of the related org for each MeasureValue
-    # during the roll-up process below we need to prefetch them to avoid doing
-    # N+1 db queries
+    # during the roll-up process below we need to fetch them up front to avoid
+    # doing N+1 db queries
     org_field = org_type if org_type != "ccg" else "pct"
+
+    if request.accepted_renderer.format == "json":
+        # When streaming we fetch the related orgs with a join, as prefetching
+        # them requires loading the entire queryset into memory. We also order
+        # by measure so that we can roll up the values for one measure at a
+        # time.
+        if aggregate:
+            measure_values = measure_values.aggregate_by_measure_and_month()
+        else:
+            measure_values = (
+                measure_values.select_related(org_field)
+                .order_by("measure_id", "month")
+                .iterator()
+            )
+        return StreamingHttpResponse(
+            in_chunks(_iter_rolled_up_measure_values(measure_values, org_type)),
+            content_type="application/json",
+        )
+
     measure_values = measure_values.prefetch_related(org_field)
 
     if aggregate:
@@ -307,6 +329,33 @@ def _measure_by_org(request, org_type):
         return Response(rsp_data)
 
 
+def _iter_rolled_up_measure_values(measure_values, org_type):
+    """
+    Yield the JSON encoding of the same response as `_roll_up_measure_values`
+    in pieces
+
+    `measure_values` must be ordered by measure.
+    """
+    yield b'{"measures":['
+    grouped = itertools.groupby(measure_values, key=lambda mv: mv.measure_id)
+    for n, (measure_id, values) in enumerate(grouped):
+        first_value = next(values)
+        measure_data = _measure_data(first_value.measure)
+        if n > 0:
+            yield b","
+        # We render everything except the values themselves in one go and
+        # then strip the closing brace so we can stream the values in after
+        # it
+        yield render_json(measure_data)[:-1]
+        yield b',"data":'
+        yield from iter_json_array(
+            _measure_value_data(mv, org_type)
+            for mv in itertools.chain([first_value], values)
+        )
+        yield b"}"
+    yield b"]}"
+
+
 def _roll_up_measure_values(measure_values, org_type):
     rolled = {}
 
@@ -317,26 +366,29 @@ def _roll_up_measure_values(measure_values, org_type):
         if measure_id in rolled:
             rolled[measure_id]["data"].append(measure_value_data)
         else:
-            measure = measure_value.measure
-            rolled[measure_id] = {
-                "id": measure_id,
-                "name": measure.name,
-                "title": measure.title,
-                "description": measure.description,
-                "why_it_matters": measure.why_it_matters,
-                "numerator_short": measure.numerator_short,
-                "denominator_short": measure.denominator_short,
-                "url": measure.url,
-                "is_cost_based": measure.is_cost_based,
-                "is_percentage": measure.is_percentage,
-                "low_is_good": measure.low_is_good,
-                "tags": _hydrate_tags(measure.tags),
-                "data": [measure_value_data],
-            }
+            rolled[measure_id] = _measure_data(measure_value.measure)
+            rolled[measure_id]["data"] = [measure_value_data]
 
     return list(rolled.values())
 
 
+def _measure_data(measure):
+    return {
+        "id": measure.id,
+        "name": measure.name,
+        "title": measure.title,
+        "description": measure.description,
+        "why_it_matters": measure.why_it_matters,
+        "numerator_short": measure.numerator_short,
+        "denominator_short": measure.denominator_short,
+        "url": measure.url,
+        "is_cost_based": measure.is_cost_based,
+        "is_percentage": measure.is_percentage,
+        "low_is_good": measure.low_is_good,
+        "tags": _hydrate_tags(measure.tags),
+    }
+
+
 def _measure_value_data(measure_value, org_type):
     measure_value_data = {
         "measure": measure_value.measure_id,
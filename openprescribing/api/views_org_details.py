@@ -1,3 +1,5 @@
+import numpy
+
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
@@ -6,6 +8,8 @@ from django.db.models import Q
 from frontend.models import Practice, PCT, STP, RegionalTeam, PCN
 from . import view_utils as utils
 from matrixstore.db import get_db, get_row_grouper
+from matrixstore.matrix_ops import get_cells
+from matrixstore.org_aggregates import has_aggregates
 
 
 STATS_COLUMN_WHITELIST = (
@@ -66,11 +70,15 @@ def _get_orgs(org_type, org_codes):
 
 def _get_practice_stats_entries(keys, org_type, orgs):
     db = get_db()
-    practice_stats = db.query(*_get_query_and_params(keys))
     group_by_org = get_row_grouper(org_type)
-    practice_stats = [
-        (name, group_by_org.sum(matrix)) for (name, matrix) in practice_stats
-    ]
+    if has_aggregates(db, org_type):
+        # Use the statistics which were grouped by org when the file was built
+        practice_stats = list(db.query(*_get_query_and_params(keys, org_type)))
+    else:
+        results = list(db.query(*_get_query_and_params(keys)))
+        names = [name for (name, _) in results]
+        matrices = group_by_org.sum_many(matrix for (_, matrix) in results)
+        practice_stats = list(zip(names, matrices))
     # `group_by_org.offsets` maps each organisation's primary key to its row
     # offset within the matrices. We pair each organisation with its row
     # offset, ignoring those organisations which aren't in the mapping (which
@@ -83,36 +91,72 @@ def _get_practice_stats_entries(keys, org_type, orgs):
     # For the "all_practices" grouping we have no orgs and just a single row
     if org_type == "all_practices":
         org_offsets = [(None, 0)]
-    date_offsets = sorted(db.date_offsets.items())
-    # Yield entries for each organisation on each date
-    for date, col_offset in date_offsets:
-        for org, row_offset in org_offsets:
-            entry = {"date": date}
-            if org is not None:
-                entry["row_id"] = org.pk
-                entry["row_name"] = org.name
-            index = (row_offset, col_offset)
-            star_pu = {}
-            has_value = False
-            for name, matrix in practice_stats:
-                value = matrix[index]
-                if value != 0:
-                    has_value = True
-                if name == "nothing":
-                    value = 1
-                if isinstance(value, float):
-                    value = round(value, 2)
-                if name.startswith("star_pu."):
-                    star_pu[name[8:]] = value
-                else:
-                    entry[name] = value
-            if star_pu:
-                entry["star_pu"] = star_pu
-            if has_value:
-                yield entry
-
-
-def _get_query_and_params(keys):
+    dates = sorted(db.date_offsets.keys())
+    rows = [row_offset for (_, row_offset) in org_offsets]
+    cols = [db.date_offsets[date] for date in dates]
+    # We transpose the matrices so that, as in the original API, entries are
+    # ordered by date and then by organisation
+    values = [get_cells(matrix, rows, cols).T for (_, matrix) in practice_stats]
+    # We only return entries where at least one statistic is non-zero
+    has_value = numpy.zeros((len(cols), len(rows)), dtype=bool)
+    for matrix in values:
+        has_value |= matrix != 0
+    date_indices, org_indices = numpy.nonzero(has_value)
+    columns = []
+    for (name, _), matrix in zip(practice_stats, values):
+        if name == "nothing":
+            column = [1] * len(date_indices)
+        else:
+            column = matrix[date_indices, org_indices]
+            if numpy.issubdtype(column.dtype, numpy.floating):
+                column = numpy.round(column, 2)
+            column = column.tolist()
+        columns.append((name, column))
+    return _iter_practice_stats_entries(
+        dates,
+        [org for (org, _) in org_offsets],
+        date_indices.tolist(),
+        org_indices.tolist(),
+        columns,
+    )
+
+
+def _iter_practice_stats_entries(dates, orgs, date_indices, org_indices, columns):
+    """
+    Build an entry dict for each of the cells identified by `date_indices` and
+    `org_indices`, whose values for each statistic are given in `columns`
+    """
+    star_pu_columns = [
+        (name[8:], column) for (name, column) in columns if name.startswith("star_pu.")
+    ]
+    other_columns = [
+        (name, column) for (name, column) in columns if not name.startswith("star_pu.")
+    ]
+    for n, (date_index, org_index) in enumerate(zip(date_indices, org_indices)):
+        entry = {"date": dates[date_index]}
+        org = orgs[org_index]
+        if org is not None:
+            entry["row_id"] = org.pk
+            entry["row_name"] = org.name
+        for name, column in other_columns:
+            entry[name] = column[n]
+        if star_pu_columns:
+            entry["star_pu"] = {name: column[n] for (name, column) in star_pu_columns}
+        yield entry
+
+
+def _get_query_and_params(keys, org_type=None):
+    """
+    Return a query which fetches the practice statistics matrices for the
+    supplied keys or, if `org_type` is supplied, the precalculated matrices for
+    that org type
+    """
+    if org_type is None:
+        table = "practice_statistic"
+        org_type_condition = ""
+    else:
+        table = "practice_statistic_by_org"
+        org_type_condition = " AND org_type = ?"
     params = []
     for key in keys:
         if key == "nothing":
@@ -129,7 +173,11 @@ def _get_query_and_params(keys):
     else:
         # If no keys are supplied we treat this as an implicit "select all"
         where = "1=1"
-    query = "SELECT name, value FROM practice_statistic WHERE {}".format(where)
+    query = "SELECT name, value FROM {} WHERE {}{}".format(
+        table, where, org_type_condition
+    )
+    if org_type is not None:
+        params.append(org_type)
     # The special "nothing" key always evaluates to 1, but to match the
     # previous API we should only return these "nothing" entries where there
     # exist statistics for that organsation and date. So we use the
@@ -139,7 +187,11 @@ def _get_query_and_params(keys):
         query += """
             UNION ALL
             SELECT "nothing" AS name, value
-            FROM practice_statistic
-            WHERE name="total_list_size"
-            """
+            FROM {}
+            WHERE name="total_list_size"{}
+            """.format(
+            table, org_type_condition
+        )
+        if org_type is not None:
+            params.append(org_type)
     return query, params
@@ -1,3 +1,6 @@
+import numpy
+
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 
 from rest_framework.decorators import api_view
@@ -11,17 +14,19 @@ from frontend.price_per_unit.prescribing_breakdown import (
     get_ppu_breakdown,
     get_mean_ppu,
 )
-from frontend.price_per_unit.savings import (
-    get_savings_for_orgs,
-    get_all_savings_for_orgs,
-)
+from frontend.price_per_unit.precomputed_savings import get_all_savings_for_orgs
+from frontend.price_per_unit.savings import get_savings_for_orgs
 from frontend.ghost_branded_generics import (
     get_ghost_branded_generic_spending,
     get_total_ghost_branded_generic_spending,
 )
+from matrixstore.bnf_prefixes import get_totals_for_prefixes
 from matrixstore.db import get_db, get_row_grouper
+from matrixstore.matrix_ops import get_cells
+from matrixstore.org_aggregates import get_prescribing_aggregates
 
 from . import view_utils as utils
+from .streaming import can_stream, streaming_response
 
 
 class NotValid(APIException):
@@ -315,21 +320,17 @@ def _get_total_prescribing_entries(bnf_code_prefixes):
     prefixes
     """
     db = get_db()
-    items_matrix, quantity_matrix, actual_cost_matrix = _get_prescribing_for_codes(
-        db, bnf_code_prefixes
-    )
-    # If no data at all was found, return early which results in an empty
-    # iterator
-    if items_matrix is None:
-        return
     # This will sum over every practice (whether setting 4 or not) which might
     # not seem like what we want but is what the original API did (it was
     # powered by the `vw__presentation_summary` table which summed over all
     # practice types)
-    group_all = get_row_grouper("all_practices")
-    items_matrix = group_all.sum(items_matrix)
-    quantity_matrix = group_all.sum(quantity_matrix)
-    actual_cost_matrix = group_all.sum(actual_cost_matrix)
+    org_type = "all_practices"
+    matrices = _get_grouped_prescribing_for_codes(db, bnf_code_prefixes, org_type)
+    items_matrix, quantity_matrix, actual_cost_matrix = matrices
+    # If no data at all was found, return early which results in an empty
+    # iterator
+    if items_matrix is None:
+        return
     # Yield entries for each date (unlike _get_prescribing_entries below we
     # return a value for each date even if it's zero as this is what the
     # original API did)
@@ -389,11 +390,11 @@ def tariff(request, format=None):
 
     query += " ORDER BY date"
 
-    data = utils.execute_query(query, params)
-    response = Response(data)
-    if request.accepted_renderer.format == "csv":
-        filename = "tariff.csv"
-        response["content-disposition"] = "attachment; filename=%s" % filename
+    if can_stream(request):
+        data = utils.iter_query(query, params)
+        response = streaming_response(request, data, filename="tariff.csv")
+    else:
+        response = Response(utils.execute_query(query, params))
     if response_should_be_cached:
         response["cache-control"] = "max-age={}, public".format(60 * 60 * 8)
     return response
@@ -453,36 +454,35 @@ def spending_by_org(request, format=None, org_type=None):
     if org_type != "practice":
         orgs = orgs.only(code_field, "name")
 
-    data = list(_get_prescribing_entries(codes, orgs, org_type, date=date))
+    entries = _get_prescribing_entries(codes, orgs, org_type, date=date)
 
-    response = Response(data)
-    if request.accepted_renderer.format == "csv":
+    if can_stream(request):
         filename = "spending-by-{}-{}.csv".format(org_type, "-".join(codes))
-        response["content-disposition"] = "attachment; filename={}".format(filename)
-    return response
+        return streaming_response(request, entries, filename=filename)
+    else:
+        return Response(list(entries))
 
 
 def _get_prescribing_entries(bnf_code_prefixes, orgs, org_type, date=None):
     """
-    For each date and organisation, yield a dict giving totals for all
-    prescribing matching the supplied BNF code prefixes.
+    Return an iterator which yields, for each date and organisation, a dict
+    giving totals for all prescribing matching the supplied BNF code prefixes.
 
     If a date is supplied then data for just that date is returned, otherwise
     all available dates are returned.
+
+    All the work of fetching and validating the data happens up front, so any
+    errors are raised here rather than once we've started streaming the
+    response.
     """
     db = get_db()
-    items_matrix, quantity_matrix, actual_cost_matrix = _get_prescribing_for_codes(
-        db, bnf_code_prefixes
-    )
-    # If no data at all was found, return early which results in an empty
-    # iterator
-    if items_matrix is None:
-        return
     # Group together practice level data to the appropriate organisation level
     group_by_org = get_row_grouper(org_type)
-    items_matrix = group_by_org.sum(items_matrix)
-    quantity_matrix = group_by_org.sum(quantity_matrix)
-    actual_cost_matrix = group_by_org.sum(actual_cost_matrix)
+    matrices = _get_grouped_prescribing_for_codes(db, bnf_code_prefixes, org_type)
+    items_matrix, quantity_matrix, actual_cost_matrix = matrices
+    # If no data at all was found, return an empty iterator
+    if items_matrix is None:
+        return iter([])
     # `group_by_org.offsets` maps each organisation's primary key to its row
     # offset within the matrices. We pair each organisation with its row
     # offset, ignoring those organisations which aren't in the mapping (which
@@ -501,28 +501,76 @@ def _get_prescribing_entries(bnf_code_prefixes, orgs, org_type, date=None):
             raise BadDate(date)
     else:
         date_offsets = sorted(db.date_offsets.items())
-    # Yield entries for each organisation on each date
-    for date, col_offset in date_offsets:
-        for org, row_offset in org_offsets:
-            index = (row_offset, col_offset)
-            items = items_matrix[index]
-            # Mimicking the behaviour of the existing API, we don't return
-            # entries where there was no prescribing
-            if items == 0:
-                continue
-            entry = {
-                "items": items,
-                "quantity": quantity_matrix[index],
-                "actual_cost": round(actual_cost_matrix[index], 2),
-                "date": date,
-                "row_id": org.pk,
-                "row_name": org.name,
-            }
-            # Practices get some extra attributes in the existing API
-            if org_type == "practice":
-                entry["ccg"] = org.ccg_id
-                entry["setting"] = org.setting
-            yield entry
+    rows = [row_offset for (_, row_offset) in org_offsets]
+    cols = [col_offset for (_, col_offset) in date_offsets]
+    # We transpose the matrices so that, as in the original API, entries are
+    # ordered by date and then by organisation
+    items = get_cells(items_matrix, rows, cols).T
+    # Mimicking the behaviour of the existing API, we don't return entries
+    # where there was no prescribing
+    date_indices, org_indices = numpy.nonzero(items)
+    quantity = get_cells(quantity_matrix, rows, cols).T
+    actual_cost = get_cells(actual_cost_matrix, rows, cols).T
+    columns = {
+        "items": items[date_indices, org_indices].tolist(),
+        "quantity": quantity[date_indices, org_indices].tolist(),
+        "actual_cost": numpy.round(actual_cost[date_indices, org_indices], 2).tolist(),
+    }
+    dates = [date for (date, _) in date_offsets]
+    orgs = [org for (org, _) in org_offsets]
+    return _iter_prescribing_entries(
+        org_type, dates, orgs, date_indices.tolist(), org_indices.tolist(), columns
+    )
+
+
+def _iter_prescribing_entries(
+    org_type, dates, orgs, date_indices, org_indices, columns
+):
+    """
+    Build an entry dict for each of the non-zero cells identified by
+    `date_indices` and `org_indices`, whose values are given in `columns`
+    """
+    org_values = [{"row_id": org.pk, "row_name": org.name} for org in orgs]
+    # Practices get some extra attributes in the existing API
+    if org_type == "practice":
+        for values, org in zip(org_values, orgs):
+            values["ccg"] = org.ccg_id
+            values["setting"] = org.setting
+    for date_index, org_index, items, quantity, actual_cost in zip(
+        date_indices,
+        org_indices,
+        columns["items"],
+        columns["quantity"],
+        columns["actual_cost"],
+    ):
+        entry = {
+            "items": items,
+            "quantity": quantity,
+            "actual_cost": actual_cost,
+            "date": dates[date_index],
+        }
+        entry.update(org_values[org_index])
+        yield entry
+
+
+def _get_grouped_prescribing_for_codes(db, bnf_code_prefixes, org_type):
+    """
+    As `_get_prescribing_for_codes` but with the matrices grouped by
+    `org_type`, using aggregates precalculated at build time if the file has
+    them
+    """
+    aggregates = get_prescribing_aggregates(db, org_type, bnf_code_prefixes)
+    if aggregates is not None:
+        items, quantity, actual_cost = aggregates
+        # Convert from pence to pounds
+        if actual_cost is not None:
+            actual_cost = actual_cost / 100.0
+        return items, quantity, actual_cost
+    items, quantity, actual_cost = _get_prescribing_for_codes(db, bnf_code_prefixes)
+    if items is None:
+        return None, None, None
+    group_by_org = get_row_grouper(org_type)
+    return tuple(group_by_org.sum_many([items, quantity, actual_cost]))
 
 
 def _get_prescribing_for_codes(db, bnf_code_prefixes):
@@ -533,26 +581,18 @@ def _get_prescribing_for_codes(db, bnf_code_prefixes):
     presentations.
     """
     if bnf_code_prefixes:
-        where_clause = " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes))
-        params = [code + "%" for code in bnf_code_prefixes]
-        sql = """
-            SELECT
-                matrix_sum(items) AS items,
-                matrix_sum(quantity) AS quantity,
-                matrix_sum(actual_cost) AS actual_cost
-            FROM
-                presentation
-            WHERE
-                {}
-            """.format(
-            where_clause
+        items, quantity, actual_cost = get_totals_for_prefixes(
+            db,
+            ["items", "quantity", "actual_cost"],
+            bnf_code_prefixes,
+            workers=settings.MATRIXSTORE_SUM_WORKERS,
         )
     else:
         # As summing over all presentations can be quite slow we use the
         # precalculated results table
-        sql = "SELECT items, quantity, actual_cost FROM all_presentations"
-        params = []
-    items, quantity, actual_cost = db.query_one(sql, params)
+        items, quantity, actual_cost = db.query_one(
+            "SELECT items, quantity, actual_cost FROM all_presentations"
+        )
     # Convert from pence to pounds
     if actual_cost is not None:
         actual_cost = actual_cost / 100.0
@@ -178,7 +178,9 @@ def constraint_and_index_reconstructor(table_name):
             print("Recreating indexes, don't hit Control-C!")
             logger.info("Recreating indexes")
             for name, cmd in indexes.items():
-                cursor.execute(cmd)
+                # Indexes on partitioned tables are defined "ON ONLY" the
+                # parent table, which would leave the partitions unindexed
+                cursor.execute(cmd.replace(" ON ONLY ", " ON ", 1))
                 logger.info("Recreated index %s" % name)
 
             logger.info("Recreating constraints")
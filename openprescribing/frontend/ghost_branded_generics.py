@@ -18,7 +18,6 @@ from django.db import connection
 
 from frontend.models import Presentation
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix
 from matrixstore.cachelib import memoize
 
 # Minimum difference (positive or negative) between a practice's net costs for
@@ -245,20 +244,4 @@ def get_prescribing(db, bnf_codes, date):
 
     Yields tuples of the form: (bnf_code, quantity_matrix, net_cost_matrix)
     """
-    date_column = db.date_offsets[date]
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
-        """
-        SELECT bnf_code, quantity, net_cost FROM presentation WHERE bnf_code IN ({})
-        """.format(
-            ",".join("?" * len(bnf_codes))
-        ),
-        bnf_codes,
-    )
-    for bnf_code, quantity, net_cost in results:
-        yield (
-            bnf_code,
-            get_submatrix(quantity, cols=date_slice),
-            get_submatrix(net_cost, cols=date_slice),
-        )
+    return db.query_presentations_at_date(bnf_codes, date)
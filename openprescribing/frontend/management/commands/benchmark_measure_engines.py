@@ -0,0 +1,118 @@
+import textwrap
+import time
+
+from dateutil.relativedelta import relativedelta
+
+from django.core.management.base import BaseCommand
+
+from frontend.management.commands.import_measures import MeasureCalculation
+from frontend.matrixstore_measures import (
+    calculate_measure,
+    can_calculate_from_matrixstore,
+    compare_rows,
+)
+from frontend.models import ImportLog, Measure
+from matrixstore.db import get_db
+
+
+KEY_FIELDS = {
+    "practice": ["practice_id"],
+    "pcn": ["pcn_id"],
+    "ccg": ["pct_id"],
+    "stp": ["stp_id"],
+    "regtm": ["regional_team_id"],
+    "global": [],
+}
+
+
+class Command(BaseCommand):
+    help = textwrap.dedent(
+        """
+        Calculates measures both in BigQuery and from the MatrixStore, and
+        reports how long each took and any differences in their results. The
+        BigQuery tables are updated but nothing is written to the database.
+        """
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--measure",
+            help="Comma-separated measure IDs (by default, all those which "
+            "can be calculated from the MatrixStore)",
+        )
+        parser.add_argument(
+            "--max-differences",
+            help="Maximum number of differences to show for each table",
+            type=int,
+            default=5,
+        )
+
+    def handle(self, measure, max_differences, **options):
+        measures = Measure.objects.order_by("id")
+        if measure:
+            measures = measures.filter(id__in=measure.split(","))
+        end_date = ImportLog.objects.latest_in_category("prescribing").current_at
+        start_date = end_date - relativedelta(years=5)
+        db = get_db()
+        for measure in measures:
+            if not can_calculate_from_matrixstore(measure):
+                self.stdout.write("{}: needs BigQuery, skipping".format(measure.id))
+                continue
+
+            start = time.time()
+            calculation = MeasureCalculation(
+                measure, start_date=start_date, end_date=end_date
+            )
+            calculation.calculate(bigquery_only=True)
+            bigquery_tables = {
+                org_type: list(
+                    calculation.get_rows_as_dicts(calculation.table_name(org_type))
+                )
+                for org_type in KEY_FIELDS
+            }
+            bigquery_seconds = time.time() - start
+
+            start = time.time()
+            matrixstore_tables = calculate_measure(measure, db, start_date, end_date)
+            matrixstore_seconds = time.time() - start
+
+            self.stdout.write(
+                "{}: BigQuery {:.1f}s, MatrixStore {:.1f}s".format(
+                    measure.id, bigquery_seconds, matrixstore_seconds
+                )
+            )
+            for org_type, key_fields in KEY_FIELDS.items():
+                self.compare_tables(
+                    org_type,
+                    bigquery_tables[org_type],
+                    matrixstore_tables[org_type],
+                    key_fields,
+                    max_differences,
+                )
+
+    def compare_tables(
+        self, org_type, bigquery_rows, matrixstore_rows, key_fields, max_differences
+    ):
+        if org_type == "global":
+            # The cost savings query prefixes these columns (see
+            # `write_global_centiles_to_database`)
+            bigquery_rows = [
+                {key.replace("global_", ""): value for key, value in row.items()}
+                for row in bigquery_rows
+            ]
+        # The MatrixStore doesn't go back as far as BigQuery, so we just
+        # compare the months it covers
+        months = {str(row["month"])[:10] for row in matrixstore_rows}
+        skipped = [row for row in bigquery_rows if str(row["month"])[:10] not in months]
+        bigquery_rows = [
+            row for row in bigquery_rows if str(row["month"])[:10] in months
+        ]
+        differences = compare_rows(bigquery_rows, matrixstore_rows, key_fields)
+        self.stdout.write(
+            "  {}: {} rows compared, {} differences ({} BigQuery rows outside "
+            "MatrixStore dates)".format(
+                org_type, len(bigquery_rows), len(differences), len(skipped)
+            )
+        )
+        for difference in differences[:max_differences]:
+            self.stdout.write("    " + difference)
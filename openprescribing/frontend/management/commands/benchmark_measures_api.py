@@ -0,0 +1,130 @@
+import random
+import textwrap
+import time
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from api import views_measures
+from frontend.models import PCN, PCT, STP, Measure, Practice, RegionalTeam
+
+
+class Command(BaseCommand):
+    help = textwrap.dedent(
+        """
+        Times requests to the measures API for a deterministic sample of
+        organisations and measures, and reports the median and 95th percentile
+        response time for each kind of request. Run this before and after a
+        change to the way MeasureValues are stored to compare the two.
+        """
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeat",
+            help="Number of times to make each request",
+            type=int,
+            default=5,
+        )
+        parser.add_argument(
+            "--sample-size",
+            help="Number of organisations and measures to sample of each kind",
+            type=int,
+            default=10,
+        )
+        parser.add_argument(
+            "--seed",
+            help="Seed for sampling, so that the same requests are made each time",
+            type=int,
+            default=0,
+        )
+
+    def handle(self, repeat, sample_size, seed, **options):
+        rng = random.Random(seed)
+
+        def sample(queryset, field):
+            values = list(queryset.order_by(field).values_list(field, flat=True))
+            return rng.sample(values, min(sample_size, len(values)))
+
+        measure_ids = sample(Measure.objects.all(), "id")
+        practice_ids = sample(Practice.objects.filter(setting=4), "code")
+        ccg_ids = sample(
+            PCT.objects.filter(org_type="CCG", close_date__isnull=True), "code"
+        )
+        pcn_ids = sample(PCN.objects.active(), "code")
+        stp_ids = sample(STP.objects.all(), "ons_code")
+        regional_team_ids = sample(RegionalTeam.objects.active(), "code")
+
+        requests = {
+            "practice, all measures": [
+                (views_measures.measure_by_practice, {"org": practice_id})
+                for practice_id in practice_ids
+            ],
+            "practices in CCG, one measure": [
+                (
+                    views_measures.measure_by_practice,
+                    {"org": ccg_id, "measure": measure_id},
+                )
+                for ccg_id, measure_id in zip(ccg_ids, measure_ids)
+            ],
+            "all practices, aggregated": [
+                (
+                    views_measures.measure_by_practice,
+                    {"aggregate": "true", "measure": measure_id},
+                )
+                for measure_id in measure_ids
+            ],
+            "CCG, all measures": [
+                (views_measures.measure_by_ccg, {"org": ccg_id}) for ccg_id in ccg_ids
+            ],
+            "all CCGs, one measure": [
+                (views_measures.measure_by_ccg, {"measure": measure_id})
+                for measure_id in measure_ids
+            ],
+            "PCN, all measures": [
+                (views_measures.measure_by_pcn, {"org": pcn_id}) for pcn_id in pcn_ids
+            ],
+            "STP, all measures": [
+                (views_measures.measure_by_stp, {"org": stp_id}) for stp_id in stp_ids
+            ],
+            "regional team, all measures": [
+                (views_measures.measure_by_regional_team, {"org": regional_team_id})
+                for regional_team_id in regional_team_ids
+            ],
+        }
+
+        all_timings = []
+        for name, views_and_params in requests.items():
+            timings = []
+            for _ in range(repeat):
+                for view, params in views_and_params:
+                    timings.append(time_request(view, params))
+            all_timings.extend(timings)
+            self.stdout.write(format_timings(name, timings))
+        self.stdout.write(format_timings("overall", all_timings))
+
+
+def time_request(view, params):
+    """Return the number of milliseconds taken to make a JSON request to the
+    given view and read the whole response.
+    """
+    request = RequestFactory().get("/", dict(params, format="json"))
+    start = time.time()
+    response = view(request)
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    else:
+        response.render()
+    assert response.status_code == 200, response.status_code
+    return (time.time() - start) * 1000
+
+
+def format_timings(name, timings):
+    if not timings:
+        return "{}: no requests".format(name)
+    return "{}: n={}, p50={:.0f}ms, p95={:.0f}ms".format(
+        name, len(timings), np.percentile(timings, 50), np.percentile(timings, 95)
+    )
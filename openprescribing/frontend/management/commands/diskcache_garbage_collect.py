@@ -1,20 +1,52 @@
 import textwrap
+import time
 
+from django.conf import settings
+from django.core.cache import caches
 from django.core.management.base import BaseCommand
-from django.core.cache import cache
+
+from matrixstore.cache_eviction import get_evictor, is_diskcache
 
 
 class Command(BaseCommand):
     help = textwrap.dedent(
         """
-        Deletes oldest values from the DiskCache instance until it is within
-        its specified maximum size. See the CACHE section of the settings file
-        for more detail.
+        Deletes values from the DiskCache instance used by `cachelib` (see
+        CACHELIB_CACHE_ALIAS) until it is within its specified maximum size,
+        starting with those computed from MatrixStore files which are no longer
+        live. See the CACHE section of the settings file and
+        `matrixstore.cache_eviction` for more detail.
         """
     )
 
-    def handle(self, *args, **options):
-        while True:
-            deleted = cache.cull()
-            if deleted <= 0:
-                break
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-seconds",
+            help="Maximum time to spend on each batch of deletions",
+            type=float,
+            default=0.5,
+        )
+        parser.add_argument(
+            "--pause-seconds",
+            help="Time to pause between batches to let other writers in",
+            type=float,
+            default=0.5,
+        )
+
+    def handle(self, batch_seconds, pause_seconds, **options):
+        alias = settings.CACHELIB_CACHE_ALIAS
+        # Other backends (e.g. memcached or Redis) manage their own size
+        if not is_diskcache(caches[alias]):
+            self.stdout.write(
+                "Skipping: cache '{}' (CACHELIB_CACHE_ALIAS) is not a DiskCache "
+                "instance".format(alias)
+            )
+            return
+        evictor = get_evictor(alias)
+        while not evictor.run_batch(batch_seconds):
+            time.sleep(pause_seconds)
+        self.stdout.write(
+            "Evicted {} entries, reclaiming {:,} bytes".format(
+                evictor.entries_evicted, evictor.bytes_reclaimed
+            )
+        )
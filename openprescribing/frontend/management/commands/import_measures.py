@@ -6,17 +6,32 @@ the alternative, which is looping over thousands of practices
 individually with a custom SQL query. However, the tradeoff is that
 most of the logic now lives in SQL which is harder to read and test
 clearly.
+
+With `--engine=matrixstore`, measures which don't need custom SQL are
+instead calculated from the MatrixStore (see
+`frontend.matrixstore_measures`), which avoids the round trips to
+BigQuery.  All measures then start from the first month in the
+MatrixStore, so that they cover the same months whichever engine
+calculates them.
+
+With `--incremental`, only months after the latest one already in the
+database are calculated, unless the measure's definition (including the
+BNF codes it resolves to) has changed since it was last calculated.
+Percent ranks and centiles are calculated separately for each month, so
+the values for earlier months are unaffected.
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 import csv
 from datetime import datetime
+import functools
 import glob
+import hashlib
 import json
 import logging
 import os
 import re
-import tempfile
 from urllib.parse import urlencode
 
 from dateutil.relativedelta import relativedelta
@@ -26,20 +41,29 @@ from django.core.management import BaseCommand
 from django.urls import reverse
 from django.db import connection
 from django.db import transaction
+from django.db.models import Max, Q
 
 from gcutils.bigquery import Client
 
 from common import utils
 
+from frontend.matrixstore_measures import (
+    calculate_measure,
+    can_calculate_from_matrixstore,
+)
 from frontend.models import MeasureGlobal, MeasureValue, Measure, ImportLog
 from frontend.utils.bnf_hierarchy import get_all_bnf_codes, simplify_bnf_codes
 
 from google.api_core.exceptions import BadRequest
 
+from matrixstore.db import get_db
+
 logger = logging.getLogger(__name__)
 
 CENTILES = [10, 20, 30, 40, 50, 60, 70, 80, 90]
 
+ORG_TYPES = ["pcn", "ccg", "stp", "regtm"]
+
 MEASURE_FIELDNAMES = [
     "measure_id",
     "regional_team_id",
@@ -55,6 +79,19 @@ MEASURE_FIELDNAMES = [
     "cost_savings",
 ]
 
+MEASURE_GLOBAL_FIELDNAMES = [
+    "measure_id",
+    "month",
+    "numerator",
+    "denominator",
+    "calc_value",
+    "percentiles",
+    "cost_savings",
+]
+
+# Used for all JSON fields, to avoid creating an encoder for each value
+encode_json = json.JSONEncoder().encode
+
 
 class Command(BaseCommand):
     """
@@ -92,7 +129,10 @@ class Command(BaseCommand):
             not options["measure"]
             and not options["definitions_only"]
             and not options["bigquery_only"]
+            and not options["incremental"]
         )
+        incremental = options["incremental"] and not options["bigquery_only"]
+        measures_needed_in_bigquery = get_measures_read_by_other_measures()
         with conditional_constraint_and_index_reconstructor(drop_and_rebuild_indices):
             for measure_def in measure_defs:
                 measure_id = measure_def["id"]
@@ -105,25 +145,152 @@ class Command(BaseCommand):
                     if options["definitions_only"]:
                         continue
 
-                    calcuation = MeasureCalculation(
+                    if (
+                        options["engine"] == "matrixstore"
+                        and not options["bigquery_only"]
+                        and measure_id not in measures_needed_in_bigquery
+                        and can_calculate_from_matrixstore(measure)
+                    ):
+                        calculation_class = MatrixStoreMeasureCalculation
+                    else:
+                        calculation_class = MeasureCalculation
+                    logger.info(
+                        "Calculating %s with %s", measure_id, calculation_class.__name__
+                    )
+
+                    definition_hash = get_definition_hash(measure_def, measure)
+                    first_month = start_date
+                    # The BigQuery tables of measures which are read by other
+                    # measures must always cover every month
+                    if incremental and measure_id not in measures_needed_in_bigquery:
+                        first_month = get_first_month_to_calculate(
+                            measure, definition_hash, start_date, end_date
+                        )
+
+                    calcuation = calculation_class(
                         measure,
-                        start_date=start_date,
+                        start_date=first_month,
                         end_date=end_date,
                         verbose=verbose,
                     )
 
                     if not options["bigquery_only"]:
-                        MeasureValue.objects.filter(measure=measure).delete()
-                        MeasureGlobal.objects.filter(measure=measure).delete()
+                        delete_measure_values(measure, start_date, first_month)
 
                     # Compute the measures
                     calcuation.calculate(options["bigquery_only"])
 
+                    if not options["bigquery_only"]:
+                        Measure.objects.filter(id=measure_id).update(
+                            definition_hash=definition_hash
+                        )
+
                 elapsed = datetime.now() - measure_start
                 logger.warning(
                     "Elapsed time for %s: %s seconds" % (measure_id, elapsed.seconds)
                 )
 
+    def build_measures_in_parallel(
+        self, measure_defs, start_date, end_date, verbose, options
+    ):
+        """Build measures as `build_measures` does, but running up to
+        `options["parallel"]` BigQuery jobs at once.
+
+        The jobs for each measure form a graph of dependencies (see
+        `MeasureCalculation.get_bigquery_jobs`), and jobs from different
+        measures can run at the same time.  Results are still written to the
+        database one measure at a time, in the order of `measure_defs`, as soon
+        as all of a measure's jobs have finished.
+        """
+        drop_and_rebuild_indices = bool(
+            not options["measure"]
+            and not options["definitions_only"]
+            and not options["bigquery_only"]
+            and not options["incremental"]
+        )
+        incremental = options["incremental"] and not options["bigquery_only"]
+        measures_needed_in_bigquery = get_measures_read_by_other_measures()
+        start = datetime.now()
+
+        calculations = []
+        definition_hashes = {}
+        for measure_def in measure_defs:
+            logger.info("Updating measure definition: %s" % measure_def["id"])
+            with transaction.atomic():
+                measure = create_or_update_measure(measure_def, end_date)
+            if options["definitions_only"]:
+                continue
+            if (
+                options["engine"] == "matrixstore"
+                and not options["bigquery_only"]
+                and measure.id not in measures_needed_in_bigquery
+                and can_calculate_from_matrixstore(measure)
+            ):
+                calculation_class = MatrixStoreMeasureCalculation
+            else:
+                calculation_class = MeasureCalculation
+            definition_hashes[measure.id] = get_definition_hash(measure_def, measure)
+            first_month = start_date
+            if incremental and measure.id not in measures_needed_in_bigquery:
+                first_month = get_first_month_to_calculate(
+                    measure, definition_hashes[measure.id], start_date, end_date
+                )
+            calculations.append(
+                calculation_class(
+                    measure, start_date=first_month, end_date=end_date, verbose=verbose
+                )
+            )
+
+        # Measures which read the BigQuery tables of other measures can only be
+        # calculated once those measures have been
+        upstream_job_names = [
+            (calculation.measure.id, job_name)
+            for calculation in calculations
+            if calculation.measure.id in measures_needed_in_bigquery
+            for job_name in calculation.get_bigquery_jobs()
+        ]
+        jobs = {}
+        outstanding_jobs = {}
+        for calculation in calculations:
+            measure = calculation.measure
+            reads_other_measures = "{measures}.practice_data_" in "{} {}".format(
+                measure.numerator_from, measure.denominator_from
+            )
+            calculation_jobs = calculation.get_bigquery_jobs()
+            for job_name, (func, dependencies) in calculation_jobs.items():
+                dependencies = [(measure.id, dep) for dep in dependencies]
+                if reads_other_measures:
+                    dependencies += upstream_job_names
+                jobs[(measure.id, job_name)] = (func, dependencies)
+            outstanding_jobs[measure.id] = {
+                (measure.id, job_name) for job_name in calculation_jobs
+            }
+
+        def write_completed_measures():
+            while calculations and not outstanding_jobs[calculations[0].measure.id]:
+                calculation = calculations.pop(0)
+                if not options["bigquery_only"]:
+                    measure = calculation.measure
+                    with transaction.atomic():
+                        delete_measure_values(
+                            measure, start_date, calculation.start_date
+                        )
+                        calculation.write_to_database()
+                        Measure.objects.filter(id=measure.id).update(
+                            definition_hash=definition_hashes[measure.id]
+                        )
+                elapsed = datetime.now() - start
+                logger.warning(
+                    "Elapsed time for %s: %s seconds"
+                    % (calculation.measure.id, elapsed.seconds)
+                )
+
+        with conditional_constraint_and_index_reconstructor(drop_and_rebuild_indices):
+            write_completed_measures()
+            for measure_id, job_name in run_jobs(jobs, options["parallel"]):
+                outstanding_jobs[measure_id].remove((measure_id, job_name))
+                write_completed_measures()
+
     def handle(self, *args, **options):
         start = datetime.now()
 
@@ -136,9 +303,29 @@ class Command(BaseCommand):
         end_date = ImportLog.objects.latest_in_category("prescribing").current_at
         start_date = end_date - relativedelta(years=5)
 
+        if options["engine"] == "matrixstore":
+            matrixstore_dates = get_db().dates
+            if matrixstore_dates[-1] < end_date.strftime("%Y-%m-%d"):
+                logger.warning(
+                    "MatrixStore only goes up to %s, so calculating all measures "
+                    "in BigQuery",
+                    matrixstore_dates[-1],
+                )
+                options["engine"] = "bigquery"
+            else:
+                # The MatrixStore may not go back as far as `start_date`, and
+                # every measure should cover the same months, whichever engine
+                # calculates it (otherwise charts and global centiles would be
+                # inconsistent between measures)
+                start_date = max(start_date, utils.parse_date(matrixstore_dates[0]))
+
         verbose = options["verbosity"] > 1
         if options["check"]:
             self.check_definitions(measure_defs, start_date, end_date, verbose)
+        elif options["parallel"] > 1:
+            self.build_measures_in_parallel(
+                measure_defs, start_date, end_date, verbose, options
+            )
         else:
             self.build_measures(measure_defs, start_date, end_date, verbose, options)
 
@@ -149,6 +336,29 @@ class Command(BaseCommand):
         parser.add_argument("--definitions_only", action="store_true")
         parser.add_argument("--bigquery_only", action="store_true")
         parser.add_argument("--check", action="store_true")
+        parser.add_argument(
+            "--engine",
+            choices=["bigquery", "matrixstore"],
+            default="bigquery",
+            help=(
+                "Where to calculate measures; with `matrixstore`, measures with "
+                "custom SQL are still calculated in BigQuery"
+            ),
+        )
+        parser.add_argument(
+            "--parallel",
+            type=int,
+            default=1,
+            help="Maximum number of BigQuery jobs to run at once",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help=(
+                "Only calculate months after the latest one already in the "
+                "database, for measures whose definitions haven't changed"
+            ),
+        )
 
 
 def load_measure_defs(measure_ids=None):
@@ -188,6 +398,94 @@ def load_measure_defs(measure_ids=None):
     return measures
 
 
+def get_measures_read_by_other_measures():
+    """Return IDs of measures whose BigQuery practice tables are read by the
+    views which other measures are calculated from (see
+    `create_bq_measure_views`).  These must always be calculated in BigQuery.
+    """
+    path = os.path.join(
+        os.path.dirname(__file__), "measure_sql", "practice_data_all_low_priority.sql"
+    )
+    with open(path) as f:
+        sql = f.read()
+    return set(re.findall(r"\{measures\}\.practice_data_(\w+)", sql))
+
+
+def get_definition_hash(measure_def, measure):
+    """Return a hash of everything which determines the values of a measure:
+    its definition, and the BNF codes which that currently resolves to.  The
+    latter change when presentations are remapped to new codes, which can
+    change the values for earlier months.
+    """
+    data = {
+        "definition": measure_def,
+        "numerator_where": measure.numerator_where,
+        "denominator_where": measure.denominator_where,
+        "numerator_bnf_codes": measure.numerator_bnf_codes,
+        "denominator_bnf_codes": measure.denominator_bnf_codes,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def get_first_month_to_calculate(measure, definition_hash, start_date, end_date):
+    """Return the first month which needs to be calculated for an incremental
+    update of `measure`.
+
+    This is the month after the latest one in the database (or the latest one
+    itself, if there's no newer data) unless the measure has never been
+    calculated or its definition has changed, in which case every month
+    from `start_date` needs calculating.
+    """
+    if measure.definition_hash != definition_hash:
+        return start_date
+    latest_month = MeasureGlobal.objects.filter(measure=measure).aggregate(
+        Max("month")
+    )["month__max"]
+    if latest_month is None:
+        return start_date
+    return max(start_date, min(latest_month + relativedelta(months=1), end_date))
+
+
+def delete_measure_values(measure, start_date, first_month):
+    """Delete a measure's values for months which are about to be calculated,
+    and for those before `start_date`, which are too old to be kept.
+    """
+    months_to_delete = Q(month__lt=start_date) | Q(month__gte=first_month)
+    MeasureValue.objects.filter(measure=measure).filter(months_to_delete).delete()
+    MeasureGlobal.objects.filter(measure=measure).filter(months_to_delete).delete()
+
+
+def run_jobs(jobs, workers):
+    """Run jobs in a pool of `workers` threads, yielding the name of each job as
+    it finishes.
+
+    `jobs` is a dict mapping job names to (function, dependencies) pairs, where
+    dependencies is a list of the names of jobs which must finish before the
+    function can be called.  If a job raises an exception then no more jobs are
+    started and the exception is raised once those already running have
+    finished.
+    """
+    pending = dict(jobs)
+    running = {}
+    finished = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name, (func, dependencies) in list(pending.items()):
+                if all(dependency in finished for dependency in dependencies):
+                    running[executor.submit(func)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(
+                    "Jobs with unmet dependencies: {}".format(sorted(pending, key=str))
+                )
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                future.result()
+                finished.add(name)
+                yield name
+
+
 # Utility methods
 
 
@@ -236,6 +534,59 @@ def convertDecilesToDict(datum, prefix=None):
     return data
 
 
+def copy_rows_to_table(table_name, fieldnames, rows):
+    """Load rows (lists of values in the same order as `fieldnames`) into the
+    given table with a single COPY command.
+
+    Rows are converted to CSV as the database reads them, so they're never
+    all held in memory or written out to a temporary file.
+    """
+    copy_str = "COPY {}({}) FROM STDIN WITH (FORMAT CSV)".format(
+        table_name, ", ".join(fieldnames)
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(copy_str, CSVStream(rows))
+
+
+class CSVStream(object):
+    """A read-only file-like object giving the CSV encoding of each row in an
+    iterable, produced on demand.  None values are written as empty fields,
+    which COPY reads as NULLs.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.lines = CSVLines()
+        self.writer = csv.writer(self.lines)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.buffer += self.lines.pop()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+# `csv.writer` wants a file-like object to write to, but we just want to grab
+# each line as it's written
+class CSVLines(list):
+    write = list.append
+
+
+def encode_centile_array(data):
+    """Encode a dict of values keyed by centile, as returned by
+    `convertSavingsToDict`, as a Postgres array literal for loading into a
+    `CentileArrayField`.
+    """
+    return "{%s}" % ",".join(str(data[str(centile)]) for centile in CENTILES)
+
+
 def normalisePercentile(percentile):
     """Given a percentile between 0 and 1, or None, return a normalised
     version between 0 and 100, or None.
@@ -391,10 +742,48 @@ def create_or_update_measure(measure_def, end_date):
         m.analyse_url = build_analyse_url(m)
 
     m.save()
+    create_measure_value_partition(measure_id)
 
     return m
 
 
+def create_measure_value_partition(measure_id):
+    """Create the partition of frontend_measurevalue which holds the values for
+    the given measure, unless it already exists.
+
+    Any values which were stored for the measure before its partition existed
+    will be in the default partition, and are moved across.
+    """
+    partition = connection.ops.quote_name("frontend_measurevalue_" + measure_id)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [partition])
+        if cursor.fetchone()[0] is not None:
+            return
+        cursor.execute(
+            "CREATE TABLE {} (LIKE frontend_measurevalue INCLUDING DEFAULTS)".format(
+                partition
+            )
+        )
+        cursor.execute(
+            """
+            WITH moved AS (
+              DELETE FROM frontend_measurevalue_default
+              WHERE measure_id = %s
+              RETURNING *
+            )
+            INSERT INTO {} SELECT * FROM moved
+            """.format(
+                partition
+            ),
+            [measure_id],
+        )
+        cursor.execute(
+            "ALTER TABLE frontend_measurevalue ATTACH PARTITION {} "
+            "FOR VALUES IN (%s)".format(partition),
+            [measure_id],
+        )
+
+
 def get_bnf_codes(base_query, filter_):
     """Return list of BNF codes used to caluclate measure numerator/denominator
     values.
@@ -623,6 +1012,75 @@ class MeasureCalculation(object):
         self.calculate_orgs("regtm", bigquery_only=bigquery_only)  # Regional Team
         self.calculate_global(bigquery_only=bigquery_only)
 
+    def get_bigquery_jobs(self):
+        """Return the BigQuery jobs which `calculate` runs, as a dict mapping
+        job names to (function, dependencies) pairs, where dependencies is a
+        list of the names of jobs which must finish first.
+
+        Each job replaces the contents of one table, usually with the result
+        of a query on that table and others.  So jobs which write to the same
+        table must run in order, and jobs which read from a table must wait for
+        the columns they need to have been written.
+        """
+        cost_based = self.measure.is_cost_based
+        jobs = {
+            "practice_ratios": (self.calculate_practice_ratios, []),
+            "practice_percent_rank": (
+                self.add_practice_percent_rank,
+                ["practice_ratios"],
+            ),
+            "practice_global_centiles": (
+                self.calculate_global_centiles_for_practices,
+                ["practice_ratios"],
+            ),
+        }
+        if cost_based:
+            jobs["practice_cost_savings"] = (
+                self.calculate_cost_savings_for_practices,
+                ["practice_percent_rank", "practice_global_centiles"],
+            )
+
+        previous_global_centiles = "practice_global_centiles"
+        for org_type in ORG_TYPES:
+            # STP and Regional Team ratios are calculated from CCG ratios
+            source = "ccg" if org_type in ["stp", "regtm"] else "practice"
+            jobs[org_type + "_ratios"] = (
+                functools.partial(self.calculate_org_ratios, org_type),
+                [source + "_ratios"],
+            )
+            jobs[org_type + "_percent_rank"] = (
+                functools.partial(self.add_org_percent_rank, org_type),
+                [org_type + "_ratios"],
+            )
+            # Each of these adds columns to the global table
+            jobs[org_type + "_global_centiles"] = (
+                functools.partial(self.calculate_global_centiles_for_orgs, org_type),
+                [org_type + "_ratios", previous_global_centiles],
+            )
+            previous_global_centiles = org_type + "_global_centiles"
+            if cost_based:
+                jobs[org_type + "_cost_savings"] = (
+                    functools.partial(self.calculate_cost_savings_for_orgs, org_type),
+                    [org_type + "_percent_rank", org_type + "_global_centiles"],
+                )
+
+        if cost_based:
+            jobs["global_cost_savings"] = (
+                self.calculate_global_cost_savings,
+                [previous_global_centiles]
+                + [org_type + "_cost_savings" for org_type in ["practice"] + ORG_TYPES],
+            )
+        return jobs
+
+    def write_to_database(self):
+        """Write the results of the jobs returned by `get_bigquery_jobs` to the
+        database.
+        """
+        self.write_practice_ratios_to_database()
+        for org_type in ORG_TYPES:
+            self.write_org_ratios_to_database(org_type)
+        self.write_global_centiles_to_database()
+
     def calculate_practices(self, bigquery_only=False):
         """Calculate ratios, centiles and (optionally) cost savings at a
         practice level, and write these to the database.
@@ -720,30 +1178,13 @@ class MeasureCalculation(object):
     def write_practice_ratios_to_database(self):
         """Copy the bigquery ratios data to the local postgres database.
 
-        Uses COPY command via a CSV file for performance as this can
-        be a very large number, especially when computing many months'
-        data at once.  We drop and then recreate indexes to improve
-        load time performance.
+        This can be a very large number of rows, especially when computing
+        many months' data at once, so they are streamed straight into a COPY
+        command (see `copy_rows_to_table`).  We drop and then recreate indexes
+        to improve load time performance.
 
         """
-        f = tempfile.TemporaryFile(mode="r+")
-        writer = csv.DictWriter(f, fieldnames=MEASURE_FIELDNAMES)
-        # Write the data we want to load into a file
-        for datum in self.get_rows_as_dicts(self.table_name("practice")):
-            datum["measure_id"] = self.measure.id
-            if self.measure.is_cost_based:
-                datum["cost_savings"] = json.dumps(convertSavingsToDict(datum))
-            datum["percentile"] = normalisePercentile(datum["percentile"])
-            datum = {fn: datum[fn] for fn in MEASURE_FIELDNAMES if fn in datum}
-            writer.writerow(datum)
-        # load data
-        copy_str = "COPY frontend_measurevalue(%s) FROM STDIN "
-        copy_str += "WITH (FORMAT CSV)"
-        self.log(copy_str % ", ".join(MEASURE_FIELDNAMES))
-        f.seek(0)
-        with connection.cursor() as cursor:
-            cursor.copy_expert(copy_str % ", ".join(MEASURE_FIELDNAMES), f)
-        f.close()
+        self.write_measure_values(self.table_name("practice"))
 
     def calculate_orgs(self, org_type, bigquery_only=False):
         """Calculate ratios, centiles and (optionally) cost savings at a
@@ -822,13 +1263,24 @@ class MeasureCalculation(object):
     def write_org_ratios_to_database(self, org_type):
         """Create measure values for organisation ratios.
         """
-        for datum in self.get_rows_as_dicts(self.table_name(org_type)):
-            datum["measure_id"] = self.measure.id
-            if self.measure.is_cost_based:
-                datum["cost_savings"] = convertSavingsToDict(datum)
-            datum["percentile"] = normalisePercentile(datum["percentile"])
-            datum = {fn: datum[fn] for fn in MEASURE_FIELDNAMES if fn in datum}
-            MeasureValue.objects.create(**datum)
+        self.write_measure_values(self.table_name(org_type))
+
+    def write_measure_values(self, table_name):
+        """Copy rows from the given bigquery table into MeasureValues.
+        """
+        rows = (
+            self.build_measure_value_row(datum)
+            for datum in self.get_rows_as_dicts(table_name)
+        )
+        self.log("Copying %s to frontend_measurevalue" % table_name)
+        copy_rows_to_table("frontend_measurevalue", MEASURE_FIELDNAMES, rows)
+
+    def build_measure_value_row(self, datum):
+        datum["measure_id"] = self.measure.id
+        if self.measure.is_cost_based:
+            datum["cost_savings"] = encode_centile_array(convertSavingsToDict(datum))
+        datum["percentile"] = normalisePercentile(datum["percentile"])
+        return [datum.get(fn) for fn in MEASURE_FIELDNAMES]
 
     def calculate_global(self, bigquery_only=False):
         if self.measure.is_cost_based:
@@ -851,57 +1303,51 @@ class MeasureCalculation(object):
         self.log(
             "Writing global centiles from %s to database" % self.table_name("global")
         )
-        for d in self.get_rows_as_dicts(self.table_name("global")):
-            regtm_cost_savings = {}
-            stp_cost_savings = {}
-            ccg_cost_savings = {}
-            pcn_cost_savings = {}
-            practice_cost_savings = {}
-            d["measure_id"] = self.measure.id
-            # The cost-savings calculations prepend columns with
-            # global_. There is probably a better way of constructing
-            # the query so this clean-up doesn't have to happen...
-            new_d = {}
-            for attr, value in d.items():
-                new_d[attr.replace("global_", "")] = value
-            d = new_d
-
-            mg, _ = MeasureGlobal.objects.get_or_create(
-                measure_id=self.measure.id, month=d["month"]
-            )
-
-            # Coerce decile-based values into JSON objects
-            if self.measure.is_cost_based:
-                practice_cost_savings = convertSavingsToDict(d, prefix="practice")
-                pcn_cost_savings = convertSavingsToDict(d, prefix="pcn")
-                ccg_cost_savings = convertSavingsToDict(d, prefix="ccg")
-                stp_cost_savings = convertSavingsToDict(d, prefix="stp")
-                regtm_cost_savings = convertSavingsToDict(d, prefix="regtm")
-                mg.cost_savings = {
-                    "regional_team": regtm_cost_savings,
-                    "stp": stp_cost_savings,
-                    "ccg": ccg_cost_savings,
-                    "pcn": pcn_cost_savings,
-                    "practice": practice_cost_savings,
+        rows = (
+            self.build_measure_global_row(d)
+            for d in self.get_rows_as_dicts(self.table_name("global"))
+        )
+        copy_rows_to_table("frontend_measureglobal", MEASURE_GLOBAL_FIELDNAMES, rows)
+
+    def build_measure_global_row(self, d):
+        # The cost-savings calculations prepend columns with
+        # global_. There is probably a better way of constructing
+        # the query so this clean-up doesn't have to happen...
+        new_d = {}
+        for attr, value in d.items():
+            new_d[attr.replace("global_", "")] = value
+        d = new_d
+        d["measure_id"] = self.measure.id
+
+        # Coerce decile-based values into JSON objects
+        if self.measure.is_cost_based:
+            d["cost_savings"] = encode_json(
+                {
+                    "regional_team": convertSavingsToDict(d, prefix="regtm"),
+                    "stp": convertSavingsToDict(d, prefix="stp"),
+                    "ccg": convertSavingsToDict(d, prefix="ccg"),
+                    "pcn": convertSavingsToDict(d, prefix="pcn"),
+                    "practice": convertSavingsToDict(d, prefix="practice"),
                 }
-            practice_deciles = convertDecilesToDict(d, prefix="practice")
-            pcn_deciles = convertDecilesToDict(d, prefix="pcn")
-            ccg_deciles = convertDecilesToDict(d, prefix="ccg")
-            stp_deciles = convertDecilesToDict(d, prefix="stp")
-            regtm_deciles = convertDecilesToDict(d, prefix="regtm")
-            mg.percentiles = {
-                "regional_team": regtm_deciles,
-                "stp": stp_deciles,
-                "ccg": ccg_deciles,
-                "pcn": pcn_deciles,
-                "practice": practice_deciles,
+            )
+        d["percentiles"] = encode_json(
+            {
+                "regional_team": convertDecilesToDict(d, prefix="regtm"),
+                "stp": convertDecilesToDict(d, prefix="stp"),
+                "ccg": convertDecilesToDict(d, prefix="ccg"),
+                "pcn": convertDecilesToDict(d, prefix="pcn"),
+                "practice": convertDecilesToDict(d, prefix="practice"),
             }
+        )
 
-            # Set the rest of the data returned from bigquery directly
-            # on the model
-            for attr, value in d.items():
-                setattr(mg, attr, value)
-            mg.save()
+        # This matches MeasureGlobal.save()
+        numerator = float_or_null(d["numerator"])
+        denominator = float_or_null(d["denominator"])
+        d["numerator"] = numerator
+        d["denominator"] = denominator
+        if denominator:
+            d["calc_value"] = numerator / denominator if numerator else numerator
+        return [d.get(fn) for fn in MEASURE_GLOBAL_FIELDNAMES]
 
     def insert_rows_from_query(self, query_id, table_name, ctx, dry_run=False):
         """Interpolate values from ctx into SQL identified by query_id, and
@@ -969,6 +1415,42 @@ class MeasureCalculation(object):
         return val
 
 
+class MatrixStoreMeasureCalculation(MeasureCalculation):
+    """Logic for measure calculations from the MatrixStore.
+
+    Rows are calculated locally rather than in BigQuery tables, but are then
+    written to the database in the same way.
+    """
+
+    def calculate(self, bigquery_only=False):
+        assert not bigquery_only
+        self.write_to_database()
+
+    def get_bigquery_jobs(self):
+        return {}
+
+    def write_to_database(self):
+        """Calculate the measure and write the results to the database."""
+        db = get_db()
+        start_date = self.start_date.strftime("%Y-%m-%d")
+        end_date = self.end_date.strftime("%Y-%m-%d")
+        if db.dates[0] > start_date or db.dates[-1] < end_date:
+            raise RuntimeError(
+                "MatrixStore covers {} to {}, so {} cannot be calculated for all "
+                "months from {} to {}".format(
+                    db.dates[0], db.dates[-1], self.measure.id, start_date, end_date
+                )
+            )
+        tables = calculate_measure(self.measure, db, self.start_date, self.end_date)
+        self.tables = {
+            self.table_name(org_type): rows for org_type, rows in tables.items()
+        }
+        super().write_to_database()
+
+    def get_rows_as_dicts(self, table_name):
+        return self.tables[table_name]
+
+
 @contextmanager
 def conditional_constraint_and_index_reconstructor(enabled):
     if not enabled:
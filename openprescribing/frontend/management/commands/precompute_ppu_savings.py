@@ -0,0 +1,31 @@
+"""
+Precomputes price-per-unit savings for the latest month in a MatrixStore file
+(by default, the live file) for all practices, all CCGs and for All England.
+These get used in place of calculating savings on demand for as long as the
+file stays live. See `frontend.price_per_unit.precomputed_savings`.
+"""
+import logging
+import os.path
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from frontend.price_per_unit.precomputed_savings import precompute_savings
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--filename", help="MatrixStore file to use instead of the live file"
+        )
+
+    def handle(self, filename=None, **kwargs):
+        if not filename:
+            filename = os.path.realpath(settings.MATRIXSTORE_LIVE_FILE)
+        path = precompute_savings(filename)
+        logger.info("Wrote precomputed savings to %s", path)
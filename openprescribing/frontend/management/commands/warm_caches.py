@@ -0,0 +1,201 @@
+"""
+Computes the expensive, cached values behind our most popular pages ahead of
+traffic so that the first visitors after a deploy or a new MatrixStore file
+going live don't have to wait for them.
+
+Each item is computed in a pool of worker processes and, because everything
+here is written via the cache in exactly the way a request would write it, the
+command is safe to run while the site is serving traffic: at worst a request
+and a worker compute the same value and both store it.
+"""
+from collections import namedtuple
+import logging
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+
+from common.utils import parse_date
+from frontend.ghost_branded_generics import (
+    MIN_GHOST_GENERIC_DELTA,
+    PRESENTATIONS_TO_IGNORE,
+    get_total_ghost_branded_generic_spending_per_practice,
+)
+from frontend.models import ImportLog
+from frontend.price_per_unit.precomputed_savings import (
+    ORG_TYPES as PPU_SAVINGS_ORG_TYPES,
+    get_precomputed_savings,
+)
+from frontend.price_per_unit.savings import get_total_savings_for_all_orgs
+from frontend.views import views
+from matrixstore.db import (
+    clear_cache,
+    get_db,
+    latest_prescribing_date,
+    pinned_generation,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Entity types which can be selected on the All England dashboard
+ALL_ENGLAND_ENTITY_TYPES = ["CCG", "practice"]
+
+# Helpers from `frontend.views.views` whose results get stored by `cached`
+ALL_ENGLAND_CACHED_FUNCTIONS = [
+    "all_england_measure_savings",
+    "all_england_low_priority_savings",
+    "all_england_low_priority_total",
+]
+
+WarmingItem = namedtuple("WarmingItem", "name function args")
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            help=(
+                "Number of worker processes to use, or 1 to warm everything in "
+                "this process (default: 4)"
+            ),
+            type=int,
+            default=4,
+        )
+
+    def handle(self, processes, **kwargs):
+        items = get_warming_items()
+        failures = 0
+        start = time.time()
+        for name, duration, error in warm_items(items, processes):
+            if error is None:
+                self.stdout.write("{}: {:.1f}s".format(name, duration))
+            else:
+                failures += 1
+                self.stderr.write(
+                    "{}: failed after {:.1f}s: {}".format(name, duration, error)
+                )
+        self.stdout.write(
+            "Warmed {} of {} items in {:.1f}s".format(
+                len(items) - failures, len(items), time.time() - start
+            )
+        )
+        if failures:
+            raise CommandError("Failed to warm {} items".format(failures))
+
+
+def get_warming_items():
+    """
+    Return a list of WarmingItems covering the values which the most popular
+    pages need for their default (i.e. latest) dates
+    """
+    dashboard_date = ImportLog.objects.latest_in_category("dashboard_data").current_at
+    with pinned_generation():
+        prescribing_date = str(parse_date(latest_prescribing_date()))
+        ppu_savings = [
+            (prescribing_date, org_type) for org_type in PPU_SAVINGS_ORG_TYPES
+        ]
+        # The All England dashboard shows price-per-unit savings for the latest
+        # dashboard date which may lag behind the latest prescribing date
+        if str(dashboard_date) != prescribing_date:
+            ppu_savings.append((str(dashboard_date), "all_standard_practices"))
+        # Pages read savings from the precomputed file wherever it covers them,
+        # so we only need to warm those it doesn't (e.g. because it hasn't been
+        # written yet, or because the org relationships have since changed)
+        precomputed = get_precomputed_savings()
+        if precomputed is not None:
+            ppu_savings = [
+                (date, org_type)
+                for (date, org_type) in ppu_savings
+                if not precomputed.is_valid_for(date, org_type)
+            ]
+
+    items = []
+    for date, org_type in ppu_savings:
+        items.append(
+            WarmingItem(
+                "ppu_savings:{}:{}".format(org_type, date),
+                warm_ppu_savings,
+                (date, org_type),
+            )
+        )
+    items.append(
+        WarmingItem(
+            "ghost_generics:{}".format(prescribing_date),
+            warm_ghost_generics,
+            (prescribing_date,),
+        )
+    )
+    if settings.ENABLE_CACHING:
+        for function_name in ALL_ENGLAND_CACHED_FUNCTIONS:
+            for entity_type in ALL_ENGLAND_ENTITY_TYPES:
+                items.append(
+                    WarmingItem(
+                        "{}:{}:{}".format(function_name, entity_type, dashboard_date),
+                        warm_all_england_cached_function,
+                        (function_name, entity_type, dashboard_date),
+                    )
+                )
+    else:
+        logger.warning(
+            "Not warming All England dashboard values as ENABLE_CACHING is off"
+        )
+    return items
+
+
+def warm_items(items, processes):
+    """
+    Compute each WarmingItem, yielding the results of `warm_item` in the order
+    they complete
+
+    Items are computed in a pool of `processes` worker processes, or in this
+    process if `processes` is 1.
+    """
+    if processes == 1:
+        yield from map(warm_item, items)
+        return
+    # Worker processes are forked from this one, so we need to make sure they
+    # don't inherit our open database connections or MatrixStore file
+    connections.close_all()
+    clear_cache()
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap_unordered(warm_item, items)
+
+
+def warm_item(item):
+    """
+    Compute a single WarmingItem, returning its name, how long it took and any
+    error raised
+
+    This is designed to be run in a separate worker process.
+    """
+    start = time.time()
+    try:
+        # Pinning the generation ensures that everything computed for this item
+        # comes from a single MatrixStore file, even if a new file goes live
+        # part way through
+        with pinned_generation():
+            item.function(*item.args)
+        error = None
+    except Exception as e:
+        logger.exception("Error warming %s", item.name)
+        error = str(e)
+    return item.name, time.time() - start, error
+
+
+def warm_ppu_savings(date, org_type):
+    get_total_savings_for_all_orgs(date, org_type)
+
+
+def warm_ghost_generics(date):
+    get_total_ghost_branded_generic_spending_per_practice(
+        get_db(), date, PRESENTATIONS_TO_IGNORE, MIN_GHOST_GENERIC_DELTA
+    )
+
+
+def warm_all_england_cached_function(function_name, entity_type, date):
+    views.cached(getattr(views, function_name), entity_type, date)
@@ -1,10 +1,8 @@
 from django.db import models
 from django.db.models import FloatField, Func, F, Q, Value, Sum
 from django.db.models.functions import Cast, Coalesce, Greatest
-from django.contrib.postgres.fields.jsonb import (
-    JSONField,
-    KeyTextTransform as ValueFromJsonObject,
-)
+from django.contrib.postgres.fields.array import IndexTransform
+from django.contrib.postgres.fields.jsonb import JSONField
 
 
 CENTILES = ["10", "20", "30", "40", "50", "60", "70", "80", "90"]
@@ -119,7 +117,7 @@ class MeasureValueQuerySet(models.QuerySet):
             .annotate(
                 numerator=Sum("numerator"),
                 denominator=Sum("denominator"),
-                cost_savings=_aggregate_over_json(
+                cost_savings=_aggregate_over_array(
                     field="cost_savings",
                     aggregate_function=_sum_positive_values,
                     keys=CENTILES,
@@ -137,7 +135,7 @@ class MeasureValueQuerySet(models.QuerySet):
         the current query
         """
         result = self.aggregate(
-            total=_aggregate_over_json(
+            total=_aggregate_over_array(
                 field="cost_savings",
                 aggregate_function=_sum_positive_values,
                 keys=CENTILES,
@@ -190,14 +188,18 @@ def _divide(numerator_field, denominator_field):
     return numerator / denominator
 
 
-def _aggregate_over_json(field, aggregate_function, keys):
+def _aggregate_over_array(field, aggregate_function, keys):
     """
-    SQL function which aggregates over `field` (which should be of JSONB type)
-    by applying `aggregate_function` over each of the supplied `keys` within
-    the object.  Returns a JSONB object with those specified keys.
+    SQL function which aggregates over `field` (which should be an array with
+    an element for each of the supplied `keys`, in order) by applying
+    `aggregate_function` over each element.  Returns a JSONB object with the
+    specified keys.
     """
     return _build_json_object(
-        {key: aggregate_function(_get_json_value(key, field)) for key in keys}
+        {
+            key: aggregate_function(_get_array_value(index, field))
+            for index, key in enumerate(keys)
+        }
     )
 
 
@@ -223,11 +225,13 @@ def _sum_positive_values(field):
     return Sum(field_with_floor)
 
 
-def _get_json_value(key, json_field):
+def _get_array_value(index, array_field):
     """
-    SQL function which extracts `key` from a field of type JSONB
+    SQL function which extracts the element at (zero-based) `index` from an
+    array field
     """
-    return ValueFromJsonObject(_preserve_key_type(key), json_field)
+    # Postgres arrays are indexed from one
+    return IndexTransform(index + 1, FloatField(), array_field)
 
 
 def _preserve_key_type(key):
@@ -0,0 +1,505 @@
+"""
+Calculates measures from the MatrixStore, as an alternative to BigQuery
+
+`import_measures` calculates each measure with a series of BigQuery jobs (see
+the SQL in `frontend/management/commands/measure_sql`). Most measures have
+numerators and denominators which are just totals of prescribing over a list
+of BNF codes, or practice statistics, and these can be calculated directly
+from the MatrixStore in a few seconds. Measures with custom SQL still need to
+be calculated in BigQuery.
+
+The calculations here follow that SQL as closely as possible, and produce rows
+with the same fields as the BigQuery tables so that `import_measures` can write
+them to the database in exactly the same way. `compare_rows` lets us check
+that the two agree (see the `benchmark_measure_engines` command).
+"""
+from datetime import datetime
+import math
+import warnings
+
+import numpy
+import scipy.sparse
+
+from frontend.models import Practice
+from matrixstore.row_grouper import RowGrouper
+
+
+CENTILES = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+# Maps numerator and denominator types to MatrixStore presentation columns
+PRESCRIBING_FIELDS = {
+    "bnf_items": "items",
+    "bnf_quantity": "quantity",
+    "bnf_cost": "actual_cost",
+}
+
+# Maps denominator types to MatrixStore practice statistics, and the number by
+# which we divide them
+PRACTICE_STATISTICS = {
+    "list_size": ("total_list_size", 1000.0),
+    "star_pu_antibiotics": ("star_pu.oral_antibacterials_item", 1),
+}
+
+# Maps the org types used in the names of BigQuery tables to the fields which
+# identify orgs of that type
+ORG_ID_FIELDS = {
+    "pcn": ["pcn_id"],
+    "ccg": ["pct_id", "stp_id", "regional_team_id"],
+    "stp": ["stp_id"],
+    "regtm": ["regional_team_id"],
+}
+
+# SQLite limits the number of parameters in a single query
+MAX_BNF_CODES_PER_QUERY = 500
+
+
+def can_calculate_from_matrixstore(measure):
+    """
+    Return whether the measure can be calculated from the MatrixStore rather
+    than BigQuery
+    """
+    if measure.numerator_type not in PRESCRIBING_FIELDS:
+        return False
+    if measure.is_cost_based and measure.is_percentage:
+        # Cost savings for percentage measures need the cost and quantity of
+        # the denominator's prescribing
+        return measure.denominator_type in PRESCRIBING_FIELDS
+    return (
+        measure.denominator_type in PRESCRIBING_FIELDS
+        or measure.denominator_type in PRACTICE_STATISTICS
+    )
+
+
+def calculate_measure(measure, db, start_date, end_date):
+    """
+    Return a dict mapping each of "practice", "pcn", "ccg", "stp", "regtm" and
+    "global" to a list of the rows which the BigQuery calculation would have
+    written to the corresponding table
+
+    Only months between `start_date` and `end_date` which the MatrixStore
+    covers are calculated.
+    """
+    assert can_calculate_from_matrixstore(measure), measure.id
+    return MeasureCalculation(measure, db, start_date, end_date).calculate()
+
+
+class MeasureCalculation(object):
+    def __init__(self, measure, db, start_date, end_date):
+        self.measure = measure
+        self.db = db
+        self.practices = list(
+            Practice.objects.filter(setting=4, ccg__isnull=False)
+            .order_by("code")
+            .values(
+                "code",
+                "pcn_id",
+                "ccg_id",
+                "ccg__org_type",
+                "ccg__stp_id",
+                "ccg__regional_team_id",
+            )
+        )
+        # Practices which aren't in the MatrixStore have no prescribing or
+        # statistics, so all their values are zero
+        self.present_rows = numpy.array(
+            [p["code"] in db.practice_offsets for p in self.practices], dtype=bool
+        )
+        self.matrixstore_rows = numpy.array(
+            [
+                db.practice_offsets[p["code"]]
+                for p in self.practices
+                if p["code"] in db.practice_offsets
+            ],
+            dtype=numpy.int_,
+        )
+        start_date = start_date.strftime("%Y-%m-%d")
+        end_date = end_date.strftime("%Y-%m-%d")
+        self.dates = [date for date in db.dates if start_date <= date <= end_date]
+        offsets = [db.date_offsets[date] for date in self.dates]
+        self.date_columns = numpy.array(offsets, dtype=numpy.int_)
+
+    def calculate(self):
+        local = self.get_practice_values()
+        self.drop_months_without_denominators(local)
+        months = [datetime.strptime(date, "%Y-%m-%d").date() for date in self.dates]
+
+        # The practice ratios are set to NULL where they're not finite
+        calc_value = divide(local["numerator"], local["denominator"])
+        calc_value[~numpy.isfinite(calc_value)] = numpy.nan
+        if self.measure.is_cost_based and self.measure.is_percentage:
+            self.global_unit_costs = get_global_unit_costs(local)
+        tables = {}
+        centiles = {}
+        cost_savings = {}
+        tables["practice"] = self.build_org_values(
+            "practice", local, calc_value, months, centiles, cost_savings
+        )
+
+        for org_type in ["pcn", "ccg", "stp", "regtm"]:
+            org_ids, row_grouper = self.get_row_grouper(org_type)
+            grouped = dict(
+                zip(local.keys(), row_grouper.sum_many(list(local.values())))
+            )
+            grouped["ids"] = org_ids
+            tables[org_type] = self.build_org_values(
+                org_type,
+                grouped,
+                divide(grouped["numerator"], grouped["denominator"]),
+                months,
+                centiles,
+                cost_savings,
+            )
+
+        tables["global"] = self.build_global_rows(local, months, centiles, cost_savings)
+        return tables
+
+    def get_practice_values(self):
+        """
+        Return a dict mapping each field of the BigQuery practice table which
+        is summed over orgs to an array of its values, with a row for each
+        practice and a column for each month
+        """
+        measure = self.measure
+        values = {}
+        prescribing = self.get_prescribing(measure.numerator_bnf_codes)
+        values["numerator"] = prescribing[PRESCRIBING_FIELDS[measure.numerator_type]]
+        if measure.denominator_type in PRESCRIBING_FIELDS:
+            denominator_prescribing = self.get_prescribing(
+                measure.denominator_bnf_codes
+            )
+            field = PRESCRIBING_FIELDS[measure.denominator_type]
+            values["denominator"] = denominator_prescribing[field]
+        else:
+            name, divisor = PRACTICE_STATISTICS[measure.denominator_type]
+            values["denominator"] = self.get_practice_statistic(name) / divisor
+        if measure.is_cost_based and measure.is_percentage:
+            # These match the extra columns `import_measures` adds for cost
+            # savings calculations
+            for field, column in [
+                ("items", "items"),
+                ("cost", "actual_cost"),
+                ("quantity", "quantity"),
+            ]:
+                values["num_" + field] = prescribing[column]
+                values["denom_" + field] = denominator_prescribing[column]
+        return values
+
+    def drop_months_without_denominators(self, local):
+        """
+        BigQuery only calculates practice statistics measures for months which
+        have practice statistics, whereas the MatrixStore has zeros for months
+        without them
+        """
+        if self.measure.denominator_type not in PRACTICE_STATISTICS:
+            return
+        keep = local["denominator"].any(axis=0)
+        self.dates = [date for date, keep_date in zip(self.dates, keep) if keep_date]
+        for key, value in local.items():
+            local[key] = value[:, keep]
+
+    def get_prescribing(self, bnf_codes):
+        """
+        Return a dict mapping "items", "quantity" and "actual_cost" to arrays
+        of each practice's total prescribing of the given BNF codes in each
+        month
+        """
+        fields = ["items", "quantity", "actual_cost"]
+        totals = {field: self.get_practice_matrix(None) for field in fields}
+        bnf_codes = bnf_codes or []
+        for i in range(0, len(bnf_codes), MAX_BNF_CODES_PER_QUERY):
+            chunk = bnf_codes[i : i + MAX_BNF_CODES_PER_QUERY]
+            sums = self.db.sum_matrices(
+                """
+                SELECT items, quantity, actual_cost FROM presentation
+                WHERE bnf_code IN ({})
+                """.format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            )
+            for field, matrix in zip(fields, sums):
+                totals[field] += self.get_practice_matrix(matrix)
+        # Costs are stored in pence in the MatrixStore
+        totals["actual_cost"] /= 100
+        return totals
+
+    def get_practice_statistic(self, name):
+        results = list(
+            self.db.query("SELECT value FROM practice_statistic WHERE name=?", [name])
+        )
+        return self.get_practice_matrix(results[0][0] if results else None)
+
+    def get_practice_matrix(self, matrix):
+        """
+        Return the values from a MatrixStore matrix as a dense float array,
+        with a row for each practice and a column for each month we're
+        calculating
+        """
+        values = numpy.zeros((len(self.practices), len(self.date_columns)))
+        if matrix is None:
+            return values
+        matrix = matrix[:, self.date_columns]
+        if scipy.sparse.issparse(matrix):
+            matrix = matrix.toarray()
+        values[self.present_rows] = matrix[self.matrixstore_rows]
+        return values
+
+    def get_row_grouper(self, org_type):
+        """
+        Return the IDs of the orgs of the given type and a RowGrouper which
+        sums practice rows into rows for those orgs
+
+        As in BigQuery, practices without a PCN, STP or regional team are
+        grouped together under an ID of None. For consistency with the SQL,
+        CCGs and the orgs above them are built from practices in CCGs proper
+        (rather than other kinds of PCT).
+        """
+        if org_type == "pcn":
+            org_ids = [(p["pcn_id"],) for p in self.practices]
+        else:
+            org_ids = [
+                (p["ccg_id"], p["ccg__stp_id"], p["ccg__regional_team_id"])
+                if p["ccg__org_type"] == "CCG"
+                else None
+                for p in self.practices
+            ]
+            if org_type == "stp":
+                org_ids = [ids and ids[1:2] for ids in org_ids]
+            elif org_type == "regtm":
+                org_ids = [ids and ids[2:] for ids in org_ids]
+        # RowGrouper needs group IDs which can be sorted, so we can't use None
+        row_grouper = RowGrouper(
+            (offset, tuple(org_id or "" for org_id in ids))
+            for offset, ids in enumerate(org_ids)
+            if ids is not None
+        )
+        org_ids = [tuple(org_id or None for org_id in ids) for ids in row_grouper.ids]
+        return org_ids, row_grouper
+
+    def build_org_values(
+        self, org_type, values, calc_value, months, centiles, cost_savings
+    ):
+        """
+        Return rows for the BigQuery table for `org_type`, recording the
+        centiles of `calc_value` and the cost savings of each org in the dicts
+        supplied
+        """
+        percentile = percent_rank(calc_value)
+        centiles[org_type] = get_centiles(calc_value)
+        columns = dict(values, calc_value=calc_value, percentile=percentile)
+        if self.measure.is_cost_based:
+            if self.measure.is_percentage:
+                org_cost_savings = percentage_cost_savings(
+                    values, centiles[org_type], *self.global_unit_costs
+                )
+            else:
+                org_cost_savings = list_size_cost_savings(values, centiles[org_type])
+            cost_savings[org_type] = org_cost_savings
+            for centile, savings in zip(CENTILES, org_cost_savings):
+                columns["cost_savings_{}".format(centile)] = savings
+
+        if org_type == "practice":
+            id_fields = [
+                ("practice_id", "code"),
+                ("pcn_id", "pcn_id"),
+                ("pct_id", "ccg_id"),
+                ("stp_id", "ccg__stp_id"),
+                ("regional_team_id", "ccg__regional_team_id"),
+            ]
+            ids = [{field: p[key] for field, key in id_fields} for p in self.practices]
+            # NaNs have already been converted to NULLs
+            keep_nans = False
+        else:
+            id_fields = ORG_ID_FIELDS[org_type]
+            ids = [dict(zip(id_fields, org_ids)) for org_ids in columns.pop("ids")]
+            # IEEE_DIVIDE gives NaN for orgs with no numerator or denominator
+            keep_nans = True
+        return build_rows(ids, months, columns, keep_nans=keep_nans)
+
+    def build_global_rows(self, local, months, centiles, cost_savings):
+        columns = {
+            "numerator": local["numerator"].sum(axis=0),
+            "denominator": local["denominator"].sum(axis=0),
+        }
+        for org_type in ["practice", "pcn", "ccg", "stp", "regtm"]:
+            for centile, values in zip(CENTILES, centiles[org_type]):
+                columns["{}_{}th".format(org_type, centile)] = values
+            if self.measure.is_cost_based:
+                for centile, savings in zip(CENTILES, cost_savings[org_type]):
+                    key = "{}_cost_savings_{}".format(org_type, centile)
+                    # Only positive savings count towards the total
+                    columns[key] = numpy.where(savings > 0, savings, 0).sum(axis=0)
+        columns = {key: value[numpy.newaxis, :] for key, value in columns.items()}
+        return build_rows([{}], months, columns)
+
+
+def build_rows(ids, months, columns, keep_nans=False):
+    """
+    Return a list of row dicts, one for each org and month, given a list of
+    dicts of the fields identifying each org and a dict mapping other fields to
+    arrays of values with a row for each org and a column for each month
+
+    NaNs are converted to None (i.e. NULL), except for `calc_value` if
+    `keep_nans` is set.
+    """
+    columns = {
+        key: [
+            [
+                None
+                if isinstance(value, float)
+                and math.isnan(value)
+                and not (keep_nans and key == "calc_value")
+                else value
+                for value in row
+            ]
+            for row in value.tolist()
+        ]
+        for key, value in columns.items()
+    }
+    rows = []
+    for org_offset, org_ids in enumerate(ids):
+        for month_offset, month in enumerate(months):
+            row = dict(org_ids, month=month)
+            for key, values in columns.items():
+                row[key] = values[org_offset][month_offset]
+            rows.append(row)
+    return rows
+
+
+def divide(numerators, denominators):
+    """
+    Divide arrays elementwise with IEEE semantics, like BigQuery's IEEE_DIVIDE
+    """
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.true_divide(numerators, denominators)
+
+
+def percent_rank(values):
+    """
+    Return the rank of each value within its column, as given by BigQuery's
+    PERCENT_RANK, ignoring NaNs (which are given a rank of NaN)
+    """
+    ranks = numpy.full(values.shape, numpy.nan)
+    for column in range(values.shape[1]):
+        present = ~numpy.isnan(values[:, column])
+        column_values = values[present, column]
+        count = len(column_values)
+        # The number of values strictly less than each value (i.e. its rank
+        # less one, where tied values all get the lowest rank)
+        lower = numpy.searchsorted(numpy.sort(column_values), column_values, "left")
+        ranks[present, column] = lower / max(count - 1, 1)
+    return ranks
+
+
+def get_centiles(values):
+    """
+    Return an array giving each of the CENTILES of each column of values, as
+    given by BigQuery's PERCENTILE_CONT, ignoring NaNs
+
+    The result has a row for each centile. Where a column has no values its
+    centiles are NaN.
+    """
+    if values.shape[0] == 0:
+        return numpy.full((len(CENTILES), values.shape[1]), numpy.nan)
+    with warnings.catch_warnings():
+        # Columns with no values trigger a warning
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return numpy.nanpercentile(values, CENTILES, axis=0)
+
+
+def list_size_cost_savings(values, centiles):
+    """
+    Return the savings which would be made at each centile for measures
+    which aren't percentages (see `*_list_size_measure_cost_savings.sql`)
+    """
+    return [values["numerator"] - ratio * values["denominator"] for ratio in centiles]
+
+
+def get_global_unit_costs(local):
+    """
+    Return the cost per unit of the numerator, and of the rest of the
+    denominator, across all practices in each month
+    """
+    totals = {key: value.sum(axis=0) for key, value in local.items()}
+    cost_per_num = divide(totals["num_cost"], totals["num_quantity"])
+    cost_per_denom = divide(
+        totals["denom_cost"] - totals["num_cost"],
+        totals["denom_quantity"] - totals["num_quantity"],
+    )
+    return cost_per_num, cost_per_denom
+
+
+def percentage_cost_savings(values, centiles, cost_per_num, cost_per_denom):
+    """
+    Return the savings which would be made at each centile for percentage
+    measures (see `*_percentage_measure_cost_savings.sql`)
+    """
+    num_cost = values["num_cost"]
+    num_quantity = values["num_quantity"]
+    denom_cost = values["denom_cost"]
+    denom_quantity = values["denom_quantity"]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        num_unit_cost = numpy.where(
+            num_quantity > 0, num_cost / num_quantity, cost_per_num
+        )
+        other_quantity = denom_quantity - num_quantity
+        other_unit_cost = numpy.where(
+            other_quantity == 0,
+            cost_per_denom,
+            (denom_cost - num_cost) / other_quantity,
+        )
+        return [
+            denom_cost
+            - (
+                ratio * denom_quantity * num_unit_cost
+                + (denom_quantity - denom_quantity * ratio) * other_unit_cost
+            )
+            for ratio in centiles
+        ]
+
+
+def compare_rows(expected_rows, actual_rows, key_fields, rel_tol=1e-6, abs_tol=1e-6):
+    """
+    Compare two lists of rows, matched on `key_fields` and month, returning a
+    list of strings describing any differences in the fields they share
+
+    None and NaN are treated as equal.
+    """
+    differences = []
+
+    def get_key(row):
+        return tuple(row[field] for field in key_fields) + (str(row["month"])[:10],)
+
+    expected = {get_key(row): row for row in expected_rows}
+    actual = {get_key(row): row for row in actual_rows}
+    for key in sorted(expected.keys() - actual.keys(), key=str):
+        differences.append("Missing row: {}".format(key))
+    for key in sorted(actual.keys() - expected.keys(), key=str):
+        differences.append("Unexpected row: {}".format(key))
+    for key in sorted(expected.keys() & actual.keys(), key=str):
+        expected_row = expected[key]
+        actual_row = actual[key]
+        for field in sorted(expected_row.keys() & actual_row.keys()):
+            if field == "month" or field in key_fields:
+                continue
+            if not values_match(
+                expected_row[field], actual_row[field], rel_tol, abs_tol
+            ):
+                differences.append(
+                    "{} {}: expected {!r}, got {!r}".format(
+                        key, field, expected_row[field], actual_row[field]
+                    )
+                )
+    return differences
+
+
+def values_match(expected, actual, rel_tol, abs_tol):
+    if is_null(expected) or is_null(actual):
+        return is_null(expected) and is_null(actual)
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        return math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=abs_tol)
+    return expected == actual
+
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0073_remove_unused_view'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='measure',
+            name='definition_hash',
+            field=models.CharField(help_text='Hash of the definition from which the measure values were last calculated (see `import_measures --incremental`)', max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,312 @@
+"""Partition frontend_measurevalue by measure, and store cost savings as arrays.
+
+There is a partition for each existing measure, and a default partition for
+values of measures without one (`import_measures` creates a partition for each
+measure it imports).  Every row is copied into the new table, so on production
+this takes a while and the table is locked while it runs.
+
+The single-column indexes on each foreign key are replaced by partial indexes
+matching the filters that `MeasureValueQuerySet.filter_by_org_type` and
+`for_orgs` apply for each type of organisation, ordered by month, and
+including the columns needed to average percentiles by measure.
+"""
+
+from django.db import migrations, models
+import django.db.models.deletion
+import frontend.models
+
+
+# Measures which aren't cost-based have NULL cost savings, which must stay NULL
+# rather than becoming an array (or object) of NULLs
+UNLESS_NULL = "CASE WHEN cost_savings IS NOT NULL THEN {} END"
+
+COST_SAVINGS_ARRAY = UNLESS_NULL.format(
+    "ARRAY[{}]::double precision[]".format(
+        ", ".join(
+            "(cost_savings ->> '{}')::double precision".format(centile)
+            for centile in range(10, 100, 10)
+        )
+    )
+)
+
+COST_SAVINGS_JSON = UNLESS_NULL.format(
+    "jsonb_build_object({})".format(
+        ", ".join(
+            "'{}', cost_savings[{}]".format(centile, ix + 1)
+            for ix, centile in enumerate(range(10, 100, 10))
+        )
+    )
+)
+
+COLUMNS = """
+    id,
+    measure_id,
+    regional_team_id,
+    stp_id,
+    pct_id,
+    pcn_id,
+    practice_id,
+    month,
+    numerator,
+    denominator,
+    calc_value,
+    percentile
+"""
+
+CONSTRAINTS = """
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_measure_id_fk
+  FOREIGN KEY (measure_id) REFERENCES frontend_measure (id)
+  DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_regional_team_id_fk
+  FOREIGN KEY (regional_team_id) REFERENCES frontend_regionalteam (code)
+  DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_stp_id_fk
+  FOREIGN KEY (stp_id) REFERENCES frontend_stp (ons_code)
+  DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_pct_id_fk
+  FOREIGN KEY (pct_id) REFERENCES frontend_pct (code)
+  DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_pcn_id_fk
+  FOREIGN KEY (pcn_id) REFERENCES frontend_pcn (code)
+  DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_practice_id_fk
+  FOREIGN KEY (practice_id) REFERENCES frontend_practice (code)
+  DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_measure_id_pct_id_practice_id_month_uniq
+  UNIQUE (measure_id, pct_id, practice_id, month);
+"""
+
+FORWARD_SQL = """
+ALTER TABLE frontend_measurevalue RENAME TO frontend_measurevalue_unpartitioned;
+
+CREATE TABLE frontend_measurevalue (
+  id integer NOT NULL DEFAULT nextval('frontend_measurevalue_id_seq'),
+  measure_id varchar(40) NOT NULL,
+  regional_team_id varchar(3),
+  stp_id varchar(9),
+  pct_id varchar(3),
+  pcn_id varchar(9),
+  practice_id varchar(6),
+  month date NOT NULL,
+  numerator double precision,
+  denominator double precision,
+  calc_value double precision,
+  percentile double precision,
+  cost_savings double precision[]
+) PARTITION BY LIST (measure_id);
+
+ALTER SEQUENCE frontend_measurevalue_id_seq OWNED BY frontend_measurevalue.id;
+
+CREATE TABLE frontend_measurevalue_default
+  PARTITION OF frontend_measurevalue DEFAULT;
+
+DO $$
+DECLARE
+  measure_id text;
+BEGIN
+  FOR measure_id IN SELECT id FROM frontend_measure LOOP
+    EXECUTE format(
+      'CREATE TABLE %I PARTITION OF frontend_measurevalue FOR VALUES IN (%L)',
+      'frontend_measurevalue_' || measure_id,
+      measure_id
+    );
+  END LOOP;
+END $$;
+
+INSERT INTO frontend_measurevalue ({columns}, cost_savings)
+SELECT {columns}, {cost_savings_array}
+FROM frontend_measurevalue_unpartitioned;
+
+DROP TABLE frontend_measurevalue_unpartitioned;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_pkey PRIMARY KEY (id, measure_id);
+
+{constraints}
+
+CREATE INDEX frontend_measurevalue_practice_idx
+  ON frontend_measurevalue (practice_id, month)
+  INCLUDE (measure_id, percentile)
+  WHERE practice_id IS NOT NULL;
+
+CREATE INDEX frontend_measurevalue_pcn_practices_idx
+  ON frontend_measurevalue (pcn_id, month)
+  INCLUDE (measure_id, percentile)
+  WHERE practice_id IS NOT NULL;
+
+CREATE INDEX frontend_measurevalue_pct_practices_idx
+  ON frontend_measurevalue (pct_id, month)
+  INCLUDE (measure_id, percentile)
+  WHERE practice_id IS NOT NULL;
+
+CREATE INDEX frontend_measurevalue_pcn_idx
+  ON frontend_measurevalue (pcn_id, month)
+  INCLUDE (measure_id, percentile)
+  WHERE practice_id IS NULL;
+
+CREATE INDEX frontend_measurevalue_pct_idx
+  ON frontend_measurevalue (pct_id, month)
+  INCLUDE (measure_id, percentile)
+  WHERE practice_id IS NULL;
+
+CREATE INDEX frontend_measurevalue_stp_idx
+  ON frontend_measurevalue (stp_id, month)
+  INCLUDE (measure_id, pct_id, percentile)
+  WHERE practice_id IS NULL;
+
+CREATE INDEX frontend_measurevalue_regional_team_idx
+  ON frontend_measurevalue (regional_team_id, month)
+  INCLUDE (measure_id, pct_id, percentile)
+  WHERE practice_id IS NULL;
+
+ANALYZE frontend_measurevalue;
+""".format(
+    columns=COLUMNS, cost_savings_array=COST_SAVINGS_ARRAY, constraints=CONSTRAINTS
+)
+
+REVERSE_SQL = """
+ALTER TABLE frontend_measurevalue RENAME TO frontend_measurevalue_partitioned;
+
+CREATE TABLE frontend_measurevalue (
+  id integer NOT NULL DEFAULT nextval('frontend_measurevalue_id_seq'),
+  measure_id varchar(40) NOT NULL,
+  regional_team_id varchar(3),
+  stp_id varchar(9),
+  pct_id varchar(3),
+  pcn_id varchar(9),
+  practice_id varchar(6),
+  month date NOT NULL,
+  numerator double precision,
+  denominator double precision,
+  calc_value double precision,
+  percentile double precision,
+  cost_savings jsonb
+);
+
+ALTER SEQUENCE frontend_measurevalue_id_seq OWNED BY frontend_measurevalue.id;
+
+INSERT INTO frontend_measurevalue ({columns}, cost_savings)
+SELECT {columns}, {cost_savings_json}
+FROM frontend_measurevalue_partitioned;
+
+DROP TABLE frontend_measurevalue_partitioned;
+
+ALTER TABLE frontend_measurevalue
+  ADD CONSTRAINT frontend_measurevalue_pkey PRIMARY KEY (id);
+
+{constraints}
+
+CREATE INDEX frontend_measurevalue_measure_id_idx
+  ON frontend_measurevalue (measure_id);
+CREATE INDEX frontend_measurevalue_regional_team_id_idx
+  ON frontend_measurevalue (regional_team_id);
+CREATE INDEX frontend_measurevalue_stp_id_idx
+  ON frontend_measurevalue (stp_id);
+CREATE INDEX frontend_measurevalue_pct_id_idx
+  ON frontend_measurevalue (pct_id);
+CREATE INDEX frontend_measurevalue_pcn_id_idx
+  ON frontend_measurevalue (pcn_id);
+CREATE INDEX frontend_measurevalue_practice_id_idx
+  ON frontend_measurevalue (practice_id);
+""".format(
+    columns=COLUMNS, cost_savings_json=COST_SAVINGS_JSON, constraints=CONSTRAINTS
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("frontend", "0074_measure_definition_hash"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(FORWARD_SQL, reverse_sql=REVERSE_SQL)
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name="measurevalue",
+                    name="cost_savings",
+                    field=frontend.models.CentileArrayField(blank=True, null=True),
+                ),
+                migrations.AlterField(
+                    model_name="measurevalue",
+                    name="measure",
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="frontend.Measure",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="measurevalue",
+                    name="pcn",
+                    field=models.ForeignKey(
+                        blank=True,
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="frontend.PCN",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="measurevalue",
+                    name="pct",
+                    field=models.ForeignKey(
+                        blank=True,
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="frontend.PCT",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="measurevalue",
+                    name="practice",
+                    field=models.ForeignKey(
+                        blank=True,
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="frontend.Practice",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="measurevalue",
+                    name="regional_team",
+                    field=models.ForeignKey(
+                        blank=True,
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="frontend.RegionalTeam",
+                    ),
+                ),
+                migrations.AlterField(
+                    model_name="measurevalue",
+                    name="stp",
+                    field=models.ForeignKey(
+                        blank=True,
+                        db_index=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="frontend.STP",
+                    ),
+                ),
+            ],
+        )
+    ]
@@ -20,7 +20,7 @@ from dmd.models import (
     AvailabilityRestriction,
     VirtualProductPresStatus,
 )
-from frontend.managers import MeasureValueQuerySet
+from frontend.managers import CENTILES, MeasureValueQuerySet
 from frontend.validators import isAlphaNumeric
 from frontend import model_prescribing_units
 
@@ -663,10 +663,58 @@ class Measure(models.Model):
     denominator_bnf_codes_query = models.CharField(max_length=10000, null=True)
     denominator_bnf_codes = ArrayField(models.CharField(max_length=15), null=True)
 
+    definition_hash = models.CharField(
+        max_length=64,
+        null=True,
+        help_text=(
+            "Hash of the definition from which the measure values were last "
+            "calculated (see `import_measures --incremental`)"
+        ),
+    )
+
     def __str__(self):
         return self.name
 
 
+class CentileArrayField(ArrayField):
+    """Stores a dict of values keyed by centile ("10", "20", ..., "90") as a
+    fixed-length array of floats, which takes much less space than JSON.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["base_field"] = models.FloatField()
+        kwargs["size"] = len(CENTILES)
+        super(CentileArrayField, self).__init__(**kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CentileArrayField, self).deconstruct()
+        del kwargs["base_field"]
+        del kwargs["size"]
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return dict(zip(CENTILES, value))
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            value = json.loads(value)
+        if isinstance(value, list):
+            value = dict(zip(CENTILES, value))
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, dict):
+            value = [value.get(centile) for centile in CENTILES]
+        return super(CentileArrayField, self).get_db_prep_value(
+            value, connection, prepared
+        )
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj))
+
+
 class MeasureValue(models.Model):
     """
     An instance of a measure for a particular organisation,
@@ -674,20 +722,32 @@ class MeasureValue(models.Model):
     If it's a measure for a CCG, the practice field will be null.
     Otherwise, it's a measure for a practice, and the pct field
     indicates the parent CCG, if it exists.
+
+    The table is partitioned by measure, with a partition for each measure
+    created by `import_measures` and a default partition for any others.  In
+    place of the usual index on each foreign key there are partial indexes
+    matching the ways that `MeasureValueQuerySet` looks up the values for each
+    type of organisation.  See migration 0075 for details.
     """
 
     # We use ON DELETE CASCADE rather than PROTECT on this model simply because
     # that was the previous default and the table is large enough that running
     # the migration will take careful planning at some later stage
-    measure = models.ForeignKey(Measure, on_delete=models.CASCADE)
+    measure = models.ForeignKey(Measure, on_delete=models.CASCADE, db_index=False)
     regional_team = models.ForeignKey(
-        RegionalTeam, null=True, blank=True, on_delete=models.CASCADE
+        RegionalTeam, null=True, blank=True, on_delete=models.CASCADE, db_index=False
+    )
+    stp = models.ForeignKey(
+        STP, null=True, blank=True, on_delete=models.CASCADE, db_index=False
+    )
+    pct = models.ForeignKey(
+        PCT, null=True, blank=True, on_delete=models.CASCADE, db_index=False
+    )
+    pcn = models.ForeignKey(
+        PCN, null=True, blank=True, on_delete=models.CASCADE, db_index=False
     )
-    stp = models.ForeignKey(STP, null=True, blank=True, on_delete=models.CASCADE)
-    pct = models.ForeignKey(PCT, null=True, blank=True, on_delete=models.CASCADE)
-    pcn = models.ForeignKey(PCN, null=True, blank=True, on_delete=models.CASCADE)
     practice = models.ForeignKey(
-        Practice, null=True, blank=True, on_delete=models.CASCADE
+        Practice, null=True, blank=True, on_delete=models.CASCADE, db_index=False
     )
     month = models.DateField()
 
@@ -699,7 +759,7 @@ class MeasureValue(models.Model):
 
     # Cost savings if organisation had prescribed at set levels.
     # Only used with cost-based measures.
-    cost_savings = JSONField(null=True, blank=True)
+    cost_savings = CentileArrayField(null=True, blank=True)
 
     class Meta:
         unique_together = (("measure", "pct", "practice", "month"),)
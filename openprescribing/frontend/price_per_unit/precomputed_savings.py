@@ -0,0 +1,325 @@
+"""
+Price-per-unit savings for the latest month, precomputed for every practice,
+every CCG and for All England (see the `precompute_ppu_savings` command which
+runs as part of the monthly import)
+
+Calculating these on demand means working through every substitution set which
+is slow enough that the first visitors after each data load would otherwise be
+left waiting. We write the results to a small SQLite file alongside the
+MatrixStore file they were calculated from so that they go live (and are
+retired) along with that file.
+
+The savings also depend on the org relationships and substitution sets
+defined in the database, so we record the `cache_key`s of these (plus the
+relevant configuration) and only use the precomputed values if everything
+still matches. Otherwise we just fall back to calculating savings on demand.
+"""
+import os
+import sqlite3
+import urllib.parse
+
+from matrixstore.build.common import get_temp_filename
+from matrixstore.connection import MatrixStore
+from matrixstore.db import (
+    build_row_grouper,
+    close_with_generation,
+    get_db_path,
+    get_row_grouper,
+    memoize,
+)
+
+from . import savings
+from .substitution_sets import (
+    FORMULATION_SWAPS_FILE,
+    get_substitution_sets,
+    get_substitution_sets_from_bnf_codes,
+)
+
+
+# Org types for which we precompute savings
+ORG_TYPES = ["practice", "ccg", "all_standard_practices"]
+
+SCHEMA_SQL = """
+    CREATE TABLE metadata (
+        key TEXT,
+        value TEXT,
+
+        PRIMARY KEY (key)
+    );
+
+    CREATE TABLE ppu_saving (
+        org_type TEXT,
+        -- NULL for the "all_standard_practices" org type
+        org_id TEXT,
+        -- Position of this saving when all savings for the org type are sorted
+        -- by size, which lets us return them in the same order as
+        -- `savings.get_all_savings_for_orgs`
+        position INTEGER,
+        substitution_set_id TEXT,
+        name TEXT,
+        formulation_swap TEXT,
+        price_per_unit REAL,
+        possible_savings REAL,
+        quantity REAL,
+        lowest_decile REAL
+    );
+
+    CREATE INDEX ppu_saving_org ON ppu_saving (org_type, org_id);
+"""
+
+# Beyond this many orgs we fetch every saving for the org type and filter them
+# ourselves, rather than run into SQLite's limit on query parameters
+MAX_ORG_IDS_PER_QUERY = 500
+
+
+def get_all_savings_for_orgs(date, org_type, org_ids):
+    """
+    As `savings.get_all_savings_for_orgs` but using precomputed savings where
+    they're available
+    """
+    precomputed = get_precomputed_savings()
+    if precomputed is not None and precomputed.is_valid_for(date, org_type):
+        return precomputed.get_all_savings_for_orgs(date, org_type, org_ids)
+    return savings.get_all_savings_for_orgs(date, org_type, org_ids)
+
+
+def get_total_savings_for_org(date, org_type, org_id):
+    """
+    As `savings.get_total_savings_for_org` but using precomputed savings where
+    they're available
+    """
+    precomputed = get_precomputed_savings()
+    if precomputed is not None and precomputed.is_valid_for(date, org_type):
+        return precomputed.get_total_savings_for_org(org_type, org_id)
+    return savings.get_total_savings_for_org(date, org_type, org_id)
+
+
+def get_precomputed_savings_path(matrixstore_path):
+    """
+    Return the path of the file holding savings precomputed from the supplied
+    MatrixStore file
+
+    We use a subdirectory so that these files never get mistaken for
+    MatrixStore files by `matrixstore_set_live`.
+    """
+    directory, basename = os.path.split(os.path.realpath(matrixstore_path))
+    return os.path.join(directory, "ppu_savings", basename)
+
+
+def get_precomputed_savings():
+    """
+    Return the precomputed savings for the live MatrixStore file, or None if
+    they haven't been computed
+    """
+    path = get_precomputed_savings_path(get_db_path())
+    # Savings are computed after their MatrixStore file goes live so we need to
+    # keep checking for the file until it appears, rather than memoizing its
+    # absence
+    if not os.path.exists(path):
+        return None
+    return _open_precomputed_savings(path)
+
+
+@memoize
+def _open_precomputed_savings(path):
+    return close_with_generation(PrecomputedSavings.from_file(path))
+
+
+class PrecomputedSavings(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.metadata = dict(connection.execute("SELECT key, value FROM metadata"))
+
+    @classmethod
+    def from_file(cls, path):
+        encoded_path = urllib.parse.quote(os.path.abspath(path))
+        connection = sqlite3.connect(
+            "file://{}?immutable=1&mode=ro".format(encoded_path),
+            uri=True,
+            check_same_thread=False,
+        )
+        return cls(connection)
+
+    def close(self):
+        self.connection.close()
+
+    def is_valid_for(self, date, org_type):
+        """
+        Return whether we have savings for `date` and `org_type` which match
+        the current org relationships, substitution sets and configuration
+        """
+        if org_type not in ORG_TYPES or self.metadata["date"] != date:
+            return False
+        row_groupers = {
+            org_type: get_row_grouper(org_type),
+            savings.CONFIG_TARGET_PEER_GROUP: get_row_grouper(
+                savings.CONFIG_TARGET_PEER_GROUP
+            ),
+        }
+        expected = get_metadata(date, get_substitution_sets(), row_groupers)
+        return all(self.metadata.get(key) == value for key, value in expected.items())
+
+    def get_all_savings_for_orgs(self, date, org_type, org_ids):
+        org_ids = list(org_ids)
+        if len(org_ids) > MAX_ORG_IDS_PER_QUERY:
+            where = "org_type = ?"
+            params = [org_type]
+        else:
+            where = "org_type = ? AND ({})".format(
+                " OR ".join(["org_id IS ?"] * len(org_ids)) or "0"
+            )
+            params = [org_type] + org_ids
+        results = self.connection.execute(
+            """
+            SELECT
+              org_id,
+              substitution_set_id,
+              name,
+              formulation_swap,
+              price_per_unit,
+              possible_savings,
+              quantity,
+              lowest_decile
+            FROM ppu_saving
+            WHERE {}
+            ORDER BY position
+            """.format(
+                where
+            ),
+            params,
+        )
+        wanted_org_ids = set(org_ids)
+        return [
+            {
+                "date": date,
+                "org_id": row[0],
+                "price_per_unit": row[4],
+                "possible_savings": row[5],
+                "quantity": row[6],
+                "lowest_decile": row[7],
+                "presentation": row[1],
+                "formulation_swap": row[3],
+                "name": row[2],
+            }
+            for row in results
+            if row[0] in wanted_org_ids
+        ]
+
+    def get_total_savings_for_org(self, org_type, org_id):
+        # We store every saving which counts towards the total so we can just
+        # add them up
+        results = self.connection.execute(
+            """
+            SELECT SUM(possible_savings) FROM ppu_saving
+            WHERE org_type = ? AND org_id IS ?
+            """,
+            [org_type, org_id],
+        )
+        return results.fetchone()[0] or 0.0
+
+
+def precompute_savings(matrixstore_path):
+    """
+    Calculate savings for the latest month in the supplied MatrixStore file
+    and write them to the file given by `get_precomputed_savings_path`
+
+    Returns the path of the new file.
+    """
+    db = MatrixStore.from_file(matrixstore_path)
+    bnf_codes = [row[0] for row in db.query("SELECT bnf_code FROM presentation")]
+    substitution_sets = get_substitution_sets_from_bnf_codes(
+        bnf_codes, FORMULATION_SWAPS_FILE
+    )
+    row_groupers = {
+        org_type: build_row_grouper(org_type, db.practice_offsets)
+        for org_type in ORG_TYPES + [savings.CONFIG_TARGET_PEER_GROUP]
+    }
+    path = get_precomputed_savings_path(matrixstore_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = get_temp_filename(path)
+    write_savings(temp_path, db, db.dates[-1], substitution_sets, row_groupers)
+    db.close()
+    os.rename(temp_path, path)
+    return path
+
+
+def write_savings(path, db, date, substitution_sets, row_groupers):
+    """
+    Write savings to a new SQLite file at `path` for every org of each type in
+    ORG_TYPES
+
+    `row_groupers` must contain a row grouper for each of these types, plus one
+    for CONFIG_TARGET_PEER_GROUP.
+    """
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA_SQL)
+    for org_type in ORG_TYPES:
+        group_by_org = row_groupers[org_type]
+        results = savings.calculate_all_savings_for_orgs(
+            db=db,
+            substitution_sets=substitution_sets,
+            date=date,
+            group_by_org=group_by_org,
+            org_ids=group_by_org.ids,
+            min_saving=savings.CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
+            practice_group_by_org=row_groupers[savings.CONFIG_TARGET_PEER_GROUP],
+            target_centile=savings.CONFIG_TARGET_CENTILE,
+        )
+        connection.executemany(
+            """
+            INSERT INTO ppu_saving (
+              org_type,
+              org_id,
+              position,
+              substitution_set_id,
+              name,
+              formulation_swap,
+              price_per_unit,
+              possible_savings,
+              quantity,
+              lowest_decile
+            )
+            VALUES
+              (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                (
+                    org_type,
+                    result["org_id"],
+                    position,
+                    result["presentation"],
+                    result["name"],
+                    result["formulation_swap"],
+                    float(result["price_per_unit"]),
+                    float(result["possible_savings"]),
+                    float(result["quantity"]),
+                    float(result["lowest_decile"]),
+                )
+                for position, result in enumerate(results)
+            ),
+        )
+    metadata = get_metadata(date, substitution_sets, row_groupers)
+    connection.executemany(
+        "INSERT INTO metadata (key, value) VALUES (?, ?)", metadata.items()
+    )
+    connection.commit()
+    connection.close()
+
+
+def get_metadata(date, substitution_sets, row_groupers):
+    """
+    Return a dict describing everything, besides the MatrixStore file itself,
+    which determines the savings for the org types in `row_groupers`
+    """
+    metadata = {
+        "date": date,
+        "substitution_sets": substitution_sets.cache_key.hex(),
+        "target_centile": str(savings.CONFIG_TARGET_CENTILE),
+    }
+    for org_type, row_grouper in row_groupers.items():
+        metadata["row_grouper:" + org_type] = row_grouper.cache_key.hex()
+        if org_type in savings.CONFIG_MIN_SAVINGS_FOR_ORG_TYPE:
+            metadata["min_saving:" + org_type] = str(
+                savings.CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type]
+            )
+    return metadata
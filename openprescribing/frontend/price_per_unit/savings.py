@@ -1,8 +1,8 @@
 import numpy
+import scipy.sparse
 
 from matrixstore.cachelib import memoize
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix, zeros_like
 from matrixstore.sql_functions import MatrixSum
 
 from .substitution_sets import get_substitution_sets
@@ -27,18 +27,83 @@ CONFIG_MIN_SAVINGS_FOR_ORG_TYPE = {
     "all_standard_practices": 50000 * 100,
 }
 
+# When calculating savings over all substitution sets we handle this many sets
+# at a time. Each block requires a few dense matrices of shape (number of
+# practices, block size) so this puts a bound on memory usage while still
+# letting us do the work in a small number of large numpy operations.
+SUBSTITUTION_SET_BLOCK_SIZE = 250
+
+# Maximum number of BNF codes to fetch in a single query, which keeps us well
+# within SQLite's limit on the number of query parameters
+MAX_CODES_PER_QUERY = 500
+
 
 def get_all_savings_for_orgs(date, org_type, org_ids):
     """
     Get all available savings through presentation switches for the given orgs
     """
-    min_saving = CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type]
+    return calculate_all_savings_for_orgs(
+        db=get_db(),
+        substitution_sets=get_substitution_sets(),
+        date=date,
+        group_by_org=get_row_grouper(org_type),
+        org_ids=org_ids,
+        min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
+        practice_group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
+        target_centile=CONFIG_TARGET_CENTILE,
+    )
+
+
+def calculate_all_savings_for_orgs(
+    db,
+    substitution_sets,
+    date,
+    group_by_org,
+    org_ids,
+    min_saving,
+    practice_group_by_org,
+    target_centile,
+):
+    """
+    Return a list of all savings of at least `min_saving` for the given orgs,
+    sorted by size of saving
+
+    Like `get_total_savings_for_org_type` this has everything passed in so that
+    it can be used with MatrixStore files other than the live one (see
+    `precomputed_savings`).
+    """
     results = []
-    for generic_code in get_substitution_sets().keys():
-        savings = get_savings_for_orgs(
-            generic_code, date, org_type, org_ids, min_saving=min_saving
-        )
-        results.extend(savings)
+    blocks = get_savings_for_all_substitution_sets(
+        db=db,
+        substitution_sets=substitution_sets,
+        date=date,
+        group_by_org=group_by_org,
+        org_ids=org_ids,
+        practice_group_by_org=practice_group_by_org,
+        target_centile=target_centile,
+    )
+    for substitution_sets, quantities, net_costs, savings, target_ppus in blocks:
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ppus = net_costs / quantities
+            above_threshold = savings >= min_saving
+        # Transposing means we get results ordered by substitution set and then
+        # by org, which gives a consistent ordering for equal savings
+        set_offsets, org_offsets = numpy.nonzero(above_threshold.T)
+        for set_offset, org_offset in zip(set_offsets, org_offsets):
+            substitution_set = substitution_sets[set_offset]
+            results.append(
+                {
+                    "date": date,
+                    "org_id": org_ids[org_offset],
+                    "price_per_unit": ppus[org_offset, set_offset] / 100,
+                    "possible_savings": savings[org_offset, set_offset] / 100,
+                    "quantity": quantities[org_offset, set_offset],
+                    "lowest_decile": target_ppus[set_offset] / 100,
+                    "presentation": substitution_set.id,
+                    "formulation_swap": substitution_set.formulation_swaps,
+                    "name": substitution_set.name,
+                }
+            )
     results.sort(key=lambda i: i["possible_savings"], reverse=True)
     return results
 
@@ -60,11 +125,12 @@ def get_savings_for_orgs(generic_code, date, org_type, org_ids, min_saving=1):
     )
 
     group_by_org = get_row_grouper(org_type)
-    quantities_for_orgs = group_by_org.sum(quantities, org_ids)
+    quantities_for_orgs, net_costs_for_orgs = group_by_org.sum_many(
+        [quantities, net_costs], org_ids
+    )
     # Bail early if none of the orgs have any relevant prescribing
     if not numpy.any(quantities_for_orgs):
         return []
-    net_costs_for_orgs = group_by_org.sum(net_costs, org_ids)
     ppu_for_orgs = net_costs_for_orgs / quantities_for_orgs
 
     target_ppu = get_target_ppu(
@@ -101,29 +167,35 @@ def get_total_savings_for_org(date, org_type, org_id):
     """
     Get total available savings through presentation switches for the given org
     """
-    group_by_org = get_row_grouper(org_type)
-    substitution_sets = get_substitution_sets()
     # This only happens during testing where a test case might not have enough
     # different presentations to generate any substitutions. If this is the
     # case then their are, obviously, zero savings available.
-    if not substitution_sets:
+    if not get_substitution_sets():
         return 0.0
-    totals = get_total_savings_for_org_type(
+    totals = get_total_savings_for_all_orgs(date, org_type)
+    offset = get_row_grouper(org_type).offsets[org_id]
+    return totals[offset, 0] / 100
+
+
+def get_total_savings_for_all_orgs(date, org_type):
+    """
+    Return a matrix giving total savings for every org of the given type,
+    calculated from the live MatrixStore using the current configuration
+    """
+    return get_total_savings_for_org_type(
         db=get_db(),
-        substitution_sets=substitution_sets,
+        substitution_sets=get_substitution_sets(),
         date=date,
-        group_by_org=group_by_org,
+        group_by_org=get_row_grouper(org_type),
         min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
         practice_group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
         target_centile=CONFIG_TARGET_CENTILE,
     )
-    offset = group_by_org.offsets[org_id]
-    return totals[offset, 0] / 100
 
 
 # Increment the version number if the logic of this function changes such that
 # the same inputs no longer produce the same outputs
-@memoize(version=1)
+@memoize(version=2)
 def get_total_savings_for_org_type(
     db,
     substitution_sets,
@@ -136,34 +208,74 @@ def get_total_savings_for_org_type(
     """
     Return a matrix giving total savings for all orgs of a given type
 
-    This duplicates some of the logic in `get_savings_for_orgs` but it gives us
-    much better caching behaviour to calculate savings for all orgs of a given
-    type together in a single, cacheable matrix than it does to do them one by
-    one.
+    It gives us much better caching behaviour to calculate savings for all
+    orgs of a given type together in a single, cacheable matrix than it does
+    to do them one by one.
 
     Because we want this function to be cacheable it needs to touch no global
     state or configuration and have eveything passed into it, hence the
     slightly convoluted call signature.
     """
-    totals = None
-    for substitution_set in substitution_sets.values():
-        quantities, net_costs = get_quantities_and_net_costs_at_date(
-            db, substitution_set, date
+    totals = numpy.zeros((len(group_by_org.ids), 1))
+    blocks = get_savings_for_all_substitution_sets(
+        db=db,
+        substitution_sets=substitution_sets,
+        date=date,
+        group_by_org=group_by_org,
+        org_ids=None,
+        practice_group_by_org=practice_group_by_org,
+        target_centile=target_centile,
+    )
+    for _, _, _, savings_for_orgs, _ in blocks:
+        with numpy.errstate(invalid="ignore"):
+            savings_above_threshold = savings_for_orgs >= min_saving
+        totals += numpy.sum(
+            savings_for_orgs, axis=1, keepdims=True, where=savings_above_threshold
         )
-        target_ppu = get_target_ppu(
+    return totals
+
+
+def get_savings_for_all_substitution_sets(
+    db,
+    substitution_sets,
+    date,
+    group_by_org,
+    org_ids,
+    practice_group_by_org,
+    target_centile,
+):
+    """
+    Calculate savings for every substitution set, yielding tuples of the form:
+
+        substitution_sets, quantities, net_costs, savings, target_ppus
+
+    for successive blocks of substitution sets, where `quantities`, `net_costs`
+    and `savings` are matrices of shape (number of orgs, number of sets in
+    block) grouped according to `group_by_org` and `org_ids` (as in
+    `RowGrouper.sum`) and `target_ppus` gives the target for each set
+
+    The results are the same as calling `get_quantities_and_net_costs_at_date`,
+    `get_target_ppu` and `get_savings` for each set in turn, but because
+    `get_target_ppu` and `get_savings` work column-wise we can handle a whole
+    block of sets with the same few numpy operations.
+    """
+    substitution_sets = list(substitution_sets.values())
+    for start in range(0, len(substitution_sets), SUBSTITUTION_SET_BLOCK_SIZE):
+        block = substitution_sets[start : start + SUBSTITUTION_SET_BLOCK_SIZE]
+        quantities, net_costs = get_quantities_and_net_costs_for_sets_at_date(
+            db, block, date
+        )
+        target_ppus = get_target_ppu(
             quantities,
             net_costs,
             group_by_org=practice_group_by_org,
             target_centile=target_centile,
         )
-        practice_savings = get_savings(quantities, net_costs, target_ppu)
-        savings_for_orgs = group_by_org.sum(practice_savings)
-        savings_above_threshold = savings_for_orgs >= min_saving
-        if totals is None:
-            totals = zeros_like(savings_for_orgs)
-        numpy.add(totals, savings_for_orgs, out=totals, where=savings_above_threshold)
-    assert totals is not None
-    return totals
+        practice_savings = get_savings(quantities, net_costs, target_ppus)
+        quantities, net_costs, savings = group_by_org.sum_many(
+            [quantities, net_costs, practice_savings], org_ids
+        )
+        yield block, quantities, net_costs, savings, target_ppus
 
 
 def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
@@ -171,9 +283,10 @@ def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
     Calculate the price-per-unit achieved by the organisation (as defined by
     `group_by_org`) at the target centile
     """
-    quantities = group_by_org.sum(quantities)
-    net_costs = group_by_org.sum(net_costs)
-    ppu = net_costs / quantities
+    quantities, net_costs = group_by_org.sum_many([quantities, net_costs])
+    # Orgs with no prescribing get a PPU of NaN which `nanpercentile` ignores
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ppu = net_costs / quantities
     target_ppu = numpy.nanpercentile(ppu, axis=0, q=target_centile)
     return target_ppu
 
@@ -191,6 +304,55 @@ def get_savings(quantities, net_costs, target_ppu):
     return savings
 
 
+def get_quantities_and_net_costs_for_sets_at_date(db, substitution_sets, date):
+    """
+    Return quantity and net cost matrices of shape (number of practices, number
+    of substitution sets) giving the totals over each set's presentations for
+    just the specified date
+
+    We fetch a single-month column for every presentation involved and then
+    sum them into their sets with one sparse matrix product.
+    """
+    bnf_codes = sorted(
+        {
+            bnf_code
+            for substitution_set in substitution_sets
+            for bnf_code in substitution_set.presentations
+        }
+    )
+    code_offsets = {bnf_code: offset for offset, bnf_code in enumerate(bnf_codes)}
+    code_offsets_in_sets = []
+    set_offsets = []
+    for set_offset, substitution_set in enumerate(substitution_sets):
+        for bnf_code in substitution_set.presentations:
+            code_offsets_in_sets.append(code_offsets[bnf_code])
+            set_offsets.append(set_offset)
+    # Maps each presentation to the sets which contain it
+    membership = scipy.sparse.csr_matrix(
+        (numpy.ones(len(set_offsets)), (code_offsets_in_sets, set_offsets)),
+        shape=(len(bnf_codes), len(substitution_sets)),
+    )
+    found_offsets = []
+    quantity_columns = []
+    net_cost_columns = []
+    for start in range(0, len(bnf_codes), MAX_CODES_PER_QUERY):
+        results = db.query_presentations_at_date(
+            bnf_codes[start : start + MAX_CODES_PER_QUERY], date
+        )
+        for bnf_code, quantity, net_cost in results:
+            found_offsets.append(code_offsets[bnf_code])
+            quantity_columns.append(scipy.sparse.csc_matrix(quantity))
+            net_cost_columns.append(scipy.sparse.csc_matrix(net_cost))
+    if not found_offsets:
+        shape = (len(db.practices), len(substitution_sets))
+        return numpy.zeros(shape), numpy.zeros(shape)
+    # Presentations which aren't in the MatrixStore just get dropped
+    membership = membership[found_offsets]
+    quantities = scipy.sparse.hstack(quantity_columns, format="csc") @ membership
+    net_costs = scipy.sparse.hstack(net_cost_columns, format="csc") @ membership
+    return quantities.toarray(), net_costs.toarray()
+
+
 # Increment the version number if the logic of this function changes such that
 # the same inputs no longer produce the same outputs
 @memoize(version=1)
@@ -200,26 +362,10 @@ def get_quantities_and_net_costs_at_date(db, substitution_set, date):
     the specified date.
     """
     bnf_codes = substitution_set.presentations
-    date_column = db.date_offsets[date]
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
-        """
-        SELECT
-          quantity, net_cost
-        FROM
-          presentation
-        WHERE
-          bnf_code IN ({})
-        """.format(
-            ",".join("?" * len(bnf_codes))
-        ),
-        bnf_codes,
-    )
-
+    results = db.query_presentations_at_date(bnf_codes, date)
     quantity_sum = MatrixSum()
     net_cost_sum = MatrixSum()
-    for quantity, net_cost in results:
-        quantity_sum.add(get_submatrix(quantity, cols=date_slice))
-        net_cost_sum.add(get_submatrix(net_cost, cols=date_slice))
+    for _, quantity, net_cost in results:
+        quantity_sum.add(quantity)
+        net_cost_sum.add(net_cost)
     return quantity_sum.value(), net_cost_sum.value()
@@ -20,9 +20,7 @@ import hashlib
 import os.path
 import re
 
-from functools import lru_cache
-
-from matrixstore.db import get_db
+from matrixstore.db import get_db, memoize
 from frontend.models import Presentation
 
 
@@ -71,12 +69,6 @@ class DictWithCacheID(dict):
         return instance
 
 
-# Create a memoize decorator (i.e. a decorator which caches the return value
-# for a given set of arguments). Here `maxsize=None` means "don't apply any
-# cache eviction, just keep values for ever"
-memoize = lru_cache(maxsize=None)
-
-
 # The below file defines groups of generics of different formulations which we
 # believe can be substituted for each other (e.g tramadol tablets and
 # capsules). The canonical version is maintained as a Google Sheet. The process
@@ -6,7 +6,8 @@ import json
 import os
 import re
 import tempfile
-from mock import patch
+import threading
+from mock import Mock, patch
 from random import Random
 from urllib.parse import parse_qs
 
@@ -17,7 +18,8 @@ import pandas as pd
 
 from django.conf import settings
 from django.core.management import call_command
-from django.test import TestCase, override_settings
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
 
 from frontend import bq_schemas as schemas
 from frontend.models import (
@@ -34,6 +36,9 @@ from frontend.models import (
 from frontend.management.commands.import_measures import (
     load_measure_defs,
     build_bnf_codes_query,
+    CSVStream,
+    MeasureCalculation,
+    run_jobs,
 )
 from gcutils.bigquery import Client
 from matrixstore.tests.contextmanagers import (
@@ -63,6 +68,9 @@ class ImportMeasuresTests(TestCase):
         cls.prescriptions = upload_prescribing(random.randint)
         cls.practice_stats = upload_practice_statistics(random.randint)
         cls.factory = build_factory()
+        cls.uploaded_data_factory = build_factory_from_uploaded_data(
+            cls.prescriptions, cls.practice_stats
+        )
         create_old_measure_value()
 
     def test_cost_based_percentage_measure(self):
@@ -80,6 +88,16 @@ class ImportMeasuresTests(TestCase):
         self.assertFalse(MeasureValue.objects.filter(month__lt="2011-01-01").exists())
         self.assertFalse(MeasureGlobal.objects.filter(month__lt="2011-01-01").exists())
 
+        # Check that the MeasureValues have been stored in the measure's own
+        # partition.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT tableoid::regclass::text FROM frontend_measurevalue"
+            )
+            self.assertEqual(
+                cursor.fetchall(), [("frontend_measurevalue_desogestrel",)]
+            )
+
         # Check that numerator_bnf_codes and denominator_bnf_codes have been set.
         m = Measure.objects.get(id="desogestrel")
         self.assertEqual(m.numerator_bnf_codes, ["0703021Q0BBAAAA"])
@@ -180,6 +198,140 @@ class ImportMeasuresTests(TestCase):
             month,
         )
 
+    def test_cost_based_percentage_measure_in_parallel(self):
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            call_command("import_measures", measure="desogestrel", parallel=4)
+
+        month = "2018-08-01"
+        prescriptions = self.prescriptions[self.prescriptions["month"] == month]
+        numerators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0B")
+        ]
+        denominators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0")
+        ]
+        self.validate_calculations(
+            self.calculate_cost_based_percentage_measure,
+            numerators,
+            denominators,
+            month,
+        )
+
+    def test_incremental_update(self):
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            call_command("import_measures", measure="desogestrel")
+
+        # Pretend that August's data has only just been imported, and mark
+        # July's values so that we can tell whether they get recalculated
+        MeasureValue.objects.filter(month="2018-08-01").delete()
+        MeasureGlobal.objects.filter(month="2018-08-01").delete()
+        MeasureValue.objects.filter(month="2018-07-01").update(numerator=-1)
+
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            call_command("import_measures", measure="desogestrel", incremental=True)
+
+        self.assertFalse(
+            MeasureValue.objects.filter(month="2018-07-01")
+            .exclude(numerator=-1)
+            .exists()
+        )
+        month = "2018-08-01"
+        prescriptions = self.prescriptions[self.prescriptions["month"] == month]
+        numerators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0B")
+        ]
+        denominators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0")
+        ]
+        self.validate_calculations(
+            self.calculate_cost_based_percentage_measure,
+            numerators,
+            denominators,
+            month,
+        )
+
+        # A change to the definition means every month is recalculated
+        Measure.objects.filter(id="desogestrel").update(definition_hash="stale")
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            call_command("import_measures", measure="desogestrel", incremental=True)
+
+        self.assertFalse(MeasureValue.objects.filter(numerator=-1).exists())
+        self.assertTrue(MeasureValue.objects.filter(month="2018-07-01").exists())
+        self.assertNotEqual(
+            Measure.objects.get(id="desogestrel").definition_hash, "stale"
+        )
+
+    def test_cost_based_percentage_measure_with_matrixstore_engine(self):
+        with patched_global_matrixstore_from_data_factory(self.uploaded_data_factory):
+            call_command("import_measures", measure="desogestrel", engine="matrixstore")
+
+        month = "2018-08-01"
+        prescriptions = self.prescriptions[self.prescriptions["month"] == month]
+        numerators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0B")
+        ]
+        denominators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0")
+        ]
+        self.validate_calculations(
+            self.calculate_cost_based_percentage_measure,
+            numerators,
+            denominators,
+            month,
+        )
+
+    def test_cost_based_practice_statistics_measure_with_matrixstore_engine(self):
+        with patched_global_matrixstore_from_data_factory(self.uploaded_data_factory):
+            call_command("import_measures", measure="glutenfree", engine="matrixstore")
+
+        month = "2018-08-01"
+        prescriptions = self.prescriptions[self.prescriptions["month"] == month]
+        numerators = prescriptions[prescriptions["bnf_code"] == "0904010AUBBAAAA"]
+        denominators = self.practice_stats[self.practice_stats["month"] == month]
+        self.validate_calculations(
+            self.calculate_cost_based_practice_statistics_measure,
+            numerators,
+            denominators,
+            month,
+        )
+
+    def test_matrixstore_engine_starts_from_first_matrixstore_month(self):
+        # The MatrixStore starts at 2018-07, so values for earlier months should
+        # be deleted rather than left for some measures and not others
+        m = Measure.objects.get(id="desogestrel")
+        m.measurevalue_set.create(month="2018-06-01")
+        m.measureglobal_set.create(month="2018-06-01")
+
+        with patched_global_matrixstore_from_data_factory(self.uploaded_data_factory):
+            call_command("import_measures", measure="desogestrel", engine="matrixstore")
+
+        self.assertFalse(MeasureValue.objects.filter(month__lt="2018-07-01").exists())
+        self.assertFalse(MeasureGlobal.objects.filter(month__lt="2018-07-01").exists())
+        self.assertTrue(MeasureValue.objects.filter(month="2018-07-01").exists())
+
+    def test_matrixstore_engine_falls_back_to_bigquery_when_out_of_date(self):
+        # This MatrixStore doesn't include the latest month of prescribing
+        factory = DataFactory()
+        factory.create_all(start_date="2018-06-01", num_months=2)
+
+        with patched_global_matrixstore_from_data_factory(factory):
+            call_command("import_measures", measure="desogestrel", engine="matrixstore")
+
+        month = "2018-08-01"
+        prescriptions = self.prescriptions[self.prescriptions["month"] == month]
+        numerators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0B")
+        ]
+        denominators = prescriptions[
+            prescriptions["bnf_code"].str.startswith("0703021Q0")
+        ]
+        self.validate_calculations(
+            self.calculate_cost_based_percentage_measure,
+            numerators,
+            denominators,
+            month,
+        )
+
     def calculate_cost_based_percentage_measure(
         self, numerators, denominators, org_type, org_codes
     ):
@@ -576,6 +728,90 @@ class LowPriorityOmnibusTest(TestCase):
         ]
 
 
+class RunJobsTests(SimpleTestCase):
+    def test_jobs_wait_for_dependencies(self):
+        finished = []
+        lock = threading.Lock()
+
+        def job(name):
+            def func():
+                with lock:
+                    finished.append(name)
+
+            return func
+
+        jobs = {
+            "c": (job("c"), ["a", "b"]),
+            "a": (job("a"), []),
+            "b": (job("b"), ["a"]),
+            "d": (job("d"), []),
+        }
+        yielded = list(run_jobs(jobs, 4))
+        self.assertEqual(sorted(yielded), ["a", "b", "c", "d"])
+        self.assertLess(finished.index("a"), finished.index("b"))
+        self.assertLess(finished.index("b"), finished.index("c"))
+
+    def test_error_stops_dependent_jobs(self):
+        def fail():
+            raise ValueError("failed")
+
+        dependent = Mock()
+        jobs = {"a": (fail, []), "b": (dependent, ["a"])}
+        with self.assertRaises(ValueError):
+            list(run_jobs(jobs, 2))
+        dependent.assert_not_called()
+
+    def test_unmet_dependencies(self):
+        with self.assertRaises(ValueError):
+            list(run_jobs({"a": (Mock(), ["missing"])}, 2))
+
+
+class BigQueryJobsTests(SimpleTestCase):
+    def test_jobs_run_same_queries_as_calculate(self):
+        for is_cost_based in [True, False]:
+            measure = Mock(id="measure", is_cost_based=is_cost_based)
+            expected = self.get_queries(measure, lambda c: c.calculate(True))
+            queries = self.get_queries(
+                measure, lambda c: list(run_jobs(c.get_bigquery_jobs(), 1))
+            )
+            self.assertEqual(sorted(queries), sorted(expected))
+            self.assertEqual(queries[0], "practice_ratios")
+            if is_cost_based:
+                self.assertEqual(queries[-1], "global_cost_savings")
+
+    def get_queries(self, measure, run):
+        calculation = MeasureCalculation(measure)
+        queries = []
+        with patch.object(
+            calculation,
+            "insert_rows_from_query",
+            side_effect=lambda query_id, *args, **kwargs: queries.append(query_id),
+        ), patch.object(calculation, "_get_col_aliases", return_value=[]), patch.object(
+            calculation, "_columns_for_select", return_value=""
+        ):
+            run(calculation)
+        return queries
+
+
+class CSVStreamTests(SimpleTestCase):
+    def test_read_in_chunks(self):
+        rows = [["a", 1, None], ["b,c", 2.5, '{"x": 1}']] * 3
+        stream = CSVStream(rows)
+        chunks = []
+        while True:
+            chunk = stream.read(7)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 7)
+            chunks.append(chunk)
+        expected = [["a", "1", ""], ["b,c", "2.5", '{"x": 1}']] * 3
+        self.assertEqual(list(csv.reader("".join(chunks).splitlines())), expected)
+
+    def test_read_all(self):
+        self.assertEqual(CSVStream([["a"], ["b"]]).read(), "a\r\nb\r\n")
+        self.assertEqual(CSVStream([]).read(), "")
+
+
 class ConstraintsTests(TestCase):
     @patch("common.utils.db")
     def test_reconstructor_not_called_when_not_enabled(self, db):
@@ -986,3 +1222,30 @@ def build_factory():
     factory = DataFactory()
     factory.create_prescribing_for_bnf_codes(bnf_codes)
     return factory
+
+
+def build_factory_from_uploaded_data(prescriptions, practice_stats):
+    """Build a MatrixStore DataFactory containing the same prescribing and practice
+    statistics as were uploaded to BQ, so that measures calculated from the
+    MatrixStore can be checked in the same way."""
+
+    factory = DataFactory()
+    factory.create_months("2018-07-01", 2)
+    presentations = {}
+    for row in prescriptions.itertuples():
+        if row.bnf_code not in presentations:
+            presentations[row.bnf_code] = factory.create_presentation(row.bnf_code)
+        prescription = factory.create_prescription(
+            presentations[row.bnf_code],
+            {"code": row.practice_id},
+            row.month + " 00:00:00 UTC",
+        )
+        prescription["items"] = row.items
+        prescription["quantity"] = row.quantity
+        prescription["actual_cost"] = row.actual_cost
+    for row in practice_stats.itertuples():
+        statistics = factory.create_statistics_for_one_practice_and_month(
+            {"code": row.practice_id}, row.month + " 00:00:00 UTC"
+        )
+        statistics["total_list_size"] = int(round(row.thousand_patients * 1000))
+    return factory
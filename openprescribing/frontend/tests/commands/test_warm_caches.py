@@ -0,0 +1,79 @@
+import mock
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from frontend.management.commands import warm_caches
+from frontend.models import PCT, ImportLog, Practice
+from frontend.price_per_unit import savings
+from frontend.price_per_unit.substitution_sets import get_substitution_sets
+from matrixstore.db import pinned_generation
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.matrixstore_factory import (
+    matrixstore_from_data_factory,
+    patch_global_matrixstore,
+)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CACHELIB_CACHE_ALIAS="default",
+)
+class WarmCachesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        factory = DataFactory()
+        factory.create_months("2020-01-01", 2)
+        factory.create_practices(5)
+        # A generic and a branded equivalent
+        for bnf_code in ["0601022B0AAASAS", "0601022B0B0ASAS"]:
+            factory.create_presentation(bnf_code=bnf_code)
+        factory.create_prescribing(
+            factory.presentations, factory.practices, factory.months
+        )
+        ccg = PCT.objects.create(name="CCG1", code="ABC", org_type="CCG")
+        for practice in factory.practices:
+            Practice.objects.create(
+                name=practice["name"], code=practice["code"], setting=4, ccg=ccg
+            )
+        ImportLog.objects.create(category="dashboard_data", current_at="2020-02-01")
+        cls.date = factory.months[-1][:10]
+        cls._remove_patch = patch_global_matrixstore(
+            matrixstore_from_data_factory(factory)
+        )
+        get_substitution_sets.cache_clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._remove_patch()
+        super().tearDownClass()
+
+    def setUp(self):
+        caches["default"].clear()
+
+    def test_warms_ppu_savings(self):
+        # Ghost generics need Drug Tariff prices which we don't have here
+        with mock.patch.object(warm_caches, "warm_ghost_generics"):
+            call_command("warm_caches", processes=1)
+        with mock.patch(
+            "frontend.price_per_unit.savings.get_savings_for_all_substitution_sets",
+            side_effect=AssertionError("Savings were not cached"),
+        ):
+            with pinned_generation():
+                for org_type in ["practice", "ccg", "all_standard_practices"]:
+                    savings.get_total_savings_for_all_orgs(self.date, org_type)
+
+    def test_skips_ppu_savings_which_are_precomputed(self):
+        precomputed = mock.Mock()
+        precomputed.is_valid_for.side_effect = lambda date, org_type: (
+            org_type != "ccg"
+        )
+        with mock.patch.object(
+            warm_caches, "get_precomputed_savings", return_value=precomputed
+        ):
+            items = warm_caches.get_warming_items()
+        names = [
+            item.name for item in items if item.function is warm_caches.warm_ppu_savings
+        ]
+        self.assertEqual(names, ["ppu_savings:ccg:{}".format(self.date)])
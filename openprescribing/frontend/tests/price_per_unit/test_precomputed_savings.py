@@ -0,0 +1,134 @@
+import os.path
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
+from frontend.price_per_unit.precomputed_savings import (
+    ORG_TYPES,
+    PrecomputedSavings,
+    write_savings,
+)
+from frontend.price_per_unit.savings import (
+    CONFIG_MIN_SAVINGS_FOR_ORG_TYPE,
+    CONFIG_TARGET_CENTILE,
+    CONFIG_TARGET_PEER_GROUP,
+    calculate_all_savings_for_orgs,
+    get_total_savings_for_org_type,
+)
+from frontend.price_per_unit.substitution_sets import (
+    DictWithCacheID,
+    SubstitutionSet,
+)
+
+from .test_savings import invent_brands_from_generic_bnf_code, invent_generic_bnf_code
+
+
+class PrecomputedSavingsTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        factory = DataFactory()
+        factory.create_months("2020-01-01", 2)
+        factory.create_practices(20)
+        substitution_sets = []
+        for i in range(4):
+            generic_code = invent_generic_bnf_code(i)
+            bnf_codes = [generic_code] + invent_brands_from_generic_bnf_code(
+                generic_code
+            )
+            for bnf_code in bnf_codes:
+                factory.create_presentation(bnf_code=bnf_code)
+            substitution_set = SubstitutionSet(
+                id=generic_code, presentations=bnf_codes, name=generic_code
+            )
+            substitution_sets.append((generic_code, substitution_set))
+        factory.create_prescribing(
+            factory.presentations, factory.practices, factory.months
+        )
+        factory.create_practice_statistics(factory.practices, factory.months)
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+        cls.substitution_sets = DictWithCacheID(substitution_sets)
+        cls.date = factory.months[-1][:10]
+        offsets = cls.matrixstore.practice_offsets
+        cls.row_groupers = {
+            "practice": RowGrouper((offset, code) for code, offset in offsets.items()),
+            "ccg": RowGrouper(
+                (offset, "CCG{}".format(offset % 3)) for offset in offsets.values()
+            ),
+            "all_standard_practices": RowGrouper(
+                (offset, None) for offset in offsets.values()
+            ),
+            CONFIG_TARGET_PEER_GROUP: RowGrouper(
+                (offset, code) for code, offset in offsets.items()
+            ),
+        }
+        cls.tempdir = tempfile.mkdtemp()
+        path = os.path.join(cls.tempdir, "ppu_savings.sqlite")
+        write_savings(
+            path, cls.matrixstore, cls.date, cls.substitution_sets, cls.row_groupers
+        )
+        cls.precomputed = PrecomputedSavings.from_file(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.precomputed.close()
+        cls.matrixstore.close()
+        shutil.rmtree(cls.tempdir)
+        super().tearDownClass()
+
+    def test_all_savings_match_calculated_savings(self):
+        for org_type in ORG_TYPES:
+            all_ids = self.row_groupers[org_type].ids
+            for org_ids in [all_ids, all_ids[:1]]:
+                expected = self.calculate_savings(org_type, org_ids)
+                results = self.precomputed.get_all_savings_for_orgs(
+                    self.date, org_type, org_ids
+                )
+                self.assertEqual(len(results), len(expected))
+                for result, expected_result in zip(results, expected):
+                    self.assertEqual(result.keys(), expected_result.keys())
+                    for key, value in expected_result.items():
+                        if isinstance(value, str) or value is None:
+                            self.assertEqual(result[key], value)
+                        else:
+                            self.assertAlmostEqual(result[key], value)
+
+    def test_some_savings_are_precomputed(self):
+        results = self.precomputed.get_all_savings_for_orgs(
+            self.date, "practice", self.row_groupers["practice"].ids
+        )
+        self.assertTrue(results)
+
+    def test_total_savings_match_calculated_totals(self):
+        for org_type in ORG_TYPES:
+            group_by_org = self.row_groupers[org_type]
+            totals = get_total_savings_for_org_type(
+                db=self.matrixstore,
+                substitution_sets=self.substitution_sets,
+                date=self.date,
+                group_by_org=group_by_org,
+                min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
+                practice_group_by_org=self.row_groupers[CONFIG_TARGET_PEER_GROUP],
+                target_centile=CONFIG_TARGET_CENTILE,
+            )
+            for offset, org_id in enumerate(group_by_org.ids):
+                self.assertAlmostEqual(
+                    self.precomputed.get_total_savings_for_org(org_type, org_id),
+                    totals[offset, 0] / 100,
+                )
+
+    def calculate_savings(self, org_type, org_ids):
+        return calculate_all_savings_for_orgs(
+            db=self.matrixstore,
+            substitution_sets=self.substitution_sets,
+            date=self.date,
+            group_by_org=self.row_groupers[org_type],
+            org_ids=org_ids,
+            min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
+            practice_group_by_org=self.row_groupers[CONFIG_TARGET_PEER_GROUP],
+            target_centile=CONFIG_TARGET_CENTILE,
+        )
@@ -5,19 +5,29 @@ import warnings
 import numpy
 
 from django.core.cache import CacheKeyWarning
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 
+from matrixstore.row_grouper import RowGrouper
 from matrixstore.tests.data_factory import DataFactory
 from matrixstore.tests.matrixstore_factory import (
     patch_global_matrixstore,
     matrixstore_from_data_factory,
 )
 from frontend.models import Practice, PCT, Presentation
-from frontend.price_per_unit.substitution_sets import get_substitution_sets
+from frontend.price_per_unit.substitution_sets import (
+    DictWithCacheID,
+    SubstitutionSet,
+    get_substitution_sets,
+)
 from frontend.price_per_unit.savings import (
     CONFIG_MIN_SAVINGS_FOR_ORG_TYPE,
     CONFIG_TARGET_CENTILE,
+    get_quantities_and_net_costs_at_date,
+    get_savings,
+    get_savings_for_all_substitution_sets,
+    get_target_ppu as get_target_ppu_for_matrices,
     get_total_savings_for_org,
+    get_total_savings_for_org_type,
 )
 
 
@@ -180,6 +190,114 @@ class PricePerUnitSavingsTest(TestCase):
         super().tearDownClass()
 
 
+@override_settings(CACHES=DUMMY_CACHE_SETTING)
+class SavingsForAllSubstitutionSetsTest(SimpleTestCase):
+    """
+    Checks that calculating savings for all substitution sets at once gives the
+    same results as calculating them one set at a time
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        factory = DataFactory()
+        factory.create_months("2020-01-01", 2)
+        factory.create_practices(10)
+        substitution_sets = []
+        for i in range(6):
+            generic_code = invent_generic_bnf_code(i)
+            bnf_codes = [generic_code] + invent_brands_from_generic_bnf_code(
+                generic_code, num_brands=i
+            )
+            # Omit some presentations from the prescribing data entirely
+            for bnf_code in bnf_codes[:-1] if i % 2 else bnf_codes:
+                factory.create_presentation(bnf_code=bnf_code)
+            substitution_set = SubstitutionSet(
+                id=generic_code, presentations=bnf_codes, name=generic_code
+            )
+            substitution_sets.append((generic_code, substitution_set))
+        factory.create_prescribing(
+            factory.presentations, factory.practices, factory.months
+        )
+        factory.create_practice_statistics(factory.practices, factory.months)
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+        cls.substitution_sets = DictWithCacheID(substitution_sets)
+        cls.date = factory.months[0][:10]
+        offsets = sorted(cls.matrixstore.practice_offsets.values())
+        cls.practice_grouper = RowGrouper((offset, offset) for offset in offsets)
+        cls.org_grouper = RowGrouper(
+            (offset, "odd" if offset % 2 else "even") for offset in offsets
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+        super().tearDownClass()
+
+    def test_matches_savings_for_each_set(self):
+        for org_ids in [None, ["odd"]]:
+            blocks = get_savings_for_all_substitution_sets(
+                db=self.matrixstore,
+                substitution_sets=self.substitution_sets,
+                date=self.date,
+                group_by_org=self.org_grouper,
+                org_ids=org_ids,
+                practice_group_by_org=self.practice_grouper,
+                target_centile=CONFIG_TARGET_CENTILE,
+            )
+            for sets, quantities, net_costs, savings, target_ppus in blocks:
+                self.assertEqual(len(sets), len(self.substitution_sets))
+                for offset, substitution_set in enumerate(sets):
+                    expected = self.get_savings_for_set(substitution_set, org_ids)
+                    numpy.testing.assert_allclose(
+                        quantities[:, offset], expected["quantities"][:, 0]
+                    )
+                    numpy.testing.assert_allclose(
+                        net_costs[:, offset], expected["net_costs"][:, 0]
+                    )
+                    numpy.testing.assert_allclose(
+                        savings[:, offset], expected["savings"][:, 0]
+                    )
+                    numpy.testing.assert_allclose(
+                        target_ppus[offset], expected["target_ppu"][0]
+                    )
+
+    def test_total_savings_for_org_type(self):
+        totals = get_total_savings_for_org_type(
+            db=self.matrixstore,
+            substitution_sets=self.substitution_sets,
+            date=self.date,
+            group_by_org=self.org_grouper,
+            min_saving=100,
+            practice_group_by_org=self.practice_grouper,
+            target_centile=CONFIG_TARGET_CENTILE,
+        )
+        expected = numpy.zeros((2, 1))
+        for substitution_set in self.substitution_sets.values():
+            savings = self.get_savings_for_set(substitution_set, None)["savings"]
+            expected += numpy.where(savings >= 100, savings, 0)
+        self.assertTrue(numpy.any(expected))
+        numpy.testing.assert_allclose(totals, expected)
+
+    def get_savings_for_set(self, substitution_set, org_ids):
+        quantities, net_costs = get_quantities_and_net_costs_at_date(
+            self.matrixstore, substitution_set, self.date
+        )
+        target_ppu = get_target_ppu_for_matrices(
+            quantities,
+            net_costs,
+            group_by_org=self.practice_grouper,
+            target_centile=CONFIG_TARGET_CENTILE,
+        )
+        savings = get_savings(quantities, net_costs, target_ppu)
+        return {
+            "quantities": self.org_grouper.sum(quantities, org_ids),
+            "net_costs": self.org_grouper.sum(net_costs, org_ids),
+            "savings": self.org_grouper.sum(savings, org_ids),
+            "target_ppu": target_ppu,
+        }
+
+
 def invent_generic_bnf_code(index):
     assert 0 <= index <= 9
     chemical = "0601022B{}".format(index)
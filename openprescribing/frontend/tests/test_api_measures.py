@@ -3,7 +3,7 @@ import json
 
 from .api_test_base import ApiTestBase
 
-from frontend.models import PCT
+from frontend.models import PCT, Measure, MeasureValue
 
 
 class TestAPIMeasureViews(ApiTestBase):
@@ -13,7 +13,7 @@ class TestAPIMeasureViews(ApiTestBase):
     def _get_json(self, url):
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        return json.loads(response.content.decode("utf8"))
+        return json.loads(response.getvalue().decode("utf8"))
 
     def test_api_measure_global(self):
         url = "/api/1.0/measure/?measure=cerazette&format=json"
@@ -329,6 +329,24 @@ class TestAPIMeasureViews(ApiTestBase):
         self.assertEqual(d["calc_value"], None)
         self.assertEqual(d["cost_savings"]["10"], 0.0)
 
+    def test_api_measure_by_practice_without_cost_savings(self):
+        Measure.objects.filter(id="cerazette2").update(is_cost_based=False)
+        MeasureValue.objects.create(
+            measure_id="cerazette2",
+            practice_id="C84001",
+            pct_id="02Q",
+            month="2015-09-01",
+            numerator=1,
+            denominator=2,
+            calc_value=0.5,
+        )
+        url = "/api/1.0/measure_by_practice/"
+        url += "?org=C84001&measure=cerazette2&format=json"
+        data = self._get_json(url)
+        d = data["measures"][0]["data"][0]
+        self.assertEqual(d["numerator"], 1)
+        self.assertIsNone(d["cost_savings"])
+
     def test_api_two_practices_one_measure(self):
         # Regression test
         url = "/api/1.0/measure_by_practice/"
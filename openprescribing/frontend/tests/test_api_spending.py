@@ -100,7 +100,7 @@ class TestSpending(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_404_returned_for_unknown_short_code(self):
         params = {"code": "0"}
@@ -178,7 +178,7 @@ class TestSpendingByCCG(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_total_spending_by_ccg(self):
         rows = self._get_rows({})
@@ -329,7 +329,7 @@ class TestSpendingByPractice(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_spending_by_all_practices_on_product_without_date(self):
         response = self._get({"code": "0204000I0BC"})
@@ -526,7 +526,7 @@ class TestSpendingByOrg(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_spending_by_all_stps(self):
         rows = self._get_rows({"org_type": "stp"})
@@ -0,0 +1,40 @@
+import datetime
+
+from django.test import SimpleTestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework_csv.renderers import CSVRenderer
+
+from api.streaming import in_chunks, iter_csv, iter_json_array
+
+
+class TestStreaming(SimpleTestCase):
+    rows = [
+        {
+            "date": datetime.date(2020, 1, 1),
+            "row_id": "ABC",
+            "row_name": 'Some   name, with "quotes"',
+            "items": 12,
+            "actual_cost": 3.25,
+        },
+        {
+            "date": datetime.date(2020, 2, 1),
+            "row_id": "DEF",
+            "row_name": None,
+            "items": 0,
+            "actual_cost": 0.0,
+        },
+    ]
+
+    def test_json_matches_renderer(self):
+        for rows in [self.rows, []]:
+            expected = JSONRenderer().render(rows)
+            self.assertEqual(b"".join(iter_json_array(iter(rows))), expected)
+
+    def test_csv_matches_renderer(self):
+        for rows in [self.rows, []]:
+            expected = CSVRenderer().render(rows)
+            self.assertEqual(b"".join(iter_csv(iter(rows))), expected)
+
+    def test_in_chunks(self):
+        pieces = [b"ab", b"c", b"defg", b"h"]
+        self.assertEqual(list(in_chunks(pieces, chunk_size=3)), [b"abc", b"defg", b"h"])
@@ -107,3 +107,29 @@ class FunctionalTests(TestCase):
             cursor.execute("SELECT count(*) FROM pg_indexes WHERE tablename = 'tofu'")
             self.assertEqual(cursor.fetchone()[0], 2)
             self.assertEqual(_cluster_count(cursor), 1)
+
+    def test_reconstructor_recreates_indexes_on_partitions(self):
+        with connection.cursor() as cursor:
+            # Set up a partitioned table
+            cursor.execute(
+                """
+                CREATE TABLE tofu (
+                  id integer,
+                  brand varchar,
+                  PRIMARY KEY (id, brand))
+                PARTITION BY LIST (brand)
+            """
+            )
+            cursor.execute(
+                "CREATE TABLE tofu_cauldron PARTITION OF tofu FOR VALUES IN ('cauldron')"
+            )
+            cursor.execute("CREATE INDEX ON tofu (id) WHERE brand IS NOT NULL")
+            with constraint_and_index_reconstructor("tofu"):
+                cursor.execute(
+                    "SELECT count(*) FROM pg_indexes WHERE tablename = 'tofu_cauldron'"
+                )
+                self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute(
+                "SELECT count(*) FROM pg_indexes WHERE tablename = 'tofu_cauldron'"
+            )
+            self.assertEqual(cursor.fetchone()[0], 2)
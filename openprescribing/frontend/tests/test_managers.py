@@ -2,6 +2,7 @@ import datetime
 
 from django.test import TestCase
 
+from frontend.managers import CENTILES
 from frontend.models import MeasureValue, MeasureGlobal
 
 
@@ -112,6 +113,19 @@ class MeasureValueManagerTests(TestCase):
         self.assertEqual("%.2f" % mv.cost_savings["50"], "59029.41")
         self.assertEqual("%.2f" % mv.cost_savings["90"], "162.00")
 
+    def test_cost_savings_are_keyed_by_centile(self):
+        mv = MeasureValue.objects.get(measure_id="cerazette", practice_id="C84001")
+        self.assertEqual(sorted(mv.cost_savings), CENTILES)
+        self.assertEqual("%.2f" % mv.cost_savings["10"], "485.58")
+        self.assertEqual("%.2f" % mv.cost_savings["90"], "-7218.00")
+
+        mv.cost_savings["90"] = 123.0
+        mv.save()
+        cost_savings = MeasureValue.objects.filter(pk=mv.pk).values_list(
+            "cost_savings", flat=True
+        )[0]
+        self.assertEqual(cost_savings, mv.cost_savings)
+
 
 # It is essential that MeasureValue.objects.by_org returns results ordered by
 # month, as the JS that renders the charts expects this.
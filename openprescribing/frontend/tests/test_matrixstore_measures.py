@@ -0,0 +1,65 @@
+import datetime
+
+import numpy
+
+from django.test import SimpleTestCase
+
+from frontend.matrixstore_measures import compare_rows, get_centiles, percent_rank
+
+
+class PercentRankTest(SimpleTestCase):
+    def test_matches_bigquery_percent_rank(self):
+        values = numpy.array(
+            [[3.0, 1.0], [1.0, numpy.nan], [2.0, numpy.nan], [2.0, numpy.nan]]
+        )
+        ranks = percent_rank(values)
+        # Ties get the lowest rank, NaNs are ignored, and a single value gets a
+        # rank of zero
+        numpy.testing.assert_array_equal(
+            ranks,
+            [[1.0, 0.0], [0.0, numpy.nan], [1 / 3, numpy.nan], [1 / 3, numpy.nan]],
+        )
+
+
+class GetCentilesTest(SimpleTestCase):
+    def test_interpolates_between_values(self):
+        values = numpy.array(
+            [[1.0, numpy.nan], [2.0, numpy.nan], [numpy.nan, numpy.nan]]
+        )
+        centiles = get_centiles(values)
+        self.assertEqual(centiles.shape, (9, 2))
+        numpy.testing.assert_allclose(centiles[:, 0], numpy.linspace(1.1, 1.9, 9))
+        self.assertTrue(numpy.isnan(centiles[:, 1]).all())
+
+    def test_no_values(self):
+        centiles = get_centiles(numpy.zeros((0, 3)))
+        self.assertEqual(centiles.shape, (9, 3))
+        self.assertTrue(numpy.isnan(centiles).all())
+
+
+class CompareRowsTest(SimpleTestCase):
+    def test_compare_rows(self):
+        month = datetime.date(2018, 8, 1)
+        expected = [
+            {"practice_id": "A", "month": month, "numerator": 1, "percentile": None},
+            {"practice_id": "B", "month": month, "numerator": 2, "percentile": 0.5},
+            {"practice_id": "C", "month": month, "numerator": 3, "percentile": 1.0},
+        ]
+        actual = [
+            {
+                "practice_id": "A",
+                "month": month,
+                "numerator": 1.0000000001,
+                "percentile": numpy.nan,
+            },
+            {"practice_id": "B", "month": month, "numerator": 2, "percentile": 0.6},
+            {"practice_id": "D", "month": month, "numerator": 3, "percentile": 1.0},
+        ]
+        self.assertEqual(
+            compare_rows(expected, actual, ["practice_id"]),
+            [
+                "Missing row: ('C', '2018-08-01')",
+                "Unexpected row: ('D', '2018-08-01')",
+                "('B', '2018-08-01') percentile: expected 0.5, got 0.6",
+            ],
+        )
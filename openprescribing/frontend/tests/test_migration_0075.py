@@ -0,0 +1,48 @@
+from importlib import import_module
+import json
+
+from django.db import connection
+from django.test import TestCase
+
+migration = import_module("frontend.migrations.0075_partition_measurevalue")
+
+
+COST_SAVINGS = {
+    "10": 1.5,
+    "20": 2,
+    "30": 3,
+    "40": 4,
+    "50": 5,
+    "60": 6,
+    "70": 7,
+    "80": 8,
+    "90": -9,
+}
+
+
+class CostSavingsConversionTests(TestCase):
+    def convert(self, expression, cost_savings, column_type):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT {} FROM (SELECT %s::{} AS cost_savings) t".format(
+                    expression, column_type
+                ),
+                [cost_savings],
+            )
+            return cursor.fetchone()[0]
+
+    def test_cost_savings_converted_to_array_and_back(self):
+        array = self.convert(
+            migration.COST_SAVINGS_ARRAY, json.dumps(COST_SAVINGS), "jsonb"
+        )
+        self.assertEqual(array, [1.5, 2, 3, 4, 5, 6, 7, 8, -9])
+        self.assertEqual(
+            self.convert(migration.COST_SAVINGS_JSON, array, "double precision[]"),
+            COST_SAVINGS,
+        )
+
+    def test_null_cost_savings_stay_null(self):
+        self.assertIsNone(self.convert(migration.COST_SAVINGS_ARRAY, None, "jsonb"))
+        self.assertIsNone(
+            self.convert(migration.COST_SAVINGS_JSON, None, "double precision[]")
+        )
@@ -28,6 +28,7 @@ from frontend.models import Measure
 from frontend.models import MeasureValue
 from frontend.models import NCSOConcessionBookmark
 from frontend.models import Practice, PCN, PCT
+from frontend.price_per_unit.precomputed_savings import get_total_savings_for_org
 from frontend.views.spending_utils import (
     ncso_spending_for_entity,
     ncso_spending_breakdown_for_entity,
@@ -38,7 +39,6 @@ from frontend.views.views import (
     all_england_low_priority_total,
     all_england_low_priority_savings,
     all_england_measure_savings,
-    get_total_savings_for_org,
 )
 
 GRAB_CMD = (
@@ -59,10 +59,11 @@ from frontend.views.spending_utils import (
     ncso_spending_breakdown_for_entity,
     NATIONAL_AVERAGE_DISCOUNT_PERCENTAGE,
 )
-from frontend.price_per_unit.savings import get_total_savings_for_org
+from frontend.price_per_unit.precomputed_savings import get_total_savings_for_org
 from frontend.price_per_unit.substitution_sets import (
     get_substitution_sets_by_presentation,
 )
+from matrixstore import memory_cache
 from matrixstore.db import org_has_prescribing, latest_prescribing_date
 
 
@@ -480,7 +481,7 @@ def _format_measure_sql(**kwargs):
 
 
 # We cache these in memory to avoid hitting the disk every time
-@functools.lru_cache(maxsize=None)
+@memory_cache.memoize
 def _get_measure_details(measure_id):
     """
     Get extra measure data which is currently only stored in the JSON on disk,
@@ -0,0 +1,135 @@
+"""
+Basic benchmarks for comparing alternative implementations of MatrixStore
+operations on matrices of realistic size
+
+Invoke with e.g.:
+./manage.py shell -c 'from matrixstore.benchmark import benchmark_serializer; benchmark_serializer()'
+./manage.py shell -c 'from matrixstore.benchmark import benchmark_row_grouper; benchmark_row_grouper()'
+"""
+import timeit
+
+import lz4.frame
+import numpy
+import scipy.sparse
+
+from matrixstore.matrix_ops import finalise_matrix
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.serializer import (
+    deserialize,
+    serialize,
+    serialize_compressed,
+    serialize_legacy,
+)
+
+
+# Roughly the number of practices and months in a production MatrixStore file
+NUM_PRACTICES = 8000
+NUM_MONTHS = 60
+
+# Roughly the number of organisations of each type into which we group
+# practices
+NUM_ORGS = {
+    "all_practices": 1,
+    "regional_team": 7,
+    "stp": 42,
+    "ccg": 135,
+    "pcn": 1250,
+}
+
+
+def benchmark_serializer(repeat=5, number=20):
+    """
+    Compare deserialization speed of the current format against the original
+    PyArrow-based format
+    """
+    print_header("matrix", "compressed", "legacy (ms)", "current (ms)")
+    for name, matrix in generate_test_matrices():
+        for compressed in [False, True]:
+            legacy_data = serialize_legacy(matrix)
+            current_data = serialize(matrix)
+            if compressed:
+                legacy_data = lz4.frame.compress(legacy_data, compression_level=10)
+                current_data = serialize_compressed(matrix)
+            legacy_time = time_function(deserialize, legacy_data, repeat, number)
+            current_time = time_function(deserialize, current_data, repeat, number)
+            print_row(name, compressed, legacy_time * 1000, current_time * 1000)
+
+
+def benchmark_row_grouper(repeat=5, number=20):
+    """
+    Compare the two strategies `RowGrouper.sum` uses for summing groups of
+    rows (looping over each group, and a single sparse matrix product) for all
+    groups and for a small subset of groups
+    """
+    print_header("matrix", "org type", "groups", "looping (ms)", "product (ms)")
+    random = numpy.random.RandomState(5678)
+    for org_type, num_orgs in NUM_ORGS.items():
+        row_grouper = RowGrouper(
+            (practice, random.randint(num_orgs)) for practice in range(NUM_PRACTICES)
+        )
+        subset = row_grouper.ids[:10]
+        for name, matrix in generate_test_matrices():
+            for group_ids in [None, subset]:
+                looping_time = time_function(
+                    lambda m: row_grouper._sum_by_looping(m, group_ids),
+                    matrix,
+                    repeat,
+                    number,
+                )
+                product_time = time_function(
+                    lambda m: row_grouper._sum_by_product(m, group_ids),
+                    matrix,
+                    repeat,
+                    number,
+                )
+                print_row(
+                    name,
+                    org_type,
+                    "all" if group_ids is None else len(group_ids),
+                    looping_time * 1000,
+                    product_time * 1000,
+                )
+
+
+def generate_test_matrices():
+    random = numpy.random.RandomState(1234)
+    shape = (NUM_PRACTICES, NUM_MONTHS)
+    for density in [0.01, 0.1, 0.9]:
+        for integer in [True, False]:
+            matrix = scipy.sparse.random(
+                *shape, density=density, format="csc", random_state=random
+            )
+            if integer:
+                matrix.data = numpy.rint(matrix.data * 1000)
+                matrix = matrix.astype(numpy.int_)
+            # This converts to dense where that's more efficient, just as we
+            # do when building real MatrixStore files
+            matrix = finalise_matrix(matrix)
+            name = "{} {} ({:.0%} full)".format(
+                "sparse" if scipy.sparse.issparse(matrix) else "dense",
+                "int" if integer else "float",
+                density,
+            )
+            yield name, matrix
+
+
+def time_function(function, argument, repeat, number):
+    """
+    Return the best average time per call (in seconds) of `function` over
+    `repeat` runs of `number` calls each
+    """
+    times = timeit.repeat(lambda: function(argument), repeat=repeat, number=number)
+    return min(times) / number
+
+
+def print_header(*columns):
+    print_row(*columns)
+    print("-" * 100)
+
+
+def print_row(*columns):
+    formatted = [
+        "{:.3f}".format(column) if isinstance(column, float) else str(column)
+        for column in columns
+    ]
+    print("".join(column.ljust(25) for column in formatted))
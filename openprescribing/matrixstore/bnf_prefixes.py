@@ -0,0 +1,92 @@
+"""
+Sums prescribing over all presentations matching a list of BNF code prefixes
+
+Where the MatrixStore file contains the `bnf_prefix_summary` table (see
+`matrixstore.build.summarise_bnf_prefixes`) we compose the result from the
+fewest possible precalculated totals: for each prefix we use the broadest
+summary nodes it contains, plus any matching presentations which aren't covered
+by those nodes. So a query for a whole chapter reads a single matrix, and a
+query for, say, a partial chemical code reads the totals for each of the
+products it contains. Without the table we fall back to summing every matching
+presentation.
+"""
+# Beyond this many values we can run into SQLite's limit on the number of
+# parameters in a single query, so we just sum the presentations instead
+MAX_QUERY_PARAMS = 900
+
+
+def get_totals_for_prefixes(db, fields, bnf_code_prefixes, workers=1):
+    """
+    Return a list containing, for each of the supplied `fields` (e.g. "items"),
+    a matrix giving the total prescribing over all presentations whose BNF
+    codes start with any of `bnf_code_prefixes`
+
+    If no presentations match then each matrix will be None. The summing is
+    spread over `workers` threads (see `MatrixStore.sum_matrices`).
+    """
+    columns = ", ".join(fields)
+    if db.has_bnf_prefix_summary:
+        summary_prefixes, bnf_codes = get_summary_prefixes_and_bnf_codes(
+            db, bnf_code_prefixes
+        )
+        if len(summary_prefixes) + len(bnf_codes) <= MAX_QUERY_PARAMS:
+            sql = """
+                SELECT {columns} FROM bnf_prefix_summary
+                WHERE prefix IN ({summary_placeholders})
+                UNION ALL
+                SELECT {columns} FROM presentation
+                WHERE bnf_code IN ({presentation_placeholders})
+                """.format(
+                columns=columns,
+                summary_placeholders=",".join("?" * len(summary_prefixes)),
+                presentation_placeholders=",".join("?" * len(bnf_codes)),
+            )
+            return db.sum_matrices(sql, summary_prefixes + bnf_codes, workers=workers)
+    where_clause = " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes))
+    sql = "SELECT {} FROM presentation WHERE {}".format(columns, where_clause)
+    params = [prefix + "%" for prefix in bnf_code_prefixes]
+    return db.sum_matrices(sql, params, workers=workers)
+
+
+def get_summary_prefixes_and_bnf_codes(db, bnf_code_prefixes):
+    """
+    Return a list of prefixes from the `bnf_prefix_summary` table, plus a list
+    of BNF codes of individual presentations, which between them cover exactly
+    those presentations matching `bnf_code_prefixes`, with no overlap
+    """
+    summary_prefixes = []
+    bnf_codes = []
+    for prefix in remove_redundant_prefixes(bnf_code_prefixes):
+        pattern = prefix + "%"
+        nodes = remove_redundant_prefixes(
+            node
+            for (node,) in db.query(
+                "SELECT prefix FROM bnf_prefix_summary WHERE prefix LIKE ?", [pattern]
+            )
+        )
+        covered = tuple(nodes)
+        summary_prefixes.extend(nodes)
+        bnf_codes.extend(
+            bnf_code
+            for (bnf_code,) in db.query(
+                "SELECT bnf_code FROM presentation WHERE bnf_code LIKE ?", [pattern]
+            )
+            if not bnf_code.startswith(covered)
+        )
+    return summary_prefixes, bnf_codes
+
+
+def remove_redundant_prefixes(prefixes):
+    """
+    Return a sorted list of the supplied prefixes, omitting any which are
+    already covered by a shorter prefix in the list
+
+    >>> remove_redundant_prefixes(["0202", "02", "0401", "04010", "0401"])
+    ['02', '0401']
+    """
+    retained = []
+    for prefix in sorted(set(prefixes)):
+        if retained and prefix.startswith(retained[-1]):
+            continue
+        retained.append(prefix)
+    return retained
@@ -0,0 +1,154 @@
+"""
+Split the `quantity` and `net_cost` matrices for each presentation into
+single-month chunks. Many of our most heavily used queries (e.g. price-per-unit
+savings and ghost-branded generics) need prescribing for just one month, and
+with only the full matrices available they have to decompress five years of
+data only to throw away all but a single column.
+
+The chunks are stored in a separate table alongside (rather than instead of)
+the full matrices so that nothing else needs to change. See
+`MatrixStore.query_presentations_at_date` for how they get used.
+
+Months in which a presentation has no prescribing at all are omitted from the
+table entirely.
+"""
+import logging
+import os.path
+import sqlite3
+import time
+
+import numpy
+from scipy.sparse import csc_matrix
+
+from matrixstore.matrix_ops import finalise_matrix, get_submatrix
+from matrixstore.serializer import deserialize, serialize_compressed
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA_SQL = """
+    CREATE TABLE presentation_date_chunk (
+        bnf_code TEXT,
+        date_offset INTEGER,
+        -- The below columns contain serialized matrices of shape (number of
+        -- practices, 1) giving prescribing for a single month
+        quantity BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (bnf_code, date_offset)
+    );
+"""
+
+
+def chunk_by_date(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    chunk_by_date_for_db(connection)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def chunk_by_date_for_db(connection):
+    logger.info("Splitting prescribing matrices into single-month chunks")
+    cursor = connection.cursor()
+    cursor.execute("SAVEPOINT chunk_by_date")
+    cursor.execute(SCHEMA_SQL)
+    num_dates = connection.execute("SELECT COUNT(*) FROM date").fetchone()[0]
+    latest_date_offset = num_dates - 1
+    stats = ChunkStats()
+    results = connection.execute(
+        """
+        SELECT bnf_code, quantity, net_cost
+        FROM presentation
+        WHERE quantity IS NOT NULL
+        ORDER BY bnf_code
+        """
+    )
+    for bnf_code, quantity_data, net_cost_data in results:
+        stats.full_bytes += len(quantity_data) + len(net_cost_data)
+        # Record how long it takes to get a single month's data out of the full
+        # matrices so we can compare this with the chunked equivalent below
+        start = time.time()
+        quantity = deserialize(quantity_data)
+        net_cost = deserialize(net_cost_data)
+        get_date_chunk(quantity, latest_date_offset)
+        get_date_chunk(net_cost, latest_date_offset)
+        stats.full_seconds += time.time() - start
+        for date_offset in range(num_dates):
+            quantity_chunk = finalise_matrix(get_date_chunk(quantity, date_offset))
+            net_cost_chunk = finalise_matrix(get_date_chunk(net_cost, date_offset))
+            if not has_data(quantity_chunk) and not has_data(net_cost_chunk):
+                continue
+            values = [
+                serialize_compressed(quantity_chunk),
+                serialize_compressed(net_cost_chunk),
+            ]
+            stats.chunk_bytes += sum(map(len, values))
+            if date_offset == latest_date_offset:
+                start = time.time()
+                for value in values:
+                    deserialize(value)
+                stats.chunk_seconds += time.time() - start
+            cursor.execute(
+                """
+                INSERT INTO presentation_date_chunk
+                  (bnf_code, date_offset, quantity, net_cost)
+                VALUES
+                  (?, ?, ?, ?)
+                """,
+                [bnf_code, date_offset] + values,
+            )
+    cursor.execute("RELEASE chunk_by_date")
+    stats.log()
+
+
+def get_date_chunk(matrix, date_offset):
+    """
+    Return the single column of `matrix` corresponding to `date_offset` as a
+    sparse matrix
+    """
+    column = get_submatrix(matrix, cols=slice(date_offset, date_offset + 1))
+    if isinstance(column, numpy.ndarray):
+        column = csc_matrix(column)
+    return column
+
+
+def has_data(matrix):
+    if isinstance(matrix, numpy.ndarray):
+        return numpy.any(matrix)
+    else:
+        return matrix.count_nonzero() > 0
+
+
+class ChunkStats(object):
+    """
+    Keeps track of the storage cost and read speed of the chunked data
+    compared with the full matrices
+    """
+
+    full_bytes = 0
+    chunk_bytes = 0
+    full_seconds = 0.0
+    chunk_seconds = 0.0
+
+    def log(self):
+        logger.info(
+            "Full quantity and net_cost matrices: %s MB; single-month chunks: %s MB "
+            "(%.1f%% extra storage)",
+            self.full_bytes // 1024 ** 2,
+            self.chunk_bytes // 1024 ** 2,
+            100 * self.chunk_bytes / self.full_bytes if self.full_bytes else 0,
+        )
+        logger.info(
+            "Reading latest month for all presentations: %.2fs from full matrices, "
+            "%.2fs from chunks",
+            self.full_seconds,
+            self.chunk_seconds,
+        )
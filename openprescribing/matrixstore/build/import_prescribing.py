@@ -1,16 +1,27 @@
 """
 Import prescribing data from CSV files into SQLite
+
+When run with multiple workers, the parent process reads the CSV files (once)
+and hands the rows for each batch of BNF codes to a pool of worker processes,
+which build and serialize the matrices while the parent writes the results to
+SQLite. Results are written in exactly the same order as in the single process
+case so the resulting files are identical.
 """
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import csv
-from itertools import groupby
+import functools
+from itertools import chain, groupby
 import logging
 import os
 import sqlite3
 import gzip
 import heapq
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
+import numpy
+
+from matrixstore.matrix_ops import sparse_matrix_from_values, finalise_matrix
+from matrixstore.parallel import map_in_order
 from matrixstore.serializer import serialize_compressed
 
 from .common import get_prescribing_filename
@@ -21,20 +32,36 @@ logger = logging.getLogger(__name__)
 
 MatrixRow = namedtuple("MatrixRow", "bnf_code items quantity actual_cost net_cost")
 
+# Whether each of items, quantity, actual_cost and net_cost is an integer
+VALUE_COLUMNS_ARE_INTEGER = (True, False, True, True)
+
+
+# When building in parallel we send the rows for whole presentations to the
+# workers in batches of roughly this many rows
+ROWS_PER_BATCH = 100000
+
+# ... and allow this many batches per worker to be in flight at once, which
+# keeps the workers busy while bounding the memory used by rows waiting to be
+# processed and results waiting to be written
+BATCHES_PER_WORKER = 2
+
 
 class MissingHeaderError(Exception):
     pass
 
 
-def import_prescribing(filename):
+def import_prescribing(filename, workers=1):
     if not os.path.exists(filename):
         raise RuntimeError("No SQLite file at: {}".format(filename))
     connection = sqlite3.connect(filename)
     # Trade crash-safety for insert speed
     connection.execute("PRAGMA synchronous=OFF")
     dates = [date for (date,) in connection.execute("SELECT date FROM date")]
-    prescriptions = get_prescriptions_for_dates(dates)
-    write_prescribing(connection, prescriptions)
+    if workers > 1:
+        write_prescribing_in_parallel(connection, dates, workers)
+    else:
+        prescriptions = get_prescriptions_for_dates(dates)
+        write_prescribing(connection, prescriptions)
     connection.commit()
     connection.close()
 
@@ -46,13 +73,69 @@ def write_prescribing(connection, prescriptions):
     practices = dict(cursor.execute("SELECT code, offset FROM practice"))
     dates = dict(cursor.execute("SELECT date, offset FROM date"))
     matrices = build_matrices(prescriptions, practices, dates)
-    rows = format_as_sql_rows(matrices, connection)
+    write_serialized_matrices(connection, map(serialize_matrix_row, matrices))
+
+
+def write_prescribing_in_parallel(connection, dates, workers):
+    """
+    As `write_prescribing` but with the matrices being built and serialized by
+    a pool of `workers` processes
+    """
+    cursor = connection.cursor()
+    practices = dict(cursor.execute("SELECT code, offset FROM practice"))
+    date_offsets = dict(cursor.execute("SELECT date, offset FROM date"))
+    prescriptions = get_prescriptions_for_dates(dates)
+    logger.info("Building matrices using %s workers", workers)
+    build_for_batch = functools.partial(
+        build_serialized_matrices_for_batch, practices, date_offsets
+    )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # We process the batches in order, reading a new one only as each
+        # finished batch is written, so the input is never read far ahead
+        batches = map_in_order(
+            executor,
+            build_for_batch,
+            split_into_batches(prescriptions, ROWS_PER_BATCH),
+            max_pending=workers * BATCHES_PER_WORKER,
+        )
+        write_serialized_matrices(connection, chain.from_iterable(batches))
+
+
+def build_serialized_matrices_for_batch(practices, dates, prescriptions):
+    """
+    Build and serialize the matrices for a batch of prescriptions (see
+    `split_into_batches`), returning a list of MatrixRows
+
+    This is designed to be run in a separate worker process.
+    """
+    matrices = build_matrices(prescriptions, practices, dates)
+    return list(map(serialize_matrix_row, matrices))
+
+
+def split_into_batches(prescriptions, rows_per_batch):
+    """
+    Given an iterable of prescriptions sorted by BNF code yield lists of
+    prescriptions, each containing at least `rows_per_batch` rows (except the
+    last) and all the rows for every BNF code it includes
+    """
+    batch = []
+    for _, rows in groupby(prescriptions, lambda row: row[0]):
+        batch.extend(rows)
+        if len(batch) >= rows_per_batch:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_serialized_matrices(connection, rows):
+    cursor = connection.cursor()
     cursor.executemany(
         """
         UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
         WHERE bnf_code=?
         """,
-        rows,
+        format_as_sql_rows(rows, connection),
     )
 
 
@@ -64,6 +147,15 @@ def get_prescriptions_for_dates(dates):
 
     sorted by bnf_code, practice and date.
     """
+    filenames = get_prescribing_filenames(dates)
+    prescribing_streams = [read_gzipped_prescribing_csv(f) for f in filenames]
+    # We assume that the input files are already sorted by (bnf_code, practice,
+    # month) so to ensure that the combined stream is sorted we just need to
+    # merge them correctly, which heapq.merge handles nicely for us
+    return heapq.merge(*prescribing_streams)
+
+
+def get_prescribing_filenames(dates):
     dates = sorted(dates)
     filenames = [get_prescribing_filename(date) for date in dates]
     missing_files = [f for f in filenames if not os.path.exists(f)]
@@ -73,11 +165,7 @@ def get_prescriptions_for_dates(dates):
                 "\n  ".join(missing_files)
             )
         )
-    prescribing_streams = [read_gzipped_prescribing_csv(f) for f in filenames]
-    # We assume that the input files are already sorted by (bnf_code, practice,
-    # month) so to ensure that the combined stream is sorted we just need to
-    # merge them correctly, which heapq.merge handles nicely for us
-    return heapq.merge(*prescribing_streams)
+    return filenames
 
 
 def read_gzipped_prescribing_csv(filename):
@@ -138,31 +226,35 @@ def build_matrices(prescriptions, practices, dates):
     shape = (max_row + 1, max_col + 1)
     grouped_by_bnf_code = groupby(prescriptions, lambda row: row[0])
     for bnf_code, row_group in grouped_by_bnf_code:
-        items_matrix = sparse_matrix(shape, integer=True)
-        quantity_matrix = sparse_matrix(shape, integer=False)
-        actual_cost_matrix = sparse_matrix(shape, integer=True)
-        net_cost_matrix = sparse_matrix(shape, integer=True)
-        for _, practice, date, items, quantity, actual_cost, net_cost in row_group:
-            practice_offset = practices[practice]
-            date_offset = dates[date]
-            items_matrix[practice_offset, date_offset] = items
-            quantity_matrix[practice_offset, date_offset] = quantity
-            actual_cost_matrix[practice_offset, date_offset] = actual_cost
-            net_cost_matrix[practice_offset, date_offset] = net_cost
-        yield MatrixRow(
-            bnf_code,
-            finalise_matrix(items_matrix),
-            finalise_matrix(quantity_matrix),
-            finalise_matrix(actual_cost_matrix),
-            finalise_matrix(net_cost_matrix),
-        )
+        # Transpose the rows into columns so that we can construct each matrix
+        # in a single vectorised operation, rather than assigning values one
+        # cell at a time
+        _, practice_codes, date_strs, *value_columns = zip(*row_group)
+        row_offsets = numpy.array([practices[practice] for practice in practice_codes])
+        column_offsets = numpy.array([dates[date] for date in date_strs])
+        items, quantity, actual_cost, net_cost = [
+            finalise_matrix(
+                sparse_matrix_from_values(
+                    shape, row_offsets, column_offsets, values, integer=integer
+                )
+            )
+            for values, integer in zip(value_columns, VALUE_COLUMNS_ARE_INTEGER)
+        ]
+        yield MatrixRow(bnf_code, items, quantity, actual_cost, net_cost)
+
+
+def serialize_matrix_row(row):
+    """
+    Return a copy of a MatrixRow with its matrices serialized and compressed
+    """
+    return MatrixRow(row.bnf_code, *map(serialize_compressed, row[1:]))
 
 
 def format_as_sql_rows(matrices, connection):
     """
-    Given an iterable of MatrixRows (which contain a BNF code plus all
-    prescribing data for that presentation) yield tuples of values ready for
-    insertion into SQLite
+    Given an iterable of serialized MatrixRows (which contain a BNF code plus
+    all prescribing data for that presentation) yield tuples of values ready
+    for insertion into SQLite
     """
     cursor = connection.cursor()
     num_presentations = next(cursor.execute("SELECT COUNT(*) FROM presentation"))[0]
@@ -179,13 +271,7 @@ def format_as_sql_rows(matrices, connection):
             logger.info(
                 "Writing data for %s (%s/%s)", row.bnf_code, count, num_presentations
             )
-        yield (
-            serialize_compressed(row.items),
-            serialize_compressed(row.quantity),
-            serialize_compressed(row.actual_cost),
-            serialize_compressed(row.net_cost),
-            row.bnf_code,
-        )
+        yield (row.items, row.quantity, row.actual_cost, row.net_cost, row.bnf_code)
     logger.info("Finished writing data for %s presentations", count)
 
 
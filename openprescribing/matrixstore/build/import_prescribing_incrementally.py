@@ -0,0 +1,295 @@
+"""
+Import prescribing data into SQLite by reusing the matrices in a previously
+built MatrixStore file and only reading CSV data for months which that file
+doesn't already contain
+
+Each month we build a new file covering a window of dates which overlaps almost
+entirely with the previous month's file. Rather than re-reading sixty months of
+CSV we take the previous file's matrices, remap their rows and columns to the
+practices and dates of the new file (so the oldest month drops off the left
+hand side) and add in the prescribing for the new month(s) on the right hand
+side.
+
+The `all_presentations` totals are updated in the same way: the previous totals
+are remapped and the totals for the new months are added to them. This means
+we don't need to run `precalculate_totals` afterwards.
+
+This assumes that prescribing for months already in the previous file hasn't
+changed since it was built. Where historical data has been revised we need to
+do a full build.
+"""
+from itertools import groupby
+import logging
+import os.path
+import sqlite3
+
+import numpy
+import scipy.sparse
+
+from matrixstore.matrix_ops import finalise_matrix, sparse_matrix_from_values
+from matrixstore.serializer import deserialize
+from matrixstore.sql_functions import fast_in_place_add
+
+from .import_prescribing import (
+    VALUE_COLUMNS_ARE_INTEGER,
+    MatrixRow,
+    format_as_sql_rows,
+    get_prescriptions_for_dates,
+    serialize_matrix_row,
+)
+from .precalculate_totals import prepare_matrix_value
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_dates_to_import(sqlite_path, previous_sqlite_path):
+    """
+    Return the dates in the new file for which we have no data in the previous
+    file, and so need to import from CSV
+    """
+    new_dates = get_dates(sqlite_path)
+    previous_dates = get_dates(previous_sqlite_path)
+    dates_to_import = [date for date in new_dates if date not in previous_dates]
+    if dates_to_import and min(dates_to_import) < max(previous_dates):
+        raise RuntimeError(
+            "Incremental builds can only add months after the end of the previous "
+            "file (which ends at {}), not before it".format(max(previous_dates))
+        )
+    return dates_to_import
+
+
+def get_dates(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    dates = [date for (date,) in connection.execute("SELECT date FROM date")]
+    connection.close()
+    return dates
+
+
+def import_prescribing_incrementally(sqlite_path, previous_sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    if not os.path.exists(previous_sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(previous_sqlite_path))
+    dates_to_import = get_dates_to_import(sqlite_path, previous_sqlite_path)
+    logger.info(
+        "Reusing prescribing from %s and importing %s new months",
+        previous_sqlite_path,
+        len(dates_to_import),
+    )
+    connection = sqlite3.connect(sqlite_path)
+    # Trade crash-safety for insert speed
+    connection.execute("PRAGMA synchronous=OFF")
+    previous_connection = sqlite3.connect(previous_sqlite_path)
+    if dates_to_import:
+        prescriptions = get_prescriptions_for_dates(dates_to_import)
+    else:
+        prescriptions = []
+    write_prescribing_incrementally(connection, previous_connection, prescriptions)
+    previous_connection.close()
+    connection.commit()
+    connection.close()
+
+
+def write_prescribing_incrementally(connection, previous_connection, prescriptions):
+    """
+    Write matrices combining the prescribing stored in `previous_connection`
+    with the supplied prescriptions (which should be for dates not covered by
+    the previous file) and write the corresponding totals
+    """
+    cursor = connection.cursor()
+    practices = dict(cursor.execute("SELECT code, offset FROM practice"))
+    dates = dict(cursor.execute("SELECT date, offset FROM date"))
+    shape = (max(practices.values()) + 1, max(dates.values()) + 1)
+    row_map = get_offset_map(previous_connection, "practice", "code", practices)
+    column_map = get_offset_map(previous_connection, "date", "date", dates)
+    previous_totals = get_previous_totals(previous_connection)
+    # We accumulate totals in dense, Fortran-ordered arrays so we can use the
+    # same fast addition routine as `MATRIX_SUM`
+    totals = [
+        remap_matrix(matrix, shape, row_map, column_map, is_integer).toarray(order="F")
+        for matrix, is_integer in zip(previous_totals, VALUE_COLUMNS_ARE_INTEGER)
+    ]
+    previous_matrices = get_previous_matrices(previous_connection)
+    new_entries = get_new_entries(prescriptions, practices, dates)
+    matrices = combine_matrices(
+        previous_matrices, new_entries, shape, row_map, column_map, totals
+    )
+    rows = (serialize_matrix_row(row) for row in matrices if has_prescribing(row))
+    cursor.executemany(
+        """
+        UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
+        WHERE bnf_code=?
+        """,
+        format_as_sql_rows(rows, connection),
+    )
+    write_totals(connection, totals)
+
+
+def get_offset_map(previous_connection, table, key_field, new_offsets):
+    """
+    Return an array which maps each row (or column) offset in the previous file
+    to the corresponding offset in the new file, or to -1 if the practice (or
+    date) no longer appears
+    """
+    previous_offsets = dict(
+        previous_connection.execute(
+            "SELECT {}, offset FROM {}".format(key_field, table)
+        )
+    )
+    offset_map = numpy.full(len(previous_offsets), -1, dtype=numpy.int_)
+    for key, previous_offset in previous_offsets.items():
+        offset_map[previous_offset] = new_offsets.get(key, -1)
+    return offset_map
+
+
+def get_previous_totals(previous_connection):
+    values = previous_connection.execute(
+        "SELECT items, quantity, actual_cost, net_cost FROM all_presentations"
+    ).fetchone()
+    return [deserialize(value) for value in values]
+
+
+def get_previous_matrices(previous_connection):
+    """
+    Yield a MatrixRow for each presentation in the previous file, sorted by BNF
+    code
+    """
+    results = previous_connection.execute(
+        """
+        SELECT bnf_code, items, quantity, actual_cost, net_cost
+        FROM presentation
+        WHERE items IS NOT NULL
+        ORDER BY bnf_code
+        """
+    )
+    for bnf_code, *values in results:
+        yield MatrixRow(bnf_code, *map(deserialize, values))
+
+
+def get_new_entries(prescriptions, practices, dates):
+    """
+    Accepts an iterable of prescriptions (sorted by BNF code) and yields, for
+    each BNF code, a tuple of the form:
+
+        bnf_code, row_offsets, column_offsets, value_columns
+
+    where `value_columns` contains arrays of items, quantity, actual_cost and
+    net_cost
+    """
+    for bnf_code, row_group in groupby(prescriptions, lambda row: row[0]):
+        _, practice_codes, date_strs, *value_columns = zip(*row_group)
+        row_offsets = numpy.array([practices[practice] for practice in practice_codes])
+        column_offsets = numpy.array([dates[date] for date in date_strs])
+        yield bnf_code, row_offsets, column_offsets, value_columns
+
+
+def combine_matrices(
+    previous_matrices, new_entries, shape, row_map, column_map, totals
+):
+    """
+    Merge the (sorted) streams of previous matrices and new entries by BNF code
+    and yield a MatrixRow for each code appearing in either, adding the values
+    for the new entries to `totals` as we go
+
+    Codes which appear only in the previous file are retained (they may still
+    have prescribing in the months which overlap) as are those which appear
+    only in the new data.
+    """
+    previous_matrices = iter(previous_matrices)
+    new_entries = iter(new_entries)
+    previous = next(previous_matrices, None)
+    new = next(new_entries, None)
+    while previous is not None or new is not None:
+        if new is None or (previous is not None and previous.bnf_code < new[0]):
+            bnf_code, previous_row, new_row = previous.bnf_code, previous, None
+            previous = next(previous_matrices, None)
+        elif previous is None or new[0] < previous.bnf_code:
+            bnf_code, previous_row, new_row = new[0], None, new
+            new = next(new_entries, None)
+        else:
+            bnf_code, previous_row, new_row = new[0], previous, new
+            previous = next(previous_matrices, None)
+            new = next(new_entries, None)
+        matrices = []
+        for i, (is_integer, total) in enumerate(zip(VALUE_COLUMNS_ARE_INTEGER, totals)):
+            if previous_row is not None:
+                matrix = remap_matrix(
+                    previous_row[i + 1], shape, row_map, column_map, is_integer
+                )
+            else:
+                matrix = empty_matrix(shape, is_integer)
+            if new_row is not None:
+                _, row_offsets, column_offsets, value_columns = new_row
+                new_matrix = sparse_matrix_from_values(
+                    shape,
+                    row_offsets,
+                    column_offsets,
+                    value_columns[i],
+                    integer=is_integer,
+                )
+                fast_in_place_add(total, new_matrix)
+                # The previous and new matrices have no columns in common so
+                # adding them just combines their values
+                matrix = matrix + new_matrix
+            matrices.append(finalise_matrix(matrix))
+        yield MatrixRow(bnf_code, *matrices)
+
+
+def remap_matrix(matrix, shape, row_map, column_map, is_integer):
+    """
+    Return a sparse matrix of the supplied shape containing the values in
+    `matrix` moved to the rows and columns given by `row_map` and `column_map`,
+    dropping any values whose row or column doesn't map to anything
+    """
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.tocoo()
+        rows, columns, values = matrix.row, matrix.col, matrix.data
+    else:
+        rows, columns = numpy.nonzero(matrix)
+        values = matrix[rows, columns]
+    rows = row_map[rows]
+    columns = column_map[columns]
+    retained = (rows >= 0) & (columns >= 0)
+    return sparse_matrix_from_values(
+        shape,
+        rows[retained],
+        columns[retained],
+        values[retained],
+        integer=is_integer,
+    )
+
+
+def empty_matrix(shape, is_integer):
+    return sparse_matrix_from_values(shape, [], [], [], integer=is_integer)
+
+
+def has_prescribing(row):
+    """
+    Return whether the MatrixRow contains any values at all
+
+    Presentations whose only prescribing was in months which have now dropped
+    out of the date range get left without data and are then deleted along
+    with the other presentations without prescribing.
+    """
+    return any(
+        matrix.nnz if scipy.sparse.issparse(matrix) else numpy.any(matrix)
+        for matrix in row[1:]
+    )
+
+
+def write_totals(connection, totals):
+    logger.info("Writing updated totals to db")
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM all_presentations")
+    cursor.execute(
+        """
+        INSERT INTO
+          all_presentations (items, quantity, actual_cost, net_cost)
+        VALUES
+          (?, ?, ?, ?)
+        """,
+        list(map(prepare_matrix_value, totals)),
+    )
@@ -0,0 +1,155 @@
+"""
+Pre-calculate prescribing and practice statistics grouped by organisation for
+the most commonly requested combinations: prescribing over all presentations
+and over each BNF chapter, section and paragraph, plus every practice
+statistic, for each org type in `org_aggregates.ORG_TYPES`.
+
+Grouped matrices are tiny compared with the practice level matrices so storing
+these costs very little space, but it means that the API can answer the most
+common queries by reading a single small value. See `matrixstore.org_aggregates`
+for how they get used.
+
+The groupings are determined by the org relationships in the database at the
+time the file is built.
+"""
+import logging
+import os.path
+import sqlite3
+
+from matrixstore.db import build_row_grouper
+from matrixstore.org_aggregates import ALL_PRESENTATIONS, BNF_PREFIX_LENGTHS, ORG_TYPES
+from matrixstore.serializer import deserialize, serialize_compressed
+
+from .summarise_bnf_prefixes import sum_by_prefix
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA_SQL = """
+    -- Records the `cache_key` of the RowGrouper used to group each org type so
+    -- we can tell whether the aggregates match the current org relationships
+    CREATE TABLE org_aggregate_grouper (
+        org_type TEXT,
+        cache_key BLOB,
+
+        PRIMARY KEY (org_type)
+    );
+
+    CREATE TABLE prescribing_by_org (
+        org_type TEXT,
+        -- Either "all_presentations" or a BNF code prefix
+        source TEXT,
+        -- The below columns contain serialized matrices of shape (number of
+        -- orgs, number of months)
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+
+        PRIMARY KEY (org_type, source)
+    );
+
+    CREATE TABLE practice_statistic_by_org (
+        org_type TEXT,
+        name TEXT,
+        value BLOB,
+
+        PRIMARY KEY (org_type, name)
+    );
+"""
+
+
+def precalculate_org_aggregates(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    practice_offsets = dict(connection.execute("SELECT code, offset FROM practice"))
+    row_groupers = {
+        org_type: build_row_grouper(org_type, practice_offsets)
+        for org_type in ORG_TYPES
+    }
+    precalculate_org_aggregates_for_db(connection, row_groupers)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def precalculate_org_aggregates_for_db(connection, row_groupers):
+    """
+    Write aggregates for each of the supplied RowGroupers, which should be a
+    dict mapping org types to RowGroupers
+    """
+    logger.info("Pre-calculating aggregates for: %s", ", ".join(row_groupers))
+    cursor = connection.cursor()
+    cursor.execute("SAVEPOINT org_aggregates")
+    # We can't use `executescript` here as it commits any open transaction
+    for statement in SCHEMA_SQL.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+    cursor.executemany(
+        "INSERT INTO org_aggregate_grouper (org_type, cache_key) VALUES (?, ?)",
+        [(org_type, grouper.cache_key) for org_type, grouper in row_groupers.items()],
+    )
+    for source, matrices in get_prescribing_totals(connection):
+        for org_type, grouper in row_groupers.items():
+            cursor.execute(
+                """
+                INSERT INTO prescribing_by_org
+                  (org_type, source, items, quantity, actual_cost)
+                VALUES
+                  (?, ?, ?, ?, ?)
+                """,
+                [org_type, source] + group_and_serialize(grouper, matrices),
+            )
+    results = connection.execute("SELECT name, value FROM practice_statistic")
+    for name, value in results:
+        matrix = deserialize(value)
+        for org_type, grouper in row_groupers.items():
+            cursor.execute(
+                """
+                INSERT INTO practice_statistic_by_org
+                  (org_type, name, value)
+                VALUES
+                  (?, ?, ?)
+                """,
+                [org_type, name] + group_and_serialize(grouper, [matrix]),
+            )
+    cursor.execute("RELEASE org_aggregates")
+
+
+def get_prescribing_totals(connection):
+    """
+    Yield pairs of the form:
+
+        source, [items_matrix, quantity_matrix, actual_cost_matrix]
+
+    where `source` is either "all_presentations" or a BNF code prefix and the
+    matrices give total prescribing over all matching presentations
+    """
+    results = connection.execute(
+        """
+        SELECT items, quantity, actual_cost FROM all_presentations
+        """
+    )
+    yield ALL_PRESENTATIONS, list(map(deserialize, results.fetchone()))
+    results = connection.execute(
+        """
+        SELECT bnf_code, items, quantity, actual_cost
+        FROM presentation
+        WHERE items IS NOT NULL
+        ORDER BY bnf_code
+        """
+    )
+    presentations = (
+        (bnf_code, list(map(deserialize, values))) for bnf_code, *values in results
+    )
+    for prefix, totals, _ in sum_by_prefix(presentations, BNF_PREFIX_LENGTHS):
+        yield prefix, totals
+
+
+def group_and_serialize(row_grouper, matrices):
+    return [serialize_compressed(grouped) for grouped in row_grouper.sum_many(matrices)]
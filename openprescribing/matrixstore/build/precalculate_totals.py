@@ -18,7 +18,7 @@ from matrixstore.serializer import serialize_compressed
 logger = logging.getLogger(__name__)
 
 
-def precalculate_totals(sqlite_path):
+def precalculate_totals(sqlite_path, workers=1):
     if not os.path.exists(sqlite_path):
         raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
     connection = sqlite3.connect(sqlite_path)
@@ -26,27 +26,28 @@ def precalculate_totals(sqlite_path):
     # we want to use our own transactions below
     previous_isolation_level = connection.isolation_level
     connection.isolation_level = None
-    precalculate_totals_for_db(connection)
+    precalculate_totals_for_db(connection, workers=workers)
     connection.isolation_level = previous_isolation_level
     connection.commit()
     connection.close()
 
 
-def precalculate_totals_for_db(connection):
+def precalculate_totals_for_db(connection, workers=1):
     matrixstore = MatrixStore(connection)
     logger.info("Summing prescribing over all presentations")
-    values = matrixstore.query_one(
+    values = matrixstore.sum_matrices(
         """
         SELECT
-          MATRIX_SUM(items),
-          MATRIX_SUM(quantity),
-          MATRIX_SUM(actual_cost),
-          MATRIX_SUM(net_cost)
+          items,
+          quantity,
+          actual_cost,
+          net_cost
         FROM
           presentation
         WHERE
           items IS NOT NULL
-        """
+        """,
+        workers=workers,
     )
     logger.info("Writing precalculated totals to db")
     cursor = connection.cursor()
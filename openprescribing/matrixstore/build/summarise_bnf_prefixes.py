@@ -0,0 +1,136 @@
+"""
+Pre-calculate practice level totals of prescribing for every BNF chapter,
+section, paragraph, chemical and product (i.e. every BNF code prefix at each
+level of the hierarchy) and store them in the `bnf_prefix_summary` table.
+
+Queries for prescribing matching a BNF code prefix would otherwise have to sum
+every matching presentation: for a whole chapter that means deserializing
+thousands of matrices. With the summary table available they can instead be
+answered by summing a handful of precalculated matrices. See
+`matrixstore.bnf_prefixes` for how the table gets used.
+
+Prefixes which match only a single presentation are omitted as there's nothing
+to be gained by storing a copy of the presentation's own matrices.
+"""
+import logging
+import os.path
+import sqlite3
+
+from scipy.sparse import csc_matrix
+
+from matrixstore.matrix_ops import finalise_matrix
+from matrixstore.serializer import deserialize, serialize_compressed
+from matrixstore.sql_functions import MatrixSum
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA_SQL = """
+    CREATE TABLE bnf_prefix_summary (
+        prefix TEXT,
+        -- The below columns contain serialized matrices of shape (number of
+        -- practices, number of months) giving the total prescribing over all
+        -- presentations whose BNF codes start with `prefix`
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (prefix)
+    );
+"""
+
+# The lengths of the BNF code prefixes which identify chapters, sections,
+# paragraphs, chemicals and products
+PREFIX_LENGTHS = (2, 4, 6, 9, 11)
+
+
+def summarise_bnf_prefixes(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    summarise_bnf_prefixes_for_db(connection)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def summarise_bnf_prefixes_for_db(connection):
+    logger.info("Summing prescribing for each BNF code prefix")
+    cursor = connection.cursor()
+    cursor.execute("SAVEPOINT summarise_bnf_prefixes")
+    cursor.execute(SCHEMA_SQL)
+    results = connection.execute(
+        """
+        SELECT bnf_code, items, quantity, actual_cost, net_cost
+        FROM presentation
+        WHERE items IS NOT NULL
+        ORDER BY bnf_code
+        """
+    )
+    presentations = (
+        (bnf_code, list(map(deserialize, values))) for bnf_code, *values in results
+    )
+    count = 0
+    for prefix, totals, num_presentations in sum_by_prefix(
+        presentations, PREFIX_LENGTHS
+    ):
+        if num_presentations < 2:
+            continue
+        count += 1
+        values = [
+            serialize_compressed(finalise_matrix(csc_matrix(total))) for total in totals
+        ]
+        cursor.execute(
+            """
+            INSERT INTO bnf_prefix_summary
+              (prefix, items, quantity, actual_cost, net_cost)
+            VALUES
+              (?, ?, ?, ?, ?)
+            """,
+            [prefix] + values,
+        )
+    cursor.execute("RELEASE summarise_bnf_prefixes")
+    logger.info("Wrote totals for %s BNF code prefixes", count)
+
+
+def sum_by_prefix(presentations, prefix_lengths):
+    """
+    Accepts an iterable of (bnf_code, list of matrices) pairs, sorted by BNF
+    code, and yields tuples of the form:
+
+        prefix, list of summed matrices, number of presentations
+
+    for every prefix of the supplied lengths
+
+    Because presentations with a given prefix are contiguous when sorted by BNF
+    code we can calculate the totals for every prefix in a single pass, keeping
+    just one set of totals in progress for each prefix length.
+    """
+    # Maps each prefix length to a list of [prefix, MatrixSums, count]
+    in_progress = {}
+    for bnf_code, matrices in presentations:
+        for length in prefix_lengths:
+            if len(bnf_code) < length:
+                continue
+            prefix = bnf_code[:length]
+            current = in_progress.get(length)
+            if current is None or current[0] != prefix:
+                if current is not None:
+                    yield finish_totals(*current)
+                current = [prefix, [MatrixSum() for _ in matrices], 0]
+                in_progress[length] = current
+            for total, matrix in zip(current[1], matrices):
+                total.add(matrix)
+            current[2] += 1
+    for current in in_progress.values():
+        yield finish_totals(*current)
+
+
+def finish_totals(prefix, totals, num_presentations):
+    return prefix, [total.value() for total in totals], num_presentations
@@ -24,8 +24,16 @@ def update_bnf_map(sqlite_path):
     cursor = connection.cursor()
     bigquery_connection = Client("hscic")
     bnf_map = get_old_to_new_bnf_codes(bigquery_connection)
+    codes_with_prescribing = get_codes_with_prescribing(cursor)
     for old_code, new_code in bnf_map:
+        # The vast majority of codes in the map have no prescribing in any
+        # given file (and in incremental builds, codes in the previous file
+        # have already been mapped) so we only touch codes which are affected
+        if old_code not in codes_with_prescribing:
+            continue
         move_values_from_old_code_to_new(cursor, old_code, new_code)
+        codes_with_prescribing.discard(old_code)
+        codes_with_prescribing.add(new_code)
     # Until we've completed the BNF code update we don't know which
     # presentations actually have prescribing data, so we have to wait until
     # now to do this cleanup
@@ -43,6 +51,11 @@ def get_old_to_new_bnf_codes(bigquery_connection):
     return rows
 
 
+def get_codes_with_prescribing(cursor):
+    result = cursor.execute("SELECT bnf_code FROM presentation WHERE items IS NOT NULL")
+    return {bnf_code for (bnf_code,) in result}
+
+
 def move_values_from_old_code_to_new(cursor, old_code, new_code):
     """
     Move prescribing data stored under `old_code` to `new_code`
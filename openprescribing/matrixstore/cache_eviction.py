@@ -0,0 +1,131 @@
+"""
+Evicts values from the diskcache instance so that it stays within its size
+limit
+
+We disable diskcache's own culling because, being run synchronously after
+writes, it could lock up SQLite in the middle of a request (see the CACHES
+setting). Instead eviction happens out of band, via the
+`diskcache_garbage_collect` command, in small time-boxed batches so that it
+never holds the database for long.
+
+Values computed by `cachelib` from MatrixStore files other than the live one
+are evicted first as they won't be needed again (unless we roll back to an old
+file). After that, values are evicted in the order in which they were first
+stored until the cache is within its limit.
+"""
+import os.path
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from diskcache import DEFAULT_SETTINGS, DjangoCache
+
+from matrixstore.cachelib import KEY_PREFIX, get_generation_tag
+
+
+class CacheEvictor(object):
+    """
+    Evicts entries from a diskcache `FanoutCache` until its volume is below
+    `size_limit`, starting with those `cachelib` entries whose generation tag
+    doesn't match `live_generation_tag`
+
+    Work is done in calls to `run_batch` so that callers can pause between
+    batches to let other writers in.
+    """
+
+    def __init__(self, cache, size_limit, live_generation_tag, key_prefix):
+        self.cache = cache
+        self.size_limit = size_limit
+        self.live_generation_tag = live_generation_tag
+        self.key_prefix = key_prefix
+        self.entries_evicted = 0
+        self.bytes_reclaimed = 0
+        self._candidates = None
+
+    def run_batch(self, time_limit):
+        """
+        Evict entries for up to `time_limit` seconds, returning True if there's
+        nothing more to do
+        """
+        deadline = time.time() + time_limit
+        if self._candidates is None:
+            # This removes any expired entries (e.g. stale `cachelib` locks)
+            self.cache.expire()
+            self._candidates = self._iter_candidates()
+        start_volume = volume = self.cache.volume()
+        finished = False
+        while True:
+            if volume <= self.size_limit:
+                finished = True
+                break
+            if time.time() >= deadline:
+                break
+            key = next(self._candidates, None)
+            if key is None:
+                finished = True
+                break
+            if self.cache.delete(key):
+                self.entries_evicted += 1
+            volume = self.cache.volume()
+        # The volume can grow during the batch due to other writers
+        self.bytes_reclaimed += max(start_volume - volume, 0)
+        return finished
+
+    def _iter_candidates(self):
+        """
+        Yield keys in the order in which they should be evicted
+
+        Keys are fetched from the database in small batches as we go, so this
+        doesn't hold any locks between calls.
+        """
+        for key in self.cache:
+            if self._is_stale(key):
+                yield key
+        # Keys are iterated in the order they were first stored. Anything we've
+        # already deleted is just skipped over.
+        yield from self.cache
+
+    def _is_stale(self, key):
+        if not isinstance(key, str) or not key.startswith(self.key_prefix):
+            return False
+        generation_tag = key[len(self.key_prefix) :].split(":", 1)[0]
+        return generation_tag != "" and generation_tag != self.live_generation_tag
+
+
+def get_evictor(alias=None):
+    """
+    Return a CacheEvictor for the diskcache instance configured under `alias`
+    in CACHES (by default, the cache in which `cachelib` stores its values)
+    """
+    if alias is None:
+        alias = settings.CACHELIB_CACHE_ALIAS
+    django_cache = caches[alias]
+    if not is_diskcache(django_cache):
+        raise ValueError("Cache '{}' is not a diskcache instance".format(alias))
+    size_limit = (
+        settings.CACHES[alias]
+        .get("OPTIONS", {})
+        .get("size_limit", DEFAULT_SETTINGS["size_limit"])
+    )
+    # Keys in the underlying cache are transformed by Django, so we need to do
+    # the same to recognise those written by `cachelib`
+    key_prefix = django_cache.make_key(KEY_PREFIX)
+    return CacheEvictor(
+        # DjangoCache doesn't expose the FanoutCache it wraps
+        django_cache._cache,
+        size_limit=size_limit,
+        live_generation_tag=get_live_generation_tag(),
+        key_prefix=key_prefix,
+    )
+
+
+def is_diskcache(django_cache):
+    return isinstance(django_cache, DjangoCache)
+
+
+def get_live_generation_tag():
+    # This matches the `cache_key` given to the live file by
+    # `MatrixStore.from_file`
+    filename = os.path.basename(os.path.realpath(settings.MATRIXSTORE_LIVE_FILE))
+    return get_generation_tag(filename.encode("utf8"))
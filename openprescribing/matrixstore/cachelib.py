@@ -9,27 +9,83 @@ Provides a basic caching decorator with a few special features:
       should only be applied to functions whose output is purely determined by
       their arguments. If the logic of the function changes then the `version`
       argument can be incremented.
+
+    * Values can be stored in any Django cache backend. By default this is the
+      local diskcache, but setting `CACHELIB_CACHE_ALIAS` to a shared cache
+      (e.g. memcached, or Redis via django-redis) lets several app servers share
+      values rather than each computing its own copy. To make this work, keys
+      are short ASCII strings and values are encoded as bytes before they reach
+      the backend, with matrices (and tuples of matrices) written using the
+      MatrixStore serializer rather than pickle. Encoded values larger than
+      `CACHELIB_COMPRESSION_THRESHOLD` bytes are LZ4 compressed.
+
+    * Concurrent misses for the same key, whether in the same process or in
+      different processes sharing the cache, are coalesced so the value is
+      computed once and the other callers wait for the result (see
+      `SingleFlight`).
 """
 import functools
+import hashlib
+import logging
+import pickle
+import struct
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+import lz4.frame
+import numpy
+from scipy.sparse import csc_matrix
 
-from django.core.cache import cache as default_cache
+from matrixstore import serializer
+from matrixstore.connection import MatrixStore
 
 
+logger = logging.getLogger(__name__)
+
 MISSING = object()
 BASIC_TYPES = (bool, int, float, str)
 
+# All keys have the form "cachelib:<generation tag>:<hash of arguments>"
+KEY_PREFIX = "cachelib:"
+
+# Encoded values start with a header giving the kind of value and whether the
+# payload is compressed
+VALUE_HEADER = struct.Struct("<BB")
+MATRIX = 0
+MATRIX_TUPLE = 1
+PICKLE = 2
+LENGTH = struct.Struct("<q")
+
+# How often, in seconds, to check whether a value being computed by another
+# process has appeared in the cache
+LOCK_POLL_INTERVAL = 0.1
+
+
+def memoize(version=1, cache=None):
+    """
+    Memoize the decorated function in `cache` (a `Cache` instance) or, if not
+    supplied, the cache returned by `get_default_cache`
+    """
 
-def memoize(version=1, cache=default_cache):
     def decorator(func):
         cache_key_base = _get_cache_key_base(func, version)
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             cache_key = _get_cache_key(cache_key_base, args, kwargs)
-            result = cache.get(cache_key, default=MISSING)
+            target_cache = cache if cache is not None else get_default_cache()
+            result = target_cache.get(cache_key, default=MISSING)
             if result is MISSING:
-                result = func(*args, **kwargs)
-                cache.set(cache_key, result)
+                result = _single_flight.get_or_compute(
+                    target_cache,
+                    cache_key,
+                    functools.partial(func, *args, **kwargs),
+                    timeout=settings.CACHELIB_LOCK_TIMEOUT,
+                )
             return result
 
         return wrapper
@@ -37,14 +93,296 @@ def memoize(version=1, cache=default_cache):
     return decorator
 
 
+def get_default_cache():
+    return Cache(
+        caches[settings.CACHELIB_CACHE_ALIAS],
+        compression_threshold=settings.CACHELIB_COMPRESSION_THRESHOLD,
+    )
+
+
+class Cache(object):
+    """
+    Stores values in a Django cache backend, encoding them as bytes so that they
+    can be held in caches which only store strings (e.g. memcached or Redis)
+    """
+
+    def __init__(self, backend, compression_threshold=None):
+        self.backend = backend
+        self.compression_threshold = compression_threshold
+
+    def get(self, key, default=None):
+        data = self.backend.get(key)
+        if data is None:
+            return default
+        return decode_value(data)
+
+    def set(self, key, value):
+        data = encode_value(value, self.compression_threshold)
+        self.backend.set(key, data, timeout=None)
+
+    def acquire_lock(self, key, timeout):
+        """
+        Atomically create a lock entry which expires after `timeout` seconds,
+        returning a token identifying this holder of the lock if we got it, or
+        None if we didn't
+        """
+        token = uuid.uuid4().hex.encode("ascii")
+        if self.backend.add(key, token, timeout=timeout):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        """
+        Delete the lock entry, unless it has expired and been acquired by
+        someone else in the meantime
+
+        Django's cache API has no atomic compare-and-delete, so there's still a
+        small window between checking the token and deleting the entry, but the
+        lock would have to expire in exactly that window for this to matter.
+        """
+        if self.backend.get(key) == token:
+            self.backend.delete(key)
+
+
+def encode_value(value, compression_threshold=None):
+    """
+    Encode `value` as bytes, compressing the result if it's larger than
+    `compression_threshold` bytes
+    """
+    if _is_matrix(value):
+        kind = MATRIX
+        payload = serializer.serialize(value)
+    elif isinstance(value, tuple) and value and all(map(_is_matrix, value)):
+        kind = MATRIX_TUPLE
+        payload = b"".join(_encode_matrix_tuple(value))
+    else:
+        kind = PICKLE
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    compressed = (
+        compression_threshold is not None and len(payload) > compression_threshold
+    )
+    if compressed:
+        payload = lz4.frame.compress(payload)
+    return VALUE_HEADER.pack(kind, compressed) + payload
+
+
+def decode_value(data):
+    """
+    Decode a value previously encoded with `encode_value`
+    """
+    kind, compressed = VALUE_HEADER.unpack_from(data, 0)
+    payload = memoryview(data)[VALUE_HEADER.size :]
+    if compressed:
+        payload = lz4.frame.decompress(payload, return_bytearray=True)
+    else:
+        # Matrices share memory with the buffer they're decoded from and would
+        # otherwise be read-only, unlike the values the function returned
+        payload = bytearray(payload)
+    if kind == MATRIX:
+        return serializer.deserialize(payload)
+    elif kind == MATRIX_TUPLE:
+        return tuple(_decode_matrix_tuple(payload))
+    elif kind == PICKLE:
+        return pickle.loads(payload)
+    else:
+        raise ValueError("Unknown cached value kind: {}".format(kind))
+
+
+def _is_matrix(value):
+    # The serializer only records the dtype string, which loses the fields of
+    # structured arrays, so we only handle plain numeric arrays here
+    return isinstance(value, csc_matrix) or (
+        isinstance(value, numpy.ndarray)
+        and not isinstance(value, numpy.matrix)
+        and value.ndim > 0
+        and value.dtype.kind in "biufc"
+    )
+
+
+def _encode_matrix_tuple(matrices):
+    for matrix in matrices:
+        data = serializer.serialize(matrix)
+        yield LENGTH.pack(len(data))
+        yield data
+
+
+def _decode_matrix_tuple(payload):
+    buf = memoryview(payload)
+    offset = 0
+    while offset < len(buf):
+        length = LENGTH.unpack_from(buf, offset)[0]
+        offset += LENGTH.size
+        yield serializer.deserialize(buf[offset : offset + length])
+        offset += length
+
+
+class SingleFlight(object):
+    """
+    Ensures that, of any concurrent attempts to compute the same missing value,
+    only one does the work while the rest wait for and share its result
+
+    Callers within a process wait on the thread doing the computation. Callers
+    in different processes (or on different servers sharing the cache) are
+    coordinated via a lock entry in the cache itself: whichever process manages
+    to add the lock computes the value, while the others poll the cache until
+    it appears.
+
+    Waiters give up after `timeout` seconds and compute the value themselves, so
+    a slow or crashed computation can delay other callers but never block them
+    indefinitely. For the same reason locks expire after `timeout` seconds.
+
+    Counts of how often callers had to wait, and for how long, are available
+    via `stats()`.
+    """
+
+    def __init__(self, poll_interval=LOCK_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            [
+                "computed",
+                "coalesced",
+                "lock_waits",
+                "lock_wait_seconds",
+                "timeouts",
+            ],
+            0,
+        )
+
+    def get_or_compute(self, cache, key, func, timeout):
+        """
+        Return the value stored in `cache` under `key`, calling `func` to
+        compute and store it if necessary
+        """
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = self._in_flight[key] = _InFlightCall()
+            else:
+                in_flight.waiters += 1
+        if not is_leader:
+            return self._wait_for_in_flight(in_flight, cache, key, func, timeout)
+        try:
+            in_flight.result = self._get_or_compute_with_lock(cache, key, func, timeout)
+        except BaseException as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+        return in_flight.result
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _wait_for_in_flight(self, in_flight, cache, key, func, timeout):
+        start = time.time()
+        finished = in_flight.done.wait(timeout)
+        self._record(coalesced=1, lock_wait_seconds=time.time() - start)
+        if not finished:
+            logger.warning("Timed out waiting for %s to be computed", key)
+            self._record(timeouts=1)
+            return self._compute(cache, key, func)
+        return in_flight.get_result()
+
+    def _get_or_compute_with_lock(self, cache, key, func, timeout):
+        lock_key = "{}:lock".format(key)
+        start = time.time()
+        waited = False
+        while True:
+            # Another process may have stored the value since we last looked
+            result = cache.get(key, default=MISSING)
+            if result is not MISSING:
+                break
+            lock_token = cache.acquire_lock(lock_key, timeout)
+            if lock_token is not None:
+                try:
+                    result = self._compute(cache, key, func)
+                finally:
+                    cache.release_lock(lock_key, lock_token)
+                break
+            if time.time() - start >= timeout:
+                logger.warning("Timed out waiting for lock on %s", key)
+                self._record(timeouts=1)
+                result = self._compute(cache, key, func)
+                break
+            waited = True
+            time.sleep(self.poll_interval)
+        if waited:
+            self._record(lock_waits=1, lock_wait_seconds=time.time() - start)
+        return result
+
+    def _compute(self, cache, key, func):
+        result = func()
+        cache.set(key, result)
+        self._record(computed=1)
+        return result
+
+    def _record(self, **increments):
+        with self._stats_lock:
+            for name, increment in increments.items():
+                self._stats[name] += increment
+
+
+class _InFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+    def get_result(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+_single_flight = SingleFlight()
+
+
+def get_stats():
+    """
+    Return counts of values computed by this process and of how often (and for
+    how long in total) callers waited for values being computed elsewhere
+    """
+    return _single_flight.stats()
+
+
 def _get_cache_key_base(func, version):
     return "{}.{}:{}".format(func.__module__, func.__qualname__, version)
 
 
 def _get_cache_key(base, args, kwargs):
+    generation = _get_generation(list(args) + list(kwargs.values()))
     args = list(map(_get_object_cache_key, args))
     kwargs = [(k, _get_object_cache_key(v)) for (k, v) in sorted(kwargs.items())]
-    return base, args, kwargs
+    # Keys must be short strings without spaces to be usable with memcached, so
+    # we use a hash of the repr (which is stable for all the types we allow)
+    key_hash = hashlib.sha256(repr((base, args, kwargs)).encode("utf8")).hexdigest()
+    return "{}{}:{}".format(KEY_PREFIX, generation, key_hash)
+
+
+def _get_generation(values):
+    # Record which MatrixStore file (if any) the value was computed from so
+    # that values belonging to files which are no longer live can be evicted
+    # first (see `matrixstore.cache_eviction`)
+    for value in values:
+        if isinstance(value, MatrixStore):
+            return get_generation_tag(value.cache_key)
+    return ""
+
+
+def get_generation_tag(matrixstore_cache_key):
+    """
+    Return the tag which appears in the keys of all values computed from the
+    MatrixStore file with the supplied `cache_key`
+    """
+    return hashlib.sha256(matrixstore_cache_key).hexdigest()[:16]
 
 
 def _get_object_cache_key(value):
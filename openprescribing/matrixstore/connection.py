@@ -2,8 +2,12 @@ import os.path
 import sqlite3
 import urllib.parse
 
+import numpy
+from scipy.sparse import csc_matrix
+
+from .matrix_ops import get_submatrix
 from .serializer import deserialize
-from .sql_functions import MatrixSum
+from .sql_functions import MatrixSum, sum_rows
 
 
 class MatrixStore(object):
@@ -28,6 +32,25 @@ class MatrixStore(object):
         )
         self.dates = sorted_keys(self.date_offsets)
         self.practices = sorted_keys(self.practice_offsets)
+        # Files built with the `--date-chunks` option contain an additional
+        # table holding each presentation's data split up by month
+        self.has_date_chunks = table_exists(self.connection, "presentation_date_chunk")
+        # Files built with the `--org-aggregates` option contain prescribing and
+        # practice statistics pre-grouped by org type (see `org_aggregates`).
+        # This maps each org type to the `cache_key` of the grouping used.
+        if table_exists(self.connection, "org_aggregate_grouper"):
+            self.org_aggregate_keys = dict(
+                self.connection.execute(
+                    "SELECT org_type, cache_key FROM org_aggregate_grouper"
+                )
+            )
+        else:
+            self.org_aggregate_keys = {}
+        # Files built with the `--bnf-prefix-summary` option contain
+        # precalculated totals for each BNF code prefix (see `bnf_prefixes`)
+        self.has_bnf_prefix_summary = table_exists(
+            self.connection, "bnf_prefix_summary"
+        )
         self.connection.create_aggregate("MATRIX_SUM", 1, MatrixSum)
 
     @classmethod
@@ -60,10 +83,88 @@ class MatrixStore(object):
     def query_one(self, sql, params=()):
         return next(self.query(sql, params=params))
 
+    def sum_matrices(self, sql, params=(), workers=1):
+        """
+        Return a list giving the sum of each column of matrices returned by
+        `sql`, or None for any column which has no values
+
+        This is equivalent to wrapping each selected column in `MATRIX_SUM`, but
+        with more than one worker the matrices are deserialized in a pool of
+        threads (see `sql_functions.sum_rows`).
+        """
+        cursor = self.connection.cursor().execute(sql, params)
+        return sum_rows(cursor, len(cursor.description), workers=workers)
+
+    def query_presentations_at_date(self, bnf_codes, date):
+        """
+        Yield the quantity and net cost prescribed on a single date for each of
+        the supplied BNF codes as tuples of the form:
+
+            bnf_code, quantity_matrix, net_cost_matrix
+
+        where the matrices have a single column. BNF codes which don't exist in
+        the file are skipped. Raises KeyError if there's no data for `date`.
+
+        Where the file contains single-month chunks we read just the chunk we
+        need, otherwise we fall back to slicing the full matrices.
+        """
+        date_offset = self.date_offsets[date]
+        placeholders = ",".join("?" * len(bnf_codes))
+        if not self.has_date_chunks:
+            date_slice = slice(date_offset, date_offset + 1)
+            results = self.query(
+                """
+                SELECT bnf_code, quantity, net_cost FROM presentation
+                WHERE bnf_code IN ({})
+                """.format(
+                    placeholders
+                ),
+                bnf_codes,
+            )
+            for bnf_code, quantity, net_cost in results:
+                yield (
+                    bnf_code,
+                    get_submatrix(quantity, cols=date_slice),
+                    get_submatrix(net_cost, cols=date_slice),
+                )
+            return
+        results = self.query(
+            """
+            SELECT
+              presentation.bnf_code, chunk.quantity, chunk.net_cost
+            FROM
+              presentation
+            LEFT JOIN
+              presentation_date_chunk AS chunk
+            ON
+              chunk.bnf_code = presentation.bnf_code AND chunk.date_offset = ?
+            WHERE
+              presentation.bnf_code IN ({})
+            """.format(
+                placeholders
+            ),
+            [date_offset] + list(bnf_codes),
+        )
+        for bnf_code, quantity, net_cost in results:
+            # Chunks are omitted for months with no prescribing
+            if quantity is None:
+                shape = (len(self.practices), 1)
+                quantity = csc_matrix(shape, dtype=numpy.float_)
+                net_cost = csc_matrix(shape, dtype=numpy.int_)
+            yield bnf_code, quantity, net_cost
+
     def close(self):
         self.connection.close()
 
 
+def table_exists(connection, table_name):
+    results = connection.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?",
+        [table_name],
+    )
+    return results.fetchone()[0] > 0
+
+
 def sorted_keys(dictionary):
     sorted_items = sorted(dictionary.items(), key=lambda item: item[1])
     return [key for (key, value) in sorted_items]
@@ -2,31 +2,285 @@
 This module provides the primary interface between the MatrixStore and the rest
 of the application.
 
-It makes use of the assumption that data is static throughout the runtime of
-the application and therefore any data imports or updates will require an
-application restart before they take effect.
+Data in any given MatrixStore file is static, but the file which is "live" can
+change underneath a running application when `matrixstore_set_live` updates the
+symlink at `MATRIXSTORE_LIVE_FILE`. Each file we open is wrapped in a
+`Generation` which owns the connection plus anything memoized against it (e.g.
+row groupers), which is held in the shared, size-bounded memory cache (see
+`matrixstore.memory_cache`). Requests pin the current generation for their duration (see
+`matrixstore.middleware`) so they never see a mix of files; when the symlink
+changes, new requests get the new generation while the old one is closed once
+its last in-flight request has finished.
+
+Note that changes to org relationships in the database are only picked up when
+a new generation is loaded.
 """
+import contextlib
+import functools
+import os.path
+import threading
+
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
 from frontend.models import Practice
 
 from .connection import MatrixStore
+from .memory_cache import MISSING, get_default_cache
 from .row_grouper import RowGrouper
 
 
-# Create a memoize decorator (i.e. a decorator which caches the return value
-# for a given set of arguments). Here `maxsize=None` means "don't apply any
-# cache eviction, just keep values for ever"
-memoize = lru_cache(maxsize=None)
+class Generation(object):
+    """
+    Holds an open MatrixStore file and tracks how many requests are currently
+    using it
+
+    Values memoized against a generation are keyed on it in the memory cache
+    and are discarded when it is closed, along with any resources registered
+    with `add_resource`.
+    """
+
+    def __init__(self, path, db):
+        self.path = path
+        self.db = db
+        self.active_requests = 0
+        self.retired = False
+        self._resources = []
+        self._lock = threading.Lock()
+
+    def add_resource(self, resource):
+        """
+        Register `resource` (anything with a `close` method) to be closed when
+        this generation is closed
+        """
+        with self._lock:
+            self._resources.append(resource)
+
+    def acquire(self):
+        with self._lock:
+            self.active_requests += 1
+
+    def release(self):
+        with self._lock:
+            self.active_requests -= 1
+            should_close = self.retired and self.active_requests == 0
+        if should_close:
+            self.close()
+
+    def retire(self):
+        """
+        Mark this generation as superseded, closing it immediately if there are
+        no in-flight requests or otherwise once the last of them is released
+        """
+        with self._lock:
+            self.retired = True
+            should_close = self.active_requests == 0
+        if should_close:
+            self.close()
+
+    def close(self):
+        get_default_cache().delete_matching(lambda key: key[0] is self)
+        with self._lock:
+            resources, self._resources = self._resources, []
+        for resource in resources:
+            resource.close()
+        self.db.close()
+
+
+_current_generation = None
+_generation_lock = threading.Lock()
+_pinned = threading.local()
+
+
+def _get_live_path():
+    # Resolve the symlink so that we can tell when it has been repointed
+    return os.path.realpath(settings.MATRIXSTORE_LIVE_FILE)
+
+
+def _load_generation(check_for_new_file=False):
+    """
+    Return the current generation, loading it if it doesn't yet exist
+
+    If `check_for_new_file` is set then also check whether the live symlink now
+    points to a different file and, if so, open that file and switch to it.
+    """
+    global _current_generation
+    generation = _current_generation
+    if generation is not None and not check_for_new_file:
+        return generation
+    path = _get_live_path()
+    if generation is not None and generation.path == path:
+        return generation
+    with _generation_lock:
+        # Another thread may have loaded the file while we waited on the lock
+        generation = _current_generation
+        if generation is not None and (
+            generation.path == path or not check_for_new_file
+        ):
+            return generation
+        # Open the new file alongside the old one so that the switch itself is
+        # just a single assignment
+        new_generation = Generation(path, MatrixStore.from_file(path))
+        _current_generation = new_generation
+    if generation is not None:
+        generation.retire()
+    return new_generation
+
+
+class _PinnedScope(object):
+    """
+    The state of a `pinned_generation` scope: the generation it has pinned, if
+    anything within it has used the MatrixStore yet
+    """
+
+    generation = None
+
+
+def _get_generation():
+    scope = getattr(_pinned, "scope", None)
+    if scope is None:
+        return _load_generation()
+    if scope.generation is None:
+        # This is the first use of the MatrixStore within the scope
+        generation = _load_generation(check_for_new_file=True)
+        generation.acquire()
+        scope.generation = generation
+    return scope.generation
+
+
+@contextlib.contextmanager
+def pinned_generation():
+    """
+    Context manager which ensures that all calls to `get_db` (and anything
+    memoized against it) within its scope use the same MatrixStore file, and
+    which prevents that file from being closed until the scope is exited
+
+    The generation is pinned lazily: the first use of the MatrixStore within
+    the scope checks whether the live file has changed (switching to the new
+    one if so) and pins the resulting generation. Scopes which never use the
+    MatrixStore don't touch the file at all, so they work even where it doesn't
+    exist yet. Yields the scope, whose `generation` attribute is the pinned
+    generation (or None) once the scope's work is done. Nested uses just reuse
+    the outer scope.
+    """
+    scope = getattr(_pinned, "scope", None)
+    if scope is not None:
+        yield scope
+        return
+    scope = _pinned.scope = _PinnedScope()
+    try:
+        yield scope
+    finally:
+        _pinned.scope = None
+        if scope.generation is not None:
+            scope.generation.release()
+
+
+class PinnedIterator(object):
+    """
+    Wraps an iterator so that each value is produced with `generation` pinned,
+    and keeps that generation open until the iterator is exhausted or closed
+
+    This is needed for streaming responses whose content is only generated
+    after the view (and so the scope of `pinned_generation`) has returned.
+    """
+
+    def __init__(self, iterable, generation):
+        self.generation = generation
+        self.generation.acquire()
+        self.iterator = iter(iterable)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        previous = getattr(_pinned, "scope", None)
+        scope = _pinned.scope = _PinnedScope()
+        scope.generation = self.generation
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.close()
+            raise
+        finally:
+            _pinned.scope = previous
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if hasattr(self.iterator, "close"):
+            self.iterator.close()
+        self.generation.release()
+
+
+def clear_cache():
+    """
+    Discard the current generation (closing its file if it's not in use) so
+    that the next access re-opens the live file
+    """
+    global _current_generation
+    with _generation_lock:
+        generation = _current_generation
+        _current_generation = None
+    if generation is not None:
+        generation.retire()
+
+
+def memoize(func):
+    """
+    Memoize the return value of `func` for each set of (hashable) arguments for
+    the lifetime of the current MatrixStore generation
+
+    Values are stored in the shared memory cache and so may be evicted (and
+    later recalculated) if the cache is over its size budget.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        cache = get_default_cache()
+        key = (_get_generation(), wrapper, args)
+        value = cache.get(key, MISSING)
+        if value is MISSING:
+            value = func(*args)
+            cache.set(key, value)
+        return value
+
+    def cache_clear():
+        get_default_cache().delete_matching(
+            lambda key: len(key) == 3 and key[1] is wrapper
+        )
+
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+
+def close_with_generation(resource):
+    """
+    Close `resource` (anything with a `close` method) when the current
+    generation is closed, and return it
+
+    This is for connections opened by memoized functions: we can't close these
+    when the memoized value is evicted from the cache as they may still be in
+    use, but they mustn't outlive the MatrixStore file they belong to.
+    """
+    _get_generation().add_resource(resource)
+    return resource
 
 
-@memoize
 def get_db():
     """
-    Return a singleton instance of the current live version of the MatrixStore
+    Return the instance of the live version of the MatrixStore for the current
+    generation
+    """
+    return _get_generation().db
+
+
+def get_db_path():
+    """
+    Return the path of the MatrixStore file for the current generation
     """
-    return MatrixStore.from_file(settings.MATRIXSTORE_LIVE_FILE)
+    return _get_generation().path
 
 
 def org_has_prescribing(org_type, org_id):
@@ -50,13 +304,24 @@ def get_row_grouper(org_type):
     Return a "row grouper" function which will group the rows of a practice
     level matrix by the supplied `org_type`
 
-    Note that the function is memoized so that if org relationships are changed
-    in the database then the application will need to be restarted to see the
-    changes.
+    Note that the function is memoized per generation so that if org
+    relationships are changed in the database they won't be seen until a new
+    MatrixStore file goes live (or the application is restarted).
+    """
+    return build_row_grouper(org_type, get_db().practice_offsets)
+
+
+def build_row_grouper(org_type, practice_offsets):
+    """
+    Return a row grouper for `org_type` given a mapping of practice codes to
+    their row offsets
+
+    This lets us build row groupers for files other than the live one (e.g.
+    during the build process).
     """
     # Get the mapping from practice codes to IDs of groups
     if org_type == "practice":
-        mapping = _practice_to_practice_map()
+        mapping = _practice_to_practice_map(practice_offsets)
     elif org_type == "standard_practice":
         mapping = _practice_to_standard_practice_map()
     elif org_type == "ccg":
@@ -70,26 +335,23 @@ def get_row_grouper(org_type):
     elif org_type == "regional_team":
         mapping = _practice_to_regional_team_map()
     elif org_type == "all_practices":
-        mapping = _group_all(_practice_to_practice_map())
+        mapping = _group_all(_practice_to_practice_map(practice_offsets))
     elif org_type == "all_standard_practices":
         mapping = _group_all(_practice_to_standard_practice_map())
     else:
         raise ValueError("Unhandled org_type: " + org_type)
     return RowGrouper(
         (offset, mapping[practice_code])
-        for practice_code, offset in get_db().practice_offsets.items()
+        for practice_code, offset in practice_offsets.items()
         if practice_code in mapping
     )
 
 
-def _practice_to_practice_map():
+def _practice_to_practice_map(practice_offsets):
     # For practice level data we just map each practice code to itself. This
     # means that we're not really doing any "grouping" in a meaningful sense,
     # but it simplifies the code by keeping things consistent.
-    return {
-        practice_code: practice_code
-        for practice_code in get_db().practice_offsets.keys()
-    }
+    return {practice_code: practice_code for practice_code in practice_offsets.keys()}
 
 
 def _practice_to_standard_practice_map():
@@ -7,7 +7,7 @@ import os
 import sqlite3
 
 from django.conf import settings
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
 from matrixstore.build.common import get_temp_filename
 from matrixstore.build.dates import DEFAULT_NUM_MONTHS
@@ -16,8 +16,15 @@ from matrixstore.build.download_practice_stats import download_practice_stats
 from matrixstore.build.import_practice_stats import import_practice_stats
 from matrixstore.build.download_prescribing import download_prescribing
 from matrixstore.build.import_prescribing import import_prescribing
+from matrixstore.build.import_prescribing_incrementally import (
+    get_dates_to_import,
+    import_prescribing_incrementally,
+)
 from matrixstore.build.update_bnf_map import update_bnf_map
 from matrixstore.build.precalculate_totals import precalculate_totals
+from matrixstore.build.chunk_by_date import chunk_by_date
+from matrixstore.build.precalculate_org_aggregates import precalculate_org_aggregates
+from matrixstore.build.summarise_bnf_prefixes import summarise_bnf_prefixes
 from matrixstore.build.generate_filename import generate_filename
 
 
@@ -36,14 +43,80 @@ class Command(BaseCommand):
             ),
             default=DEFAULT_NUM_MONTHS,
         )
+        parser.add_argument(
+            "--date-chunks",
+            help=(
+                "Additionally store quantity and net_cost split into single-month "
+                "chunks for faster single-date queries"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--org-aggregates",
+            help=(
+                "Additionally store prescribing and practice statistics "
+                "pre-grouped by org for the most commonly requested queries"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--bnf-prefix-summary",
+            help=(
+                "Additionally store totals for every BNF chapter, section, "
+                "paragraph, chemical and product for faster prefix queries"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--workers",
+            help=(
+                "Number of processes to use when building prescribing matrices, "
+                "and threads to use when summing them (default: 1). Not "
+                "supported with --incremental-from"
+            ),
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--incremental-from",
+            help=(
+                "Path to a previously built MatrixStore file whose prescribing "
+                "data should be reused, so that only months it doesn't contain "
+                "need importing"
+            ),
+        )
         parser.add_argument(
             "--quiet", help="Don't emit logging output", action="store_true"
         )
 
-    def handle(self, end_date, months=None, quiet=False, **kwargs):
+    def handle(
+        self,
+        end_date,
+        months=None,
+        date_chunks=False,
+        org_aggregates=False,
+        bnf_prefix_summary=False,
+        workers=1,
+        incremental_from=None,
+        quiet=False,
+        **kwargs
+    ):
+        # The incremental import merges the previous file's matrices with the
+        # new months in a single pass, so there's nothing to split between
+        # workers
+        if incremental_from and workers > 1:
+            raise CommandError("--workers can't be used with --incremental-from")
         log_level = "INFO" if not quiet else "ERROR"
         with LogToStream("matrixstore", self.stdout, log_level):
-            return build(end_date, months=months)
+            return build(
+                end_date,
+                months=months,
+                date_chunks=date_chunks,
+                org_aggregates=org_aggregates,
+                bnf_prefix_summary=bnf_prefix_summary,
+                workers=workers,
+                incremental_from=incremental_from,
+            )
 
 
 class LogToStream(object):
@@ -73,16 +146,41 @@ class LogToStream(object):
         self.logger.removeHandler(self.handler)
 
 
-def build(end_date, months=None):
+def build(
+    end_date,
+    months=None,
+    date_chunks=False,
+    org_aggregates=False,
+    bnf_prefix_summary=False,
+    workers=1,
+    incremental_from=None,
+):
     directory = settings.MATRIXSTORE_BUILD_DIR
     sqlite_temp = get_temp_filename(os.path.join(directory, "matrixstore.sqlite"))
     init_db(end_date, sqlite_temp, months=months)
     download_practice_stats(end_date, months=months)
     import_practice_stats(sqlite_temp)
-    download_prescribing(end_date, months=months)
-    import_prescribing(sqlite_temp)
-    update_bnf_map(sqlite_temp)
-    precalculate_totals(sqlite_temp)
+    if incremental_from:
+        # We only need prescribing data for the months at the end of the range
+        # which aren't in the previous file
+        dates_to_import = get_dates_to_import(sqlite_temp, incremental_from)
+        if dates_to_import:
+            download_prescribing(end_date, months=len(dates_to_import))
+        import_prescribing_incrementally(sqlite_temp, incremental_from)
+        update_bnf_map(sqlite_temp)
+        # Totals get updated as part of the incremental import so there's no
+        # need to recalculate them here
+    else:
+        download_prescribing(end_date, months=months)
+        import_prescribing(sqlite_temp, workers=workers)
+        update_bnf_map(sqlite_temp)
+        precalculate_totals(sqlite_temp, workers=workers)
+    if date_chunks:
+        chunk_by_date(sqlite_temp)
+    if org_aggregates:
+        precalculate_org_aggregates(sqlite_temp)
+    if bnf_prefix_summary:
+        summarise_bnf_prefixes(sqlite_temp)
     vacuum_database(sqlite_temp)
     basename = generate_filename(sqlite_temp)
     filename = os.path.join(directory, basename)
@@ -45,8 +45,8 @@ class Command(BaseCommand):
         os.symlink(target_file, temp_file)
         os.rename(temp_file, symlink)
         self.stdout.write(
-            "NOTE: You will need to restart the application in order for this "
-            "change to take effect"
+            "NOTE: Running application processes will switch to this file at "
+            "the start of their next request"
         )
 
 
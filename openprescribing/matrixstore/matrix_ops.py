@@ -13,6 +13,41 @@ def sparse_matrix(shape, integer=False):
     return scipy.sparse.lil_matrix(shape, dtype=dtype)
 
 
+def sparse_matrix_from_values(shape, rows, columns, values, integer=False):
+    """
+    Create a new sparse matrix (either integer or floating point) containing
+    `values` at the supplied row and column offsets, in a form suitable for
+    passing to `finalise_matrix`
+
+    This gives the same result as assigning each value into a `sparse_matrix`
+    one at a time (so where a position appears more than once the last value
+    wins) but is very much faster as it's done in a single vectorised
+    operation.
+    """
+    dtype = numpy.int_ if integer else numpy.float_
+    rows = numpy.asarray(rows, dtype=numpy.int_)
+    columns = numpy.asarray(columns, dtype=numpy.int_)
+    values = numpy.asarray(values, dtype=dtype)
+    positions = rows * shape[1] + columns
+    # COO matrices sum duplicate entries, so we need to drop all but the last
+    # occurrence of any repeated position. Our input is usually already sorted
+    # without duplicates so we can skip the expensive check in that case.
+    if not numpy.all(positions[1:] > positions[:-1]):
+        # `numpy.unique` gives us the index of the first occurrence of each
+        # value, so to get the last we search the reversed array
+        _, reversed_indices = numpy.unique(positions[::-1], return_index=True)
+        last_indices = len(positions) - 1 - reversed_indices
+        rows = rows[last_indices]
+        columns = columns[last_indices]
+        values = values[last_indices]
+    matrix = scipy.sparse.coo_matrix((values, (rows, columns)), shape=shape)
+    matrix = matrix.tocsc()
+    # Assigning zero into a sparse matrix doesn't store anything, so we get rid
+    # of any explicitly stored zeros here to match that behaviour
+    matrix.eliminate_zeros()
+    return matrix
+
+
 def finalise_matrix(matrix):
     """
     Return a copy of a sparse matrix in a form suitable for storage
@@ -148,3 +183,18 @@ def get_submatrix(matrix, rows=slice(None, None), cols=slice(None, None)):
     new_matrix.indptr = indptr
     new_matrix._shape = shape
     return new_matrix
+
+
+def get_cells(matrix, rows, cols):
+    """
+    Return a dense ndarray containing the values at the intersection of each
+    of the supplied row offsets with each of the supplied column offsets
+
+    This lets us pull out all the values we need from a matrix in a single
+    operation, rather than indexing into it once for every value.
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int_)
+    cols = numpy.asarray(cols, dtype=numpy.int_)
+    if scipy.sparse.issparse(matrix):
+        return matrix.tocsr()[rows][:, cols].toarray()
+    return matrix[numpy.ix_(rows, cols)]
@@ -0,0 +1,176 @@
+"""
+Provides a bounded, in-process LRU cache shared by everything in the
+application which memoizes values in memory
+
+Unlike `functools.lru_cache`, which bounds the number of entries, this bounds
+the total (approximate) size of the cached values in bytes. Each gunicorn
+worker holds its own copy of the cache so bounding its size means we can
+predict how much memory each worker will use. Once the budget is exceeded the
+least recently used values are evicted.
+
+The size of each value is estimated by `get_size` which counts the actual
+buffer sizes of any numpy arrays and sparse matrices it contains, rather than
+just the size of the Python objects which wrap them.
+
+The budget is set by `settings.MEMORY_CACHE_MAX_BYTES`. Stats on cache hits,
+misses and evictions are available via `get_default_cache().stats()`.
+"""
+from collections import OrderedDict
+import functools
+import sys
+import threading
+
+from django.conf import settings
+
+import numpy
+import scipy.sparse
+
+
+MISSING = object()
+
+
+class MemoryCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Maps keys to (value, size) pairs, in order from least to most
+        # recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = get_size(value)
+        with self._lock:
+            self._remove(key)
+            # There's no point caching something which would evict everything
+            # else and still not fit
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def delete_matching(self, predicate):
+        """
+        Remove all entries whose keys match `predicate`
+        """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = MemoryCache(settings.MEMORY_CACHE_MAX_BYTES)
+    return _default_cache
+
+
+def memoize(func):
+    """
+    Memoize the return value of `func` for each set of (hashable) arguments in
+    the shared memory cache
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        cache = get_default_cache()
+        key = (wrapper, args)
+        value = cache.get(key, MISSING)
+        if value is MISSING:
+            value = func(*args)
+            cache.set(key, value)
+        return value
+
+    def cache_clear():
+        get_default_cache().delete_matching(lambda key: key[0] is wrapper)
+
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+
+def get_size(obj):
+    """
+    Return the approximate number of bytes of memory used by `obj` and
+    everything it references
+
+    Objects referenced more than once are only counted once.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, numpy.ndarray):
+            # Arrays which don't own their data (e.g. views, or arrays wrapping
+            # a deserialized buffer) get counted via the object which does so
+            # that data shared between arrays is only counted once
+            if obj.base is None:
+                size += obj.nbytes
+            else:
+                stack.append(obj.base)
+            continue
+        if isinstance(obj, memoryview):
+            stack.append(obj.obj)
+            continue
+        if scipy.sparse.issparse(obj):
+            stack.extend(vars(obj).values())
+            continue
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float, bool, type(None), type)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+    return size
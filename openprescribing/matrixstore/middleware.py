@@ -0,0 +1,27 @@
+from matrixstore.db import PinnedIterator, pinned_generation
+
+
+class PinMatrixStoreGenerationMiddleware(object):
+    """
+    Ensures that each request sees a single, consistent version of the
+    MatrixStore even if the live file changes while it is being handled, and
+    picks up any such change at the start of the next request
+
+    Nothing is loaded for requests which don't use the MatrixStore. For
+    streaming responses which do, the pinning extends to generating the
+    response content, which happens after the view has returned.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with pinned_generation() as scope:
+            response = self.get_response(request)
+            # Streaming responses which never used the MatrixStore (e.g. the
+            # Drug Tariff) don't need to keep a generation open
+            if response.streaming and scope.generation is not None:
+                response.streaming_content = PinnedIterator(
+                    response.streaming_content, scope.generation
+                )
+            return response
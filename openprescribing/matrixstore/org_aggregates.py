@@ -0,0 +1,79 @@
+"""
+Provides access to prescribing and practice statistics which have been grouped
+by organisation at build time (see `matrixstore.build.precalculate_org_aggregates`)
+
+Many of our most heavily used API calls need the total prescribing over all
+presentations, or over a whole BNF chapter, section or paragraph, grouped by
+CCG, STP or similar. Rather than load the practice level matrices and group
+them on every request we can read the small, pre-grouped matrix directly.
+
+The aggregates are only valid for the practice-to-org mapping in force when
+the file was built, so we record the `cache_key` of each org type's RowGrouper
+alongside them and only use them if it matches the current RowGrouper. If org
+relationships have changed since the file was built we just fall back to
+grouping at runtime.
+"""
+from .db import get_row_grouper
+
+
+# Org types for which we precalculate aggregates
+ORG_TYPES = ["ccg", "pcn", "stp", "regional_team", "all_practices"]
+
+# The lengths of BNF code prefixes which identify chapters, sections and
+# paragraphs
+BNF_PREFIX_LENGTHS = (2, 4, 6)
+
+# Identifies the aggregates over all presentations
+ALL_PRESENTATIONS = "all_presentations"
+
+
+def has_aggregates(db, org_type):
+    """
+    Return whether `db` contains aggregates for `org_type` which match the
+    current practice-to-org mapping
+    """
+    if org_type not in db.org_aggregate_keys:
+        return False
+    return db.org_aggregate_keys[org_type] == get_row_grouper(org_type).cache_key
+
+
+def get_prescribing_source(bnf_code_prefixes):
+    """
+    Return the identifier under which aggregates of prescribing matching the
+    supplied BNF code prefixes are stored, or None if we don't store such
+    aggregates
+    """
+    if not bnf_code_prefixes:
+        return ALL_PRESENTATIONS
+    if len(bnf_code_prefixes) == 1 and len(bnf_code_prefixes[0]) in BNF_PREFIX_LENGTHS:
+        return bnf_code_prefixes[0]
+    return None
+
+
+def get_prescribing_aggregates(db, org_type, bnf_code_prefixes):
+    """
+    Return items, quantity and actual_cost (in pence) matrices giving the
+    totals for all prescribing matching the supplied BNF code prefixes, already
+    grouped by `org_type`
+
+    Returns None if there are no suitable aggregates, in which case the caller
+    should calculate the values itself. If there are suitable aggregates but no
+    prescribing matches the prefixes then all three matrices are None.
+    """
+    source = get_prescribing_source(bnf_code_prefixes)
+    if source is None or not has_aggregates(db, org_type):
+        return None
+    results = list(
+        db.query(
+            """
+            SELECT items, quantity, actual_cost FROM prescribing_by_org
+            WHERE org_type = ? AND source = ?
+            """,
+            [org_type, source],
+        )
+    )
+    # We store aggregates for every prefix which has prescribing, so no
+    # results means no prescribing
+    if not results:
+        return None, None, None
+    return results[0]
@@ -0,0 +1,19 @@
+from collections import deque
+
+
+def map_in_order(executor, function, items, max_pending):
+    """
+    Like `executor.map` but only reads a new item from `items` once there are
+    fewer than `max_pending` results waiting to be consumed, so the input is
+    never read far ahead of the output
+
+    `executor` can be any `concurrent.futures.Executor`, so this works with
+    pools of either threads or processes.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
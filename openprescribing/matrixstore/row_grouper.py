@@ -4,6 +4,14 @@ import hashlib
 import numpy
 import scipy.sparse
 
+from .matrix_ops import is_integer
+
+
+# When summing dense matrices over at most this many groups we sum each group
+# separately, as this is faster than a sparse matrix product for small numbers
+# of groups (see `benchmark.benchmark_row_grouper`)
+MAX_GROUPS_FOR_LOOPING = 16
+
 
 class RowGrouper(object):
     """
@@ -65,10 +73,19 @@ class RowGrouper(object):
             )
         else:
             self._single_row_groups_selector = None
+        # Sparse matrices recording which rows belong to which groups, built on
+        # demand for each combination of row count and result type (see
+        # `_get_membership_matrix`)
+        self._membership_matrices = {}
         # `cache_key` is used to identify the state of this RowGrouper for
         # caching purposes i.e.  RowGrouper instances should have the same
-        # cache_key if and only if they have same group configuration
-        hashobj = hashlib.md5(str(self._group_selectors).encode("utf8"))
+        # cache_key if and only if they have same group configuration. (We hash
+        # the raw offsets rather than the string representation of the arrays
+        # because numpy elides the middle of large arrays when printing them.)
+        hashobj = hashlib.md5()
+        for group_id, row_selector in self._group_selectors.items():
+            hashobj.update(repr((group_id, len(row_selector))).encode("utf8"))
+            hashobj.update(row_selector.astype(numpy.int64).tobytes())
         self.cache_key = hashobj.digest()
 
     def sum(self, matrix, group_ids=None):
@@ -92,12 +109,124 @@ class RowGrouper(object):
             # Otherwise build a selector containing just the rows we want
             else:
                 row_selector = numpy.array(
-                    [self._group_selectors[group_id][0] for group_id in group_ids]
+                    [self._group_selectors[group_id][0] for group_id in group_ids],
+                    dtype=numpy.int_,
                 )
                 return matrix[row_selector]
 
-        # If we can't take the fast path then build a list of row selectors for
-        # each group we want
+        # For dense matrices where only a handful of groups are needed it's
+        # quicker to sum each group's rows directly
+        num_groups = len(self.ids) if group_ids is None else len(group_ids)
+        if not scipy.sparse.issparse(matrix) and num_groups <= MAX_GROUPS_FOR_LOOPING:
+            return self._sum_by_looping(matrix, group_ids)
+
+        return self._sum_by_product(matrix, group_ids)
+
+    def sum_many(self, matrices, group_ids=None):
+        """
+        Sum rows of each of the supplied matrices column-wise, according to
+        their group
+
+        This returns a list equivalent to:
+
+            [row_grouper.sum(matrix, group_ids) for matrix in matrices]
+
+        but it's faster where the matrices have the same number of rows (e.g.
+        the items, quantity and actual_cost matrices from a single query) as we
+        stack them side by side and group them all in a single call
+        """
+        matrices = list(matrices)
+        sparse = [scipy.sparse.issparse(matrix) for matrix in matrices]
+        # There's no advantage in stacking matrices if we're just selecting
+        # rows, and we can't cheaply stack a mix of sparse and dense matrices
+        if (
+            len(matrices) < 2
+            or self._single_row_groups_selector is not None
+            or any(sparse) != all(sparse)
+        ):
+            return [self.sum(matrix, group_ids) for matrix in matrices]
+        if all(sparse):
+            stacked = scipy.sparse.hstack(matrices, format="csc")
+        else:
+            stacked = numpy.hstack(matrices)
+        grouped_output = self.sum(stacked, group_ids)
+        split_offsets = numpy.cumsum([matrix.shape[1] for matrix in matrices])
+        results = numpy.split(grouped_output, split_offsets[:-1], axis=1)
+        return [
+            # Where we've stacked integer and float matrices together the
+            # result will be float, so we need to convert back to integer
+            # where appropriate
+            numpy.ascontiguousarray(
+                result, dtype=numpy.int_ if is_integer(matrix) else result.dtype
+            )
+            for matrix, result in zip(matrices, results)
+        ]
+
+    def _sum_by_product(self, matrix, group_ids=None):
+        """
+        Equivalent to `sum` but multiplying by the group membership matrix,
+        which sums every group's rows in a single sparse matrix product rather
+        than making separate numpy calls for each group
+        """
+        membership = self._get_membership_matrix(matrix)
+        if group_ids is not None:
+            group_offsets = [self.offsets[group_id] for group_id in group_ids]
+            membership = membership[group_offsets]
+        grouped_output = membership @ matrix
+        if scipy.sparse.issparse(grouped_output):
+            return grouped_output.toarray()
+        else:
+            # See `is_matrix` docstring for why we need to ensure we return an
+            # `ndarray` here
+            return numpy.asarray(grouped_output)
+
+    def _get_membership_matrix(self, matrix):
+        """
+        Return a sparse matrix of shape:
+
+            (number_of_groups X rows_in_original_matrix)
+
+        where each element is 1 if that row belongs to that group and 0
+        otherwise, so that multiplying `matrix` by it gives the group sums
+
+        We use the largest integer type for integer matrices (and float
+        otherwise) so that the sums have sufficient headroom even where the
+        input uses a smaller type.
+        """
+        num_rows = matrix.shape[0]
+        dtype = numpy.int_ if is_integer(matrix) else numpy.float_
+        key = (num_rows, dtype)
+        membership = self._membership_matrices.get(key)
+        if membership is None:
+            group_offsets = []
+            row_offsets = []
+            for group_offset, row_selector in enumerate(self._group_selectors.values()):
+                group_offsets.extend([group_offset] * len(row_selector))
+                row_offsets.extend(row_selector)
+            if row_offsets and max(row_offsets) >= num_rows:
+                raise IndexError(
+                    "Row offset {} out of bounds for matrix with {} rows".format(
+                        max(row_offsets), num_rows
+                    )
+                )
+            membership = scipy.sparse.csr_matrix(
+                (
+                    numpy.ones(len(row_offsets), dtype=dtype),
+                    (group_offsets, row_offsets),
+                ),
+                shape=(len(self.ids), num_rows),
+            )
+            self._membership_matrices[key] = membership
+        return membership
+
+    def _sum_by_looping(self, matrix, group_ids=None):
+        """
+        Equivalent to `sum` but summing each group with a separate numpy call
+
+        This is only faster than the sparse matrix product for dense matrices
+        and small numbers of groups.
+        """
+        # Build a list of row selectors for each group we want
         if group_ids is not None:
             row_selectors = [self._group_selectors[group_id] for group_id in group_ids]
         else:
@@ -106,7 +235,10 @@ class RowGrouper(object):
         # Initialise an array to contain the output
         rows = len(row_selectors)
         columns = matrix.shape[1]
-        grouped_output = numpy.empty((rows, columns), dtype=matrix.dtype)
+        # As with `_get_membership_matrix`, we use the largest integer type to
+        # give the sums sufficient headroom
+        dtype = numpy.int_ if is_integer(matrix) else matrix.dtype
+        grouped_output = numpy.empty((rows, columns), dtype=dtype)
 
         # This is awkward. We always want to return an `ndarray` even if the
         # input type is `matrix`. But where the input is a `matrix` the `out`
@@ -1,7 +1,32 @@
+"""
+Serializes matrices (dense numpy ndarrays and scipy Compressed Sparse Column
+matrices) to and from bytes for storage in SQLite
+
+The format is a small fixed-size header followed by the raw contents of the
+underlying numpy buffers, padded to 8-byte boundaries. This means
+deserialization is just a matter of parsing the header and wrapping the buffers
+using `numpy.frombuffer` without copying any data.
+
+Layout (all integers little-endian):
+
+    magic number (4 bytes) | format version (uint8) | kind (uint8) |
+    ndim (uint8) | Fortran order flag (uint8) | shape (ndim x int64) |
+
+followed by one array for dense matrices, or three (data, indices, indptr) for
+CSC matrices, each of the form:
+
+    dtype string (8 bytes, NUL padded) | length in bytes (int64) |
+    raw bytes (padded to a multiple of 8)
+
+Each serialized value carries its own format version and data written in the
+original PyArrow-based format is still readable (see `deserialize_legacy`) so
+MatrixStore files in old and new formats can be used side by side.
+"""
+import functools
 import struct
 
 import lz4.frame
-import pyarrow
+import numpy
 from scipy.sparse import csc_matrix
 
 
@@ -9,26 +34,133 @@ from scipy.sparse import csc_matrix
 # compressed data
 LZ4_MAGIC_NUMBER = struct.pack("<I", 0x184D2204)
 
-context = pyarrow.SerializationContext()
+# The magic initial bytes which identify our own format
+MAGIC_NUMBER = b"\x93MXS"
+FORMAT_VERSION = 1
 
+DENSE = 0
+CSC = 1
 
-def serialize_csc(matrix):
+HEADER = struct.Struct("<4sBBBB")
+DIMENSION = struct.Struct("<q")
+ARRAY_HEADER = struct.Struct("<8sq")
+ALIGNMENT = 8
+
+
+def serialize(matrix):
     """
-    Decompose a matrix in Compressed Sparse Column format into more basic data
-    types (tuples and numpy arrays) which PyArrow knows how to serialize
+    Serialize a numpy ndarray or scipy CSC matrix
     """
-    return ((matrix.data, matrix.indices, matrix.indptr), matrix.shape)
+    return b"".join(encode(matrix))
 
 
-def deserialize_csc(args):
+def serialize_compressed(matrix):
     """
-    Reconstruct a Compressed Sparse Column matrix from its decomposed parts
+    Serialize a numpy ndarray or scipy CSC matrix and compress the result using
+    LZ4
+    """
+    data = serialize(matrix)
+    # See commit comments for details of how this compression level was chosen
+    return lz4.frame.compress(data, compression_level=10, return_bytearray=True)
+
+
+def deserialize(data):
+    """
+    Deserialize binary data, automatically detecting compressed data and
+    decompressing if necessary
+
+    Where the data is uncompressed the returned matrix shares memory with
+    `data` and so will be read-only if `data` is immutable.
+    """
+    magic_number = memoryview(data)[:4]
+    if magic_number == LZ4_MAGIC_NUMBER:
+        data = lz4.frame.decompress(data, return_bytearray=True)
+        magic_number = memoryview(data)[:4]
+    if magic_number == MAGIC_NUMBER:
+        return decode(data)
+    else:
+        return deserialize_legacy(data)
+
+
+def encode(matrix):
+    """
+    Yield the chunks of bytes which make up the serialized form of `matrix`
+    """
+    if isinstance(matrix, csc_matrix):
+        yield HEADER.pack(MAGIC_NUMBER, FORMAT_VERSION, CSC, 2, 0)
+        yield from map(DIMENSION.pack, matrix.shape)
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            yield from encode_array(numpy.ascontiguousarray(array))
+    elif isinstance(matrix, numpy.ndarray) and not isinstance(matrix, numpy.matrix):
+        fortran_order = matrix.flags.f_contiguous and not matrix.flags.c_contiguous
+        if not fortran_order:
+            matrix = numpy.ascontiguousarray(matrix)
+        yield HEADER.pack(
+            MAGIC_NUMBER, FORMAT_VERSION, DENSE, matrix.ndim, int(fortran_order)
+        )
+        yield from map(DIMENSION.pack, matrix.shape)
+        yield from encode_array(matrix)
+    else:
+        raise TypeError("Can't serialize object of type {}".format(type(matrix)))
+
+
+def encode_array(array):
+    if array.dtype.hasobject:
+        raise TypeError("Can't serialize arrays of Python objects")
+    dtype_str = array.dtype.str.encode("ascii")
+    yield ARRAY_HEADER.pack(dtype_str, array.nbytes)
+    # Flattening with order "A" gives us the raw buffer in whichever order (C
+    # or Fortran) the array is stored in, without copying
+    yield array.ravel(order="A").data
+    yield b"\0" * (-array.nbytes % ALIGNMENT)
+
+
+def decode(data):
+    buf = memoryview(data)
+    _, version, kind, ndim, fortran_order = HEADER.unpack_from(buf, 0)
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported matrix format version: {}".format(version))
+    offset = HEADER.size
+    shape = []
+    for _ in range(ndim):
+        shape.append(DIMENSION.unpack_from(buf, offset)[0])
+        offset += DIMENSION.size
+    shape = tuple(shape)
+    if kind == DENSE:
+        array, offset = decode_array(buf, offset)
+        return array.reshape(shape, order="F" if fortran_order else "C")
+    elif kind == CSC:
+        data, offset = decode_array(buf, offset)
+        indices, offset = decode_array(buf, offset)
+        indptr, offset = decode_array(buf, offset)
+        return construct_csc(data, indices, indptr, shape)
+    else:
+        raise ValueError("Unknown matrix kind: {}".format(kind))
+
+
+def decode_array(buf, offset):
+    """
+    Return the array starting at `offset` in `buf`, along with the offset of
+    whatever follows it
+    """
+    dtype_str, nbytes = ARRAY_HEADER.unpack_from(buf, offset)
+    offset += ARRAY_HEADER.size
+    dtype = numpy.dtype(dtype_str.rstrip(b"\0").decode("ascii"))
+    array = numpy.frombuffer(
+        buf, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset
+    )
+    offset += nbytes + (-nbytes % ALIGNMENT)
+    return array, offset
+
+
+def construct_csc(data, indices, indptr, shape):
+    """
+    Construct a Compressed Sparse Column matrix from its constituent parts
     """
     # We construct a `csc_matrix` instance by directly assigning its members,
     # rather than using `__init__` which runs additional checks that
     # significantly slow down deserialization. Because we know these values
     # came from properly constructed matrices we can skip these checks
-    (data, indices, indptr), shape = args
     matrix = csc_matrix.__new__(csc_matrix)
     matrix.data = data
     matrix.indices = indices
@@ -37,39 +169,38 @@ def deserialize_csc(args):
     return matrix
 
 
-# Register a custom PyArrow serialization context which knows how to handle
-# Compressed Sparse Column (csc) matrices
-context.register_type(
-    csc_matrix,
-    "csc",
-    custom_serializer=serialize_csc,
-    custom_deserializer=deserialize_csc,
-)
-
-
-def serialize(obj):
+def deserialize_legacy(data):
     """
-    Serialize an arbitrary Python object using our custom PyArrow context
-    """
-    return context.serialize(obj).to_buffer()
-
+    Deserialize data written in the original format, which used the (now
+    deprecated) PyArrow SerializationContext
 
-def serialize_compressed(obj):
-    """
-    Serialize an arbitrary Python object using our custom PyArrow context and
-    compress the result using LZ4
+    PyArrow is imported lazily so that it's only needed while we still have
+    files in the old format around.
     """
-    data = context.serialize(obj).to_buffer()
-    # See commit comments for details of how this compression level was chosen
-    return lz4.frame.compress(data, compression_level=10, return_bytearray=True)
+    return _get_legacy_context().deserialize(data)
 
 
-def deserialize(data):
+def serialize_legacy(obj):
     """
-    Deserialize binary data using our custom PyArrow context, automatically
-    detecting compressed data and decompressing if necessary
+    Serialize an object in the original PyArrow-based format
+
+    This exists only so we can benchmark the old format against the new and
+    should not be used to write new data.
     """
-    magic_number = memoryview(data)[:4]
-    if magic_number == LZ4_MAGIC_NUMBER:
-        data = lz4.frame.decompress(data, return_bytearray=True)
-    return context.deserialize(data)
+    return _get_legacy_context().serialize(obj).to_buffer()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_legacy_context():
+    import pyarrow
+
+    # Register a custom PyArrow serialization context which knows how to
+    # handle Compressed Sparse Column (csc) matrices
+    context = pyarrow.SerializationContext()
+    context.register_type(
+        csc_matrix,
+        "csc",
+        custom_serializer=lambda m: ((m.data, m.indices, m.indptr), m.shape),
+        custom_deserializer=lambda args: construct_csc(*args[0], args[1]),
+    )
+    return context
@@ -1,9 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+import numpy
 from scipy.sparse import csc_matrix, _sparsetools
 
 from .matrix_ops import zeros_like
+from .parallel import map_in_order
 from .serializer import serialize, deserialize
 
 
+# When summing in parallel we allow this many rows per worker to be in flight
+# at once, so that we don't read rows much faster than we can sum them
+ROWS_PER_WORKER = 4
+
+
 class MatrixSum(object):
     """
     Provides an optimised (for our use case) routine for summing matrices
@@ -38,6 +48,53 @@ class MatrixSum(object):
             return serialize(self.accumulator)
 
 
+def sum_rows(rows, num_columns, workers=1):
+    """
+    Accepts an iterable of rows, each containing `num_columns` serialized
+    matrices (or None), and returns a list giving the sum of each column as an
+    ndarray, or None where a column contains no values
+
+    With more than one worker, the matrices are decompressed and deserialized
+    in a pool of threads, which is possible because LZ4 decompression releases
+    the GIL. The matrices are still added together one row at a time, in the
+    order the rows are supplied, so the results are exactly the same as with a
+    single worker. (Floating point addition isn't associative, so summing
+    different subsets of rows in each thread could change the totals from one
+    run to the next.)
+
+    Rows are read from the iterable in the calling thread only, so it's safe to
+    pass an SQLite cursor here even where the connection can't be shared
+    between threads.
+
+    Starting a pool of threads isn't worth it for just a few rows (e.g. when
+    summing over a single presentation) so we only do so when there are enough
+    rows to keep every worker busy.
+    """
+    matrix_sums = [MatrixSum() for _ in range(num_columns)]
+    max_pending = workers * ROWS_PER_WORKER
+    rows = iter(rows)
+    first_rows = list(islice(rows, max_pending)) if workers > 1 else []
+    rows = chain(first_rows, rows)
+    if workers <= 1 or len(first_rows) < max_pending:
+        for row in rows:
+            for matrix_sum, value in zip(matrix_sums, row):
+                matrix_sum.step(value)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            matrices = map_in_order(
+                executor, deserialize_row, rows, max_pending=max_pending
+            )
+            for row in matrices:
+                for matrix_sum, matrix in zip(matrix_sums, row):
+                    if matrix is not None:
+                        matrix_sum.add(matrix)
+    return [matrix_sum.accumulator for matrix_sum in matrix_sums]
+
+
+def deserialize_row(row):
+    return [deserialize(value) if value is not None else None for value in row]
+
+
 def fast_in_place_add(ndarray, matrix):
     """
     Performs fast in-place addition of a sparse CSC matrix to an ndarray of the
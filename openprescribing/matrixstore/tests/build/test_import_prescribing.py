@@ -0,0 +1,71 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+from mock import patch
+
+from matrixstore.build.common import get_prescribing_filename
+from matrixstore.build.import_prescribing import import_prescribing, split_into_batches
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import _dicts_to_csv, init_db
+
+
+class TestSplitIntoBatches(SimpleTestCase):
+    def test_split_into_batches(self):
+        rows = [(code, "P1") for code in ["01", "01", "02", "03", "03", "03", "04"]]
+        batches = list(split_into_batches(rows, 2))
+        self.assertEqual(
+            [[row[0] for row in batch] for batch in batches],
+            [["01", "01"], ["02", "03", "03", "03"], ["04"]],
+        )
+
+    def test_split_no_rows(self):
+        self.assertEqual(list(split_into_batches([], 2)), [])
+
+
+class TestImportPrescribingInParallel(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        settings_patcher = override_settings(MATRIXSTORE_IMPORT_DIR=self.tempdir)
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(4)
+        presentations = factory.create_presentations(12)
+        factory.create_prescribing(presentations, practices, months)
+        self.factory = factory
+        self.dates = [month[:10] for month in months]
+        for date in self.dates:
+            self.write_prescribing_csv(date)
+
+    def write_prescribing_csv(self, date):
+        prescribing = sorted(
+            [p for p in self.factory.prescribing if p["month"][:10] == date],
+            key=lambda p: (p["bnf_code"], p["practice"]),
+        )
+        with gzip.open(get_prescribing_filename(date), "wt") as f:
+            f.writelines(_dicts_to_csv(prescribing))
+
+    def build_file(self, workers):
+        filename = os.path.join(self.tempdir, "workers_{}.sqlite".format(workers))
+        connection = sqlite3.connect(filename)
+        init_db(connection, self.factory, self.dates)
+        connection.commit()
+        connection.close()
+        import_prescribing(filename, workers=workers)
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def test_parallel_build_is_byte_identical_to_serial_build(self):
+        serial_bytes = self.build_file(workers=1)
+        # Use small batches so that the rows are split across several
+        # batches and workers
+        with patch("matrixstore.build.import_prescribing.ROWS_PER_BATCH", 5):
+            parallel_bytes = self.build_file(workers=3)
+        self.assertEqual(parallel_bytes, serial_bytes)
@@ -0,0 +1,75 @@
+import sqlite3
+
+from django.test import SimpleTestCase
+
+import numpy
+
+from matrixstore.serializer import deserialize
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import (
+    import_test_data_fast,
+    import_test_data_incrementally,
+)
+
+
+class TestImportPrescribingIncrementally(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 4)
+        practices = factory.create_practices(3)
+        presentations = factory.create_presentations(4)
+        factory.create_practice_statistics(practices, months)
+        factory.create_prescribing(presentations, practices, months)
+        # A practice and a presentation which only appear in the first month,
+        # and so drop out of the incrementally built file
+        closed_practice = factory.create_practice()
+        factory.create_statistics_for_one_practice_and_month(closed_practice, months[0])
+        discontinued_presentation = factory.create_presentation()
+        factory.create_prescription(
+            discontinued_presentation, closed_practice, months[0]
+        )
+        # A practice and a presentation which only appear in the new month
+        new_practice = factory.create_practice()
+        factory.create_statistics_for_one_practice_and_month(new_practice, months[3])
+        new_presentation = factory.create_presentation()
+        factory.create_prescription(new_presentation, new_practice, months[3])
+        # A presentation which changes its BNF code, with prescribing under the
+        # old code in every month so the new month's prescribing needs mapping
+        presentation_to_update = factory.create_presentation()
+        factory.update_bnf_code(presentation_to_update)
+        factory.create_prescribing([presentation_to_update], practices, months)
+
+        cls.previous = sqlite3.connect(":memory:")
+        import_test_data_fast(cls.previous, factory, "2019-03", months=3)
+        cls.incremental = sqlite3.connect(":memory:")
+        import_test_data_incrementally(
+            cls.incremental, cls.previous, factory, "2019-04", months=3
+        )
+        cls.full = sqlite3.connect(":memory:")
+        import_test_data_fast(cls.full, factory, "2019-04", months=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        for connection in [cls.previous, cls.incremental, cls.full]:
+            connection.close()
+
+    def test_matches_full_build(self):
+        # Totals are summed in a different order in the two builds and so
+        # floating point values can differ slightly; we compare these below
+        exclude = 'INSERT INTO "all_presentations"'
+        incremental_dump = [
+            line for line in self.incremental.iterdump() if exclude not in line
+        ]
+        full_dump = [line for line in self.full.iterdump() if exclude not in line]
+        self.assertEqual(incremental_dump, full_dump)
+
+    def test_totals_match_full_build(self):
+        sql = "SELECT items, quantity, actual_cost, net_cost FROM all_presentations"
+        incremental_totals = self.incremental.execute(sql).fetchone()
+        full_totals = self.full.execute(sql).fetchone()
+        for incremental_value, full_value in zip(incremental_totals, full_totals):
+            incremental_matrix = deserialize(incremental_value)
+            full_matrix = deserialize(full_value)
+            self.assertEqual(incremental_matrix.dtype, full_matrix.dtype)
+            numpy.testing.assert_allclose(incremental_matrix, full_matrix)
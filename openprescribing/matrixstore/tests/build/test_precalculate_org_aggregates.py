@@ -0,0 +1,126 @@
+import sqlite3
+
+from django.test import SimpleTestCase
+
+import mock
+import numpy
+
+from matrixstore.build.precalculate_org_aggregates import (
+    precalculate_org_aggregates_for_db,
+)
+from matrixstore.connection import MatrixStore
+from matrixstore.org_aggregates import get_prescribing_aggregates, has_aggregates
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestPrecalculateOrgAggregates(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(4)
+        presentations = [
+            factory.create_presentation(bnf_code)
+            for bnf_code in [
+                "0202010B0AAABAB",
+                "0202010B0AAACAC",
+                "0202020L0AAAAAA",
+                "0212000AAAAAAAA",
+                "0407010H0AAAMAM",
+            ]
+        ]
+        factory.create_practice_statistics(practices, months)
+        factory.create_prescribing(presentations, practices, months)
+        cls.connection = sqlite3.connect(":memory:")
+        import_test_data_fast(cls.connection, factory, months[-1][:7], months=3)
+        cls.matrixstore = MatrixStore(cls.connection)
+        cls.row_grouper = RowGrouper(
+            (offset, "odd" if offset % 2 else "even")
+            for offset in cls.matrixstore.practice_offsets.values()
+        )
+        previous_isolation_level = cls.connection.isolation_level
+        cls.connection.isolation_level = None
+        precalculate_org_aggregates_for_db(
+            cls.connection, {"odd_even": cls.row_grouper}
+        )
+        cls.connection.isolation_level = previous_isolation_level
+        # Reload so that the aggregates get picked up
+        cls.matrixstore = MatrixStore(cls.connection)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.close()
+
+    def setUp(self):
+        patcher = mock.patch(
+            "matrixstore.org_aggregates.get_row_grouper",
+            return_value=self.row_grouper,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prescribing_aggregates_match_runtime_grouping(self):
+        for prefixes in [[], ["02"], ["0202"], ["020201"], ["0212"], ["04"]]:
+            aggregates = get_prescribing_aggregates(
+                self.matrixstore, "odd_even", prefixes
+            )
+            for matrix, field in zip(aggregates, ["items", "quantity", "actual_cost"]):
+                numpy.testing.assert_allclose(
+                    matrix, self.get_expected_value(field, prefixes)
+                )
+
+    def test_no_aggregates_for_unsupported_prefixes(self):
+        self.assertIsNone(
+            get_prescribing_aggregates(self.matrixstore, "odd_even", ["0202010B0"])
+        )
+        self.assertIsNone(
+            get_prescribing_aggregates(self.matrixstore, "odd_even", ["02", "04"])
+        )
+
+    def test_no_data_for_prefix_without_prescribing(self):
+        self.assertEqual(
+            get_prescribing_aggregates(self.matrixstore, "odd_even", ["05"]),
+            (None, None, None),
+        )
+
+    def test_aggregates_ignored_if_grouping_has_changed(self):
+        self.assertTrue(has_aggregates(self.matrixstore, "odd_even"))
+        different_grouper = RowGrouper(
+            (offset, "all") for offset in self.matrixstore.practice_offsets.values()
+        )
+        with mock.patch(
+            "matrixstore.org_aggregates.get_row_grouper",
+            return_value=different_grouper,
+        ):
+            self.assertFalse(has_aggregates(self.matrixstore, "odd_even"))
+            self.assertIsNone(
+                get_prescribing_aggregates(self.matrixstore, "odd_even", [])
+            )
+        self.assertFalse(has_aggregates(self.matrixstore, "ccg"))
+
+    def test_practice_statistics(self):
+        results = self.matrixstore.query(
+            """
+            SELECT name, value FROM practice_statistic_by_org
+            WHERE org_type = 'odd_even'
+            """
+        )
+        aggregates = dict(results)
+        stats = dict(
+            self.matrixstore.query("SELECT name, value FROM practice_statistic")
+        )
+        self.assertEqual(aggregates.keys(), stats.keys())
+        for name, matrix in stats.items():
+            numpy.testing.assert_allclose(
+                aggregates[name], self.row_grouper.sum(matrix)
+            )
+
+    def get_expected_value(self, field, prefixes):
+        where = " OR ".join(["bnf_code LIKE ?"] * len(prefixes)) or "1=1"
+        matrix = self.matrixstore.query_one(
+            "SELECT MATRIX_SUM({}) FROM presentation WHERE {}".format(field, where),
+            [prefix + "%" for prefix in prefixes],
+        )[0]
+        return self.row_grouper.sum(matrix)
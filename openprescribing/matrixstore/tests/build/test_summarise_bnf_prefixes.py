@@ -0,0 +1,101 @@
+import sqlite3
+
+from django.test import SimpleTestCase
+
+import numpy
+
+from matrixstore.bnf_prefixes import (
+    get_summary_prefixes_and_bnf_codes,
+    get_totals_for_prefixes,
+    remove_redundant_prefixes,
+)
+from matrixstore.build.summarise_bnf_prefixes import summarise_bnf_prefixes_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+FIELDS = ["items", "quantity", "actual_cost", "net_cost"]
+
+
+class TestSummariseBNFPrefixes(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(4)
+        presentations = [
+            factory.create_presentation(bnf_code)
+            for bnf_code in [
+                "0202010B0AAABAB",
+                "0202010B0AAACAC",
+                "0202010B0BBAAAB",
+                "0202020L0AAAAAA",
+                "0212000AAAAAAAA",
+                "0407010H0AAAMAM",
+            ]
+        ]
+        factory.create_practice_statistics(practices, months)
+        factory.create_prescribing(presentations, practices, months)
+        cls.connection = sqlite3.connect(":memory:")
+        import_test_data_fast(cls.connection, factory, months[-1][:7], months=3)
+        # This instance won't know about the summary table so it always sums
+        # the matching presentations, giving us values to compare against
+        cls.unsummarised = MatrixStore(cls.connection)
+        previous_isolation_level = cls.connection.isolation_level
+        cls.connection.isolation_level = None
+        summarise_bnf_prefixes_for_db(cls.connection)
+        cls.connection.isolation_level = previous_isolation_level
+        cls.matrixstore = MatrixStore(cls.connection)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.close()
+
+    def test_totals_match_sum_over_presentations(self):
+        self.assertTrue(self.matrixstore.has_bnf_prefix_summary)
+        self.assertFalse(self.unsummarised.has_bnf_prefix_summary)
+        for prefixes in [
+            ["02"],
+            ["0202"],
+            ["020201"],
+            ["0202010B0"],
+            ["0202010B0AA"],
+            ["0202010B0AAABAB"],
+            ["02020"],
+            ["0202010B0", "0407"],
+            ["02", "0202010"],
+            ["0212", "04"],
+        ]:
+            totals = get_totals_for_prefixes(self.matrixstore, FIELDS, prefixes)
+            expected = get_totals_for_prefixes(self.unsummarised, FIELDS, prefixes)
+            for matrix, expected_matrix in zip(totals, expected):
+                numpy.testing.assert_allclose(
+                    _to_dense(matrix), _to_dense(expected_matrix)
+                )
+
+    def test_no_prescribing(self):
+        self.assertEqual(
+            get_totals_for_prefixes(self.matrixstore, FIELDS, ["05"]),
+            [None, None, None, None],
+        )
+
+    def test_uses_fewest_summary_values(self):
+        self.assertEqual(
+            get_summary_prefixes_and_bnf_codes(self.matrixstore, ["02"]),
+            (["02"], []),
+        )
+        self.assertEqual(
+            get_summary_prefixes_and_bnf_codes(self.matrixstore, ["02020"]),
+            (["020201"], ["0202020L0AAAAAA"]),
+        )
+
+    def test_remove_redundant_prefixes(self):
+        self.assertEqual(
+            remove_redundant_prefixes(["0202", "02", "0401", "04010", "0401"]),
+            ["02", "0401"],
+        )
+
+
+def _to_dense(matrix):
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
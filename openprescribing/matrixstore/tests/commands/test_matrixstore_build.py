@@ -23,6 +23,8 @@ import shutil
 import sqlite3
 import tempfile
 
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import SimpleTestCase
 
 import numpy
@@ -284,6 +286,18 @@ class TestMatrixStoreBuildEndToEnd(TestMatrixStoreBuild):
         self.assertEqual(db_dump, other_db_dump)
 
 
+class TestMatrixStoreBuildArguments(SimpleTestCase):
+    def test_workers_cannot_be_used_with_incremental_build(self):
+        with self.assertRaisesRegex(CommandError, "--workers"):
+            call_command(
+                "matrixstore_build",
+                "2019-03",
+                workers=2,
+                incremental_from="previous.sqlite",
+                quiet=True,
+            )
+
+
 class MatrixValueFetcher(object):
     """
     Provides convenient access to values stored in matrices in SQLite
@@ -9,6 +9,9 @@ from matrixstore.build.import_prescribing import (
     write_prescribing,
     parse_prescribing_csv,
 )
+from matrixstore.build.import_prescribing_incrementally import (
+    write_prescribing_incrementally,
+)
 from matrixstore.build.update_bnf_map import (
     move_values_from_old_code_to_new,
     delete_presentations_with_no_prescribing,
@@ -40,6 +43,33 @@ def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None):
     sqlite_conn.commit()
 
 
+def import_test_data_incrementally(
+    sqlite_conn, previous_sqlite_conn, data_factory, end_date, months=None
+):
+    """
+    As `import_test_data_fast` but reusing the prescribing data in an existing
+    file (see `import_prescribing_incrementally`) and only importing
+    prescribing from `data_factory` for dates which that file doesn't cover
+    """
+    dates = generate_dates(end_date, months=months)
+    previous_dates = {
+        date for (date,) in previous_sqlite_conn.execute("SELECT date FROM date")
+    }
+    dates_to_import = [date for date in dates if date not in previous_dates]
+
+    previous_isolation_level = sqlite_conn.isolation_level
+    sqlite_conn.isolation_level = None
+
+    init_db(sqlite_conn, data_factory, dates)
+    import_practice_stats(sqlite_conn, data_factory, dates)
+    prescribing = _get_prescribing(data_factory, dates_to_import)
+    write_prescribing_incrementally(sqlite_conn, previous_sqlite_conn, prescribing)
+    update_bnf_map(sqlite_conn, data_factory)
+
+    sqlite_conn.isolation_level = previous_isolation_level
+    sqlite_conn.commit()
+
+
 def init_db(sqlite_conn, data_factory, dates):
     sqlite_conn.executescript(SCHEMA_SQL)
     import_dates(sqlite_conn, dates)
@@ -69,13 +99,17 @@ def import_practice_stats(sqlite_conn, data_factory, dates):
 
 
 def import_prescribing(sqlite_conn, data_factory, dates):
+    prescribing = _get_prescribing(data_factory, dates)
+    write_prescribing(sqlite_conn, prescribing)
+
+
+def _get_prescribing(data_factory, dates):
     filtered_prescribing = _filter_by_date(data_factory.prescribing, dates)
     sorted_prescribing = sorted(
         filtered_prescribing, key=lambda p: (p["bnf_code"], p["practice"], p["month"])
     )
     prescribing_csv = _dicts_to_csv(sorted_prescribing)
-    prescribing = parse_prescribing_csv(prescribing_csv)
-    write_prescribing(sqlite_conn, prescribing)
+    return parse_prescribing_csv(prescribing_csv)
 
 
 def update_bnf_map(sqlite_conn, data_factory):
@@ -1,7 +1,6 @@
 import mock
 import sqlite3
 
-from frontend.price_per_unit.substitution_sets import get_substitution_sets
 from matrixstore.connection import MatrixStore
 from matrixstore import db
 from matrixstore.tests.import_test_data_fast import import_test_data_fast
@@ -32,15 +31,11 @@ def patch_global_matrixstore(matrixstore):
     mocked = patcher.start()
     mocked.return_value = matrixstore
     # There are memoized functions so we clear any previously memoized value
-    db.get_db.cache_clear()
-    db.get_row_grouper.cache_clear()
-    get_substitution_sets.cache_clear()
+    db.clear_cache()
 
     def stop_patching():
         patcher.stop()
-        db.get_db.cache_clear()
-        db.get_row_grouper.cache_clear()
-        get_substitution_sets.cache_clear()
+        db.clear_cache()
         matrixstore.close()
 
     return stop_patching
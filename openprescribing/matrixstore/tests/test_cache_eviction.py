@@ -0,0 +1,115 @@
+from io import StringIO
+import shutil
+import tempfile
+
+from diskcache import FanoutCache
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from matrixstore.cache_eviction import CacheEvictor, get_evictor
+
+
+VALUE_SIZE = 64 * 1024
+
+
+class CacheEvictorTest(SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.cache = FanoutCache(
+            tmpdir, shards=1, cull_limit=0, disk_min_file_size=2 ** 30
+        )
+        self.addCleanup(self.cache.close)
+        self.empty_volume = self.cache.volume()
+        # Values are stored in this order, so a plain oldest-first policy would
+        # evict the untagged and live values first
+        self.keys = [
+            ":1:some_other_value",
+            ":1:cachelib::untagged",
+            ":1:cachelib:live:aaaa",
+            ":1:cachelib:old:bbbb",
+            ":1:cachelib:old:cccc",
+        ]
+        for key in self.keys:
+            self.cache.set(key, b"x" * VALUE_SIZE)
+
+    def get_evictor(self, values_to_keep):
+        return CacheEvictor(
+            self.cache,
+            size_limit=self.empty_volume + (values_to_keep + 0.5) * VALUE_SIZE,
+            live_generation_tag="live",
+            key_prefix=":1:cachelib:",
+        )
+
+    def test_evicts_values_from_old_generations_first(self):
+        evictor = self.get_evictor(values_to_keep=3)
+        self.assertTrue(evictor.run_batch(time_limit=10))
+        self.assertEqual(sorted(self.cache), sorted(self.keys[:3]))
+        self.assertEqual(evictor.entries_evicted, 2)
+        self.assertGreaterEqual(evictor.bytes_reclaimed, 2 * VALUE_SIZE)
+
+    def test_then_evicts_oldest_values(self):
+        evictor = self.get_evictor(values_to_keep=2)
+        self.assertTrue(evictor.run_batch(time_limit=10))
+        self.assertEqual(sorted(self.cache), sorted(self.keys[1:3]))
+
+    def test_does_nothing_if_within_limit(self):
+        evictor = self.get_evictor(values_to_keep=5)
+        self.assertTrue(evictor.run_batch(time_limit=10))
+        self.assertEqual(sorted(self.cache), sorted(self.keys))
+        self.assertEqual(evictor.entries_evicted, 0)
+
+    def test_work_is_split_into_batches(self):
+        evictor = self.get_evictor(values_to_keep=3)
+        # With no time available no progress is made
+        self.assertFalse(evictor.run_batch(time_limit=0))
+        self.assertEqual(len(self.cache), 5)
+        self.assertTrue(evictor.run_batch(time_limit=10))
+        self.assertEqual(len(self.cache), 3)
+
+
+class GarbageCollectCommandTest(SimpleTestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        # We use aliases not used elsewhere in the tests so that we never get a
+        # cache instance left over from a different configuration
+        settings_patcher = override_settings(
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+                "eviction_test_diskcache": {
+                    "BACKEND": "diskcache.DjangoCache",
+                    "LOCATION": tmpdir,
+                    "SHARDS": 1,
+                    "OPTIONS": {"size_limit": 2 ** 20},
+                },
+                "eviction_test_locmem": {
+                    "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+                },
+            }
+        )
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+
+    @override_settings(CACHELIB_CACHE_ALIAS="eviction_test_diskcache")
+    def test_evicts_from_cachelib_cache(self):
+        django_cache = caches["eviction_test_diskcache"]
+        self.addCleanup(django_cache.close)
+        evictor = get_evictor()
+        self.assertIs(evictor.cache, django_cache._cache)
+        self.assertEqual(evictor.size_limit, 2 ** 20)
+        stdout = StringIO()
+        call_command("diskcache_garbage_collect", stdout=stdout)
+        self.assertIn("Evicted 0 entries", stdout.getvalue())
+
+    @override_settings(CACHELIB_CACHE_ALIAS="eviction_test_locmem")
+    def test_skips_cache_which_is_not_diskcache(self):
+        stdout = StringIO()
+        call_command("diskcache_garbage_collect", stdout=stdout)
+        self.assertIn(
+            "Skipping: cache 'eviction_test_locmem' (CACHELIB_CACHE_ALIAS) is not a "
+            "DiskCache instance",
+            stdout.getvalue(),
+        )
@@ -1,14 +1,40 @@
+import threading
+import time
+
 from mock import Mock
-import warnings
+import numpy
+from scipy.sparse import csc_matrix
 
-from django.core.cache import CacheKeyWarning
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import SimpleTestCase, override_settings
 
-from matrixstore.cachelib import memoize
+from matrixstore.cachelib import (
+    Cache,
+    decode_value,
+    encode_value,
+    get_default_cache,
+    memoize,
+    SingleFlight,
+)
+
 
-# The local memory cache backend we use in testing warns that our binary cache
-# keys won't be compatible with memcached, but we really don't care
-warnings.simplefilter("ignore", CacheKeyWarning)
+class MemcachedStandIn(LocMemCache):
+    """
+    In-process cache which enforces the restrictions of a shared cache like
+    memcached: keys must be short strings without spaces and values must
+    already be encoded as bytes
+    """
+
+    def validate_key(self, key):
+        if not isinstance(key, str) or len(key) > 250:
+            raise ValueError("Invalid key: {!r}".format(key))
+        if any(ord(char) <= 32 or ord(char) == 127 for char in key):
+            raise ValueError("Invalid key: {!r}".format(key))
+
+    def set(self, key, value, *args, **kwargs):
+        if not isinstance(value, bytes):
+            raise ValueError("Value is not bytes: {!r}".format(value))
+        return super().set(key, value, *args, **kwargs)
 
 
 class MyTestObject:
@@ -17,7 +43,10 @@ class MyTestObject:
 
 
 @override_settings(
-    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    CACHES={"default": {"BACKEND": "matrixstore.tests.test_cachelib.MemcachedStandIn"}},
+    CACHELIB_CACHE_ALIAS="default",
+    CACHELIB_COMPRESSION_THRESHOLD=None,
+    CACHELIB_LOCK_TIMEOUT=5,
 )
 class MemoizeDecoratorTest(SimpleTestCase):
     def test_cached_function_with_basic_arguments(self):
@@ -64,3 +93,235 @@ class MemoizeDecoratorTest(SimpleTestCase):
         test_arg = MyTestObject()
         with self.assertRaises(ValueError):
             cached_func(test_arg)
+
+    def test_matrix_values_are_stored_as_bytes(self):
+        matrix = numpy.arange(12, dtype=numpy.float64).reshape(3, 4)
+        test_func = Mock(return_value=matrix, __qualname__="test_func3")
+        cached_func = memoize()(test_func)
+        cached_func("foo")
+        result = cached_func("foo")
+        test_func.assert_called_once_with("foo")
+        self.assertIsNot(result, matrix)
+        numpy.testing.assert_array_equal(result, matrix)
+
+    def test_concurrent_misses_are_coalesced(self):
+        release = threading.Event()
+
+        def slow_func(arg):
+            release.wait()
+            return arg
+
+        test_func = Mock(side_effect=slow_func, __qualname__="test_func4")
+        cached_func = memoize()(test_func)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cached_func("foo")))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        # Give the other threads a chance to miss the cache while the first is
+        # still computing the value
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["foo", "foo", "foo"])
+        test_func.assert_called_once_with("foo")
+
+
+class EncodeValueTest(SimpleTestCase):
+    def assertRoundTrips(self, value, compression_threshold=None):
+        data = encode_value(value, compression_threshold)
+        self.assertIsInstance(data, bytes)
+        decoded = decode_value(data)
+        self.assertEqual(type(decoded), type(value))
+        return decoded
+
+    def test_dense_matrix(self):
+        matrix = numpy.arange(12, dtype=numpy.int32).reshape(3, 4)
+        decoded = self.assertRoundTrips(matrix)
+        numpy.testing.assert_array_equal(decoded, matrix)
+        self.assertEqual(decoded.dtype, matrix.dtype)
+        # Values should be writable, just as if they'd been computed
+        decoded[0, 0] = 100
+
+    def test_sparse_matrix(self):
+        matrix = csc_matrix(numpy.array([[0, 1.5], [2.5, 0], [0, 0]]))
+        decoded = self.assertRoundTrips(matrix)
+        numpy.testing.assert_array_equal(decoded.toarray(), matrix.toarray())
+
+    def test_tuple_of_matrices(self):
+        value = (numpy.ones((2, 2)), csc_matrix(numpy.eye(3)))
+        decoded = self.assertRoundTrips(value)
+        numpy.testing.assert_array_equal(decoded[0], value[0])
+        numpy.testing.assert_array_equal(decoded[1].toarray(), value[1].toarray())
+
+    def test_other_values_are_pickled(self):
+        structured = numpy.array([(1, 2.5)], dtype=[("a", "i4"), ("b", "f8")])
+        for value in [{"a": [1, 2]}, ("foo", 1), (), structured]:
+            decoded = self.assertRoundTrips(value)
+            if isinstance(value, numpy.ndarray):
+                numpy.testing.assert_array_equal(decoded, value)
+            else:
+                self.assertEqual(decoded, value)
+
+    def test_large_values_are_compressed(self):
+        matrix = numpy.zeros((100, 100))
+        uncompressed = encode_value(matrix)
+        compressed = encode_value(matrix, compression_threshold=1000)
+        self.assertLess(len(compressed), len(uncompressed))
+        decoded = decode_value(compressed)
+        numpy.testing.assert_array_equal(decoded, matrix)
+        decoded[0, 0] = 1
+        # Values under the threshold are left alone
+        self.assertEqual(encode_value(matrix, len(uncompressed)), uncompressed)
+
+
+class CacheTest(SimpleTestCase):
+    def test_get_and_set(self):
+        cache = Cache(MemcachedStandIn("cache_test", {}), compression_threshold=100)
+        cache.backend.clear()
+        self.assertEqual(cache.get("foo", default="missing"), "missing")
+        cache.set("foo", numpy.ones(1000))
+        numpy.testing.assert_array_equal(cache.get("foo"), numpy.ones(1000))
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "matrixstore.tests.test_cachelib.MemcachedStandIn"},
+        },
+        CACHELIB_CACHE_ALIAS="shared",
+        CACHELIB_COMPRESSION_THRESHOLD=1024,
+    )
+    def test_default_cache_uses_settings(self):
+        cache = get_default_cache()
+        self.assertIsInstance(cache.backend, MemcachedStandIn)
+        self.assertEqual(cache.compression_threshold, 1024)
+
+
+class SingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        self.cache = Cache(MemcachedStandIn("single_flight_test", {}))
+        self.cache.backend.clear()
+        self.single_flight = SingleFlight(poll_interval=0.01)
+
+    def get_or_compute(self, func, timeout=5):
+        return self.single_flight.get_or_compute(self.cache, "key", func, timeout)
+
+    def test_followers_share_leaders_result(self):
+        follower_results = []
+
+        def leader_func():
+            follower = threading.Thread(
+                target=lambda: follower_results.append(
+                    self.get_or_compute(lambda: "follower")
+                )
+            )
+            follower.start()
+            self.wait_for_waiters(1)
+            return "leader"
+
+        self.assertEqual(self.get_or_compute(leader_func), "leader")
+        self.wait_for(lambda: follower_results)
+        self.assertEqual(follower_results, ["leader"])
+        self.assertEqual(self.cache.get("key"), "leader")
+        stats = self.single_flight.stats()
+        self.assertEqual(stats["computed"], 1)
+        self.assertEqual(stats["coalesced"], 1)
+
+    def test_followers_see_leaders_error(self):
+        follower_errors = []
+
+        def follow():
+            try:
+                self.get_or_compute(lambda: "follower")
+            except ValueError as e:
+                follower_errors.append(e)
+
+        def leader_func():
+            threading.Thread(target=follow).start()
+            self.wait_for_waiters(1)
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            self.get_or_compute(leader_func)
+        self.wait_for(lambda: follower_errors)
+        self.assertEqual(str(follower_errors[0]), "failed")
+        # Nothing is left locked
+        self.assertTrue(self.cache.acquire_lock("key:lock", 5))
+
+    def test_followers_compute_value_if_leader_is_too_slow(self):
+        release = threading.Event()
+        follower_results = []
+
+        def leader_func():
+            release.wait()
+            return "leader"
+
+        leader = threading.Thread(target=lambda: self.get_or_compute(leader_func))
+        leader.start()
+        self.wait_for(lambda: "key" in self.single_flight._in_flight)
+        follower_results.append(self.get_or_compute(lambda: "follower", timeout=0.05))
+        release.set()
+        leader.join()
+        self.assertEqual(follower_results, ["follower"])
+        self.assertEqual(self.single_flight.stats()["timeouts"], 1)
+
+    def test_waits_for_value_computed_by_another_process(self):
+        # Simulate another process taking the lock and then storing the value
+        lock_token = self.cache.acquire_lock("key:lock", 5)
+
+        def other_process():
+            time.sleep(0.05)
+            self.cache.set("key", "other process")
+            self.cache.release_lock("key:lock", lock_token)
+
+        threading.Thread(target=other_process).start()
+        func = Mock(return_value="this process")
+        self.assertEqual(self.get_or_compute(func), "other process")
+        func.assert_not_called()
+        stats = self.single_flight.stats()
+        self.assertEqual(stats["lock_waits"], 1)
+        self.assertGreater(stats["lock_wait_seconds"], 0)
+        self.assertEqual(stats["computed"], 0)
+
+    def test_computes_value_if_other_process_is_too_slow(self):
+        self.cache.acquire_lock("key:lock", 5)
+        self.assertEqual(self.get_or_compute(lambda: "value", timeout=0.05), "value")
+        self.assertEqual(self.cache.get("key"), "value")
+        stats = self.single_flight.stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["computed"], 1)
+
+    def test_expired_lock_does_not_release_new_holders_lock(self):
+        release = threading.Event()
+        computing = threading.Event()
+
+        def slow_func():
+            computing.set()
+            release.wait()
+            return "value"
+
+        leader = threading.Thread(
+            target=lambda: self.get_or_compute(slow_func, timeout=0.05)
+        )
+        leader.start()
+        computing.wait()
+        # The leader's lock expires while it's still computing, and another
+        # process takes the lock
+        self.wait_for(lambda: self.cache.acquire_lock("key:lock", 5) is not None)
+        release.set()
+        leader.join()
+        # The other process still holds the lock
+        self.assertIsNone(self.cache.acquire_lock("key:lock", 5))
+
+    def wait_for_waiters(self, count):
+        self.wait_for(lambda: self.single_flight._in_flight["key"].waiters == count)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("Timed out waiting for condition")
+            time.sleep(0.001)
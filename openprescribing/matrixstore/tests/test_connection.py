@@ -1,8 +1,11 @@
 from collections import defaultdict
 import numbers
+import sqlite3
 
 from django.test import SimpleTestCase
 
+from matrixstore.build.chunk_by_date import chunk_by_date_for_db
+from matrixstore.connection import MatrixStore
 from matrixstore.tests.data_factory import DataFactory
 from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
 
@@ -70,6 +73,64 @@ class TestMatrixStoreConnection(SimpleTestCase):
                 expected_value = items_dict[practice, date]
                 self.assertEqual(value, expected_value)
 
+    def test_sum_matrices(self):
+        expected = self.matrixstore.query_one(
+            "SELECT MATRIX_SUM(items), MATRIX_SUM(net_cost) FROM presentation"
+        )
+        for workers in [1, 3]:
+            items, net_cost = self.matrixstore.sum_matrices(
+                "SELECT items, net_cost FROM presentation", workers=workers
+            )
+            self.assertEqual(items.tolist(), expected[0].tolist())
+            self.assertEqual(net_cost.tolist(), expected[1].tolist())
+
+    def test_query_presentations_at_date(self):
+        target_codes = [p["bnf_code"] for p in self.factory.presentations][:3]
+        target_codes.append("not-a-real-code")
+        date = self.matrixstore.dates[2]
+        results = self.matrixstore.query_presentations_at_date(target_codes, date)
+        self.assertPresentationsAtDateCorrect(results, target_codes, date)
+
+    def test_query_presentations_at_date_with_chunks(self):
+        connection = self.matrixstore.connection
+        # Build a new MatrixStore with chunks but with an identical backing
+        # database, so we don't disturb the other tests
+        chunked_connection = sqlite3.connect(":memory:")
+        connection.backup(chunked_connection)
+        chunked_connection.isolation_level = None
+        chunk_by_date_for_db(chunked_connection)
+        chunked_matrixstore = MatrixStore(chunked_connection)
+        self.assertTrue(chunked_matrixstore.has_date_chunks)
+        self.assertFalse(self.matrixstore.has_date_chunks)
+        target_codes = [p["bnf_code"] for p in self.factory.presentations]
+        for date in chunked_matrixstore.dates:
+            results = chunked_matrixstore.query_presentations_at_date(
+                target_codes, date
+            )
+            self.assertPresentationsAtDateCorrect(results, target_codes, date)
+        chunked_matrixstore.close()
+
+    def assertPresentationsAtDateCorrect(self, results, target_codes, date):
+        expected = defaultdict(int)
+        for p in self.factory.prescribing:
+            if p["bnf_code"] in target_codes and p["month"][:10] == date:
+                expected[p["bnf_code"], p["practice"], "quantity"] += p["quantity"]
+                expected[p["bnf_code"], p["practice"], "net_cost"] += p["net_cost"]
+        bnf_codes = set()
+        for bnf_code, quantity, net_cost in results:
+            bnf_codes.add(bnf_code)
+            self.assertEqual(quantity.shape, (len(self.matrixstore.practices), 1))
+            for practice, row_offset in self.matrixstore.practice_offsets.items():
+                self.assertAlmostEqual(
+                    quantity[row_offset, 0],
+                    expected[bnf_code, practice, "quantity"],
+                )
+                self.assertEqual(
+                    net_cost[row_offset, 0],
+                    round(expected[bnf_code, practice, "net_cost"] * 100),
+                )
+        self.assertEqual(bnf_codes, set(target_codes) - {"not-a-real-code"})
+
     @classmethod
     def tearDownClass(cls):
         cls.matrixstore.close()
@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from matrixstore import db
+from matrixstore.middleware import PinMatrixStoreGenerationMiddleware
+
+
+class FakeMatrixStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestGenerations(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.symlink = os.path.join(self.tmpdir, "matrixstore_live.sqlite")
+        settings_patcher = override_settings(MATRIXSTORE_LIVE_FILE=self.symlink)
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        from_file_patcher = mock.patch(
+            "matrixstore.connection.MatrixStore.from_file", side_effect=FakeMatrixStore
+        )
+        from_file_patcher.start()
+        self.addCleanup(from_file_patcher.stop)
+        db.clear_cache()
+        self.addCleanup(db.clear_cache)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.set_live("matrixstore_1.sqlite")
+
+    def set_live(self, filename):
+        target = os.path.join(self.tmpdir, filename)
+        open(target, "w").close()
+        temp_link = self.symlink + ".tmp"
+        os.symlink(target, temp_link)
+        os.rename(temp_link, self.symlink)
+        return target
+
+    def test_get_db_is_stable_without_pinning(self):
+        first_db = db.get_db()
+        self.set_live("matrixstore_2.sqlite")
+        self.assertIs(db.get_db(), first_db)
+
+    def test_new_file_is_picked_up_by_next_request(self):
+        with db.pinned_generation():
+            first_db = db.get_db()
+        new_path = self.set_live("matrixstore_2.sqlite")
+        with db.pinned_generation():
+            second_db = db.get_db()
+        self.assertEqual(second_db.path, new_path)
+        self.assertTrue(first_db.closed)
+        self.assertFalse(second_db.closed)
+
+    def test_in_flight_requests_keep_old_file_until_finished(self):
+        with db.pinned_generation():
+            first_db = db.get_db()
+            self.set_live("matrixstore_2.sqlite")
+            # Simulate a new request starting, on another thread, while this
+            # one is still in progress
+            generation = db._load_generation(check_for_new_file=True)
+            self.assertIsNot(generation.db, first_db)
+            # The in-flight request continues to see the old file
+            self.assertIs(db.get_db(), first_db)
+            self.assertFalse(first_db.closed)
+        self.assertTrue(first_db.closed)
+
+    def test_memoized_values_belong_to_generation(self):
+        calls = []
+
+        @db.memoize
+        def memoized_func(arg):
+            calls.append(arg)
+            return db.get_db()
+
+        with db.pinned_generation():
+            first_value = memoized_func("a")
+            self.assertIs(memoized_func("a"), first_value)
+        self.set_live("matrixstore_2.sqlite")
+        with db.pinned_generation():
+            second_value = memoized_func("a")
+        self.assertIsNot(second_value, first_value)
+        self.assertEqual(calls, ["a", "a"])
+
+    def test_resources_are_closed_with_generation(self):
+        @db.memoize
+        def open_resource(path):
+            return db.close_with_generation(FakeMatrixStore(path))
+
+        with db.pinned_generation():
+            resource = open_resource("extra.sqlite")
+            self.set_live("matrixstore_2.sqlite")
+            # Starting a new request retires the old generation, but it stays
+            # open while this request is in flight
+            db._load_generation(check_for_new_file=True)
+            self.assertFalse(resource.closed)
+        self.assertTrue(resource.closed)
+
+    def test_pinned_iterator_keeps_file_open_until_exhausted(self):
+        def get_paths():
+            for _ in range(2):
+                yield db.get_db().path
+
+        with db.pinned_generation() as scope:
+            first_db = db.get_db()
+            iterator = db.PinnedIterator(get_paths(), scope.generation)
+        # Simulate a new file going live, and a new request starting, after
+        # the view has returned but before the response has been streamed
+        self.set_live("matrixstore_2.sqlite")
+        with db.pinned_generation():
+            db.get_db()
+        self.assertFalse(first_db.closed)
+        self.assertEqual(list(iterator), [first_db.path, first_db.path])
+        self.assertTrue(first_db.closed)
+
+    def test_pinned_iterator_releases_file_when_closed(self):
+        with db.pinned_generation() as scope:
+            first_db = db.get_db()
+            iterator = db.PinnedIterator(iter([1, 2, 3]), scope.generation)
+        self.set_live("matrixstore_2.sqlite")
+        with db.pinned_generation():
+            db.get_db()
+        self.assertEqual(next(iterator), 1)
+        self.assertFalse(first_db.closed)
+        iterator.close()
+        self.assertTrue(first_db.closed)
+
+    def test_pinning_is_lazy(self):
+        with db.pinned_generation() as scope:
+            self.assertIsNone(scope.generation)
+            first_db = db.get_db()
+            self.assertIs(scope.generation.db, first_db)
+
+    def test_scope_which_does_not_use_matrixstore_does_not_need_file(self):
+        os.remove(self.symlink)
+        with db.pinned_generation() as scope:
+            pass
+        self.assertIsNone(scope.generation)
+
+    def test_streaming_response_which_does_not_use_matrixstore(self):
+        os.remove(self.symlink)
+        response = get_response_from_middleware(
+            lambda: StreamingHttpResponse(iter([b"a"]))
+        )
+        self.assertNotIsInstance(response.streaming_content, db.PinnedIterator)
+        self.assertEqual(b"".join(response.streaming_content), b"a")
+
+    def test_streaming_response_which_uses_matrixstore(self):
+        def view():
+            db.get_db()
+            return StreamingHttpResponse(
+                db.get_db().path.encode("utf8") for _ in range(2)
+            )
+
+        response = get_response_from_middleware(view)
+        first_db = db.get_db()
+        self.set_live("matrixstore_2.sqlite")
+        with db.pinned_generation():
+            db.get_db()
+        self.assertFalse(first_db.closed)
+        content = b"".join(response.streaming_content)
+        self.assertEqual(content, first_db.path.encode("utf8") * 2)
+        self.assertTrue(first_db.closed)
+
+
+def get_response_from_middleware(view):
+    middleware = PinMatrixStoreGenerationMiddleware(lambda request: view())
+    return middleware(RequestFactory().get("/"))
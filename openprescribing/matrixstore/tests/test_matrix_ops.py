@@ -1,6 +1,7 @@
 import random
 
 import numpy
+import scipy.sparse
 from scipy.sparse import spmatrix as SparseMatrixBase
 
 from django.test import SimpleTestCase
@@ -8,7 +9,9 @@ from django.test import SimpleTestCase
 from matrixstore.matrix_ops import (
     convert_to_smallest_int_type,
     finalise_matrix,
+    get_cells,
     sparse_matrix,
+    sparse_matrix_from_values,
 )
 
 
@@ -95,3 +98,49 @@ class TestFinaliseMatrix(SimpleTestCase):
             i = int(n / cols)
             j = n % cols
             yield i, j
+
+
+class TestSparseMatrixFromValues(SimpleTestCase):
+    def setUp(self):
+        self.random = random.Random()
+        self.random.seed(27)
+
+    def test_matches_assigning_values_individually(self):
+        shape = (8, 5)
+        for integer in [True, False]:
+            entries = []
+            for _ in range(30):
+                coords = self.random.randrange(shape[0]), self.random.randrange(
+                    shape[1]
+                )
+                # Include some zeros and some repeated coordinates
+                value = self.random.choice([0, self.random.randint(1, 100)])
+                entries.append((coords, value if integer else value / 7))
+            expected = sparse_matrix(shape, integer=integer)
+            for coords, value in entries:
+                expected[coords] = value
+            rows = [coords[0] for coords, _ in entries]
+            cols = [coords[1] for coords, _ in entries]
+            values = [value for _, value in entries]
+            matrix = sparse_matrix_from_values(shape, rows, cols, values, integer)
+            self.assertEqual(matrix.dtype, expected.dtype)
+            self.assertEqual(matrix.nnz, expected.nnz)
+            self.assertEqual(matrix.toarray().tolist(), expected.toarray().tolist())
+            finalised = finalise_matrix(matrix)
+            expected_finalised = finalise_matrix(expected)
+            self.assertEqual(type(finalised), type(expected_finalised))
+            self.assertEqual(finalised.dtype, expected_finalised.dtype)
+
+
+class TestGetCells(SimpleTestCase):
+    def test_matches_indexing_each_cell(self):
+        random = numpy.random.RandomState(12)
+        dense = random.randint(0, 3, size=(6, 4))
+        rows = [4, 0, 5]
+        cols = [3, 1]
+        expected = [[dense[row, col] for col in cols] for row in rows]
+        for matrix in [dense, scipy.sparse.csc_matrix(dense)]:
+            cells = get_cells(matrix, rows, cols)
+            self.assertIsInstance(cells, numpy.ndarray)
+            self.assertEqual(cells.tolist(), expected)
+        self.assertEqual(get_cells(dense, [], cols).shape, (0, 2))
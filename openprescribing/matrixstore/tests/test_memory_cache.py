@@ -0,0 +1,93 @@
+from django.test import SimpleTestCase, override_settings
+
+import numpy
+import scipy.sparse
+
+from matrixstore import memory_cache
+from matrixstore.memory_cache import MemoryCache, get_size
+
+
+class TestMemoryCache(SimpleTestCase):
+    def test_least_recently_used_values_are_evicted(self):
+        cache = MemoryCache(max_bytes=20000)
+        cache.set("a", numpy.zeros(1000))
+        cache.set("b", numpy.zeros(1000))
+        # Touch "a" so that "b" becomes the least recently used value
+        self.assertIsNotNone(cache.get("a"))
+        cache.set("c", numpy.zeros(1000))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+        self.assertLessEqual(stats["current_bytes"], 20000)
+
+    def test_values_larger_than_budget_are_not_cached(self):
+        cache = MemoryCache(max_bytes=1000)
+        cache.set("a", numpy.zeros(10))
+        cache.set("b", numpy.zeros(1000))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+
+    def test_replacing_value_updates_size(self):
+        cache = MemoryCache(max_bytes=100000)
+        cache.set("a", numpy.zeros(1000))
+        cache.set("a", numpy.zeros(10))
+        self.assertLess(cache.stats()["current_bytes"], 1000)
+
+    def test_delete_matching(self):
+        cache = MemoryCache(max_bytes=100000)
+        cache.set(("x", 1), 1)
+        cache.set(("y", 1), 2)
+        cache.delete_matching(lambda key: key[0] == "x")
+        self.assertIsNone(cache.get(("x", 1)))
+        self.assertEqual(cache.get(("y", 1)), 2)
+
+
+class TestGetSize(SimpleTestCase):
+    def test_counts_array_buffers(self):
+        array = numpy.zeros(10000)
+        self.assertGreaterEqual(get_size({"key": [array]}), array.nbytes)
+
+    def test_counts_shared_buffers_once(self):
+        array = numpy.zeros(10000)
+        size = get_size([array, array[:10], array[10:]])
+        self.assertLess(size, 2 * array.nbytes)
+
+    def test_counts_sparse_matrix_buffers(self):
+        matrix = scipy.sparse.random(1000, 100, density=0.5, format="csc")
+        expected = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+        self.assertGreaterEqual(get_size(matrix), expected)
+
+    def test_counts_object_attributes(self):
+        class Holder(object):
+            def __init__(self, value):
+                self.value = value
+
+        array = numpy.zeros(10000)
+        self.assertGreaterEqual(get_size(Holder(array)), array.nbytes)
+
+
+class TestMemoize(SimpleTestCase):
+    def setUp(self):
+        memory_cache._default_cache = None
+        self.addCleanup(setattr, memory_cache, "_default_cache", None)
+
+    @override_settings(MEMORY_CACHE_MAX_BYTES=100000)
+    def test_memoize(self):
+        calls = []
+
+        @memory_cache.memoize
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [2])
+        double.cache_clear()
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [2, 2])
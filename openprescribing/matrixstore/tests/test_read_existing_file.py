@@ -21,8 +21,10 @@ class TestReadExistingFile(SimpleTestCase):
     dense, compressed and uncompressed) from an SQLite fixture created by a
     previous version of the software. This should catch any backwards
     incompatibilities introduced by upgrading our dependencies, in particular
-    PyArrow. The fixture file can be regenerated by calling the
-    `create_fixture` class method on this class.
+    PyArrow.
+
+    This fixture was written in the original PyArrow-based format and so should
+    not be regenerated (`create_fixture` now writes the current format).
     """
 
     fixture_db_path = "matrixstore/tests/fixtures/read_existing_file.sqlite"
@@ -135,3 +137,14 @@ class TestReadExistingFile(SimpleTestCase):
             [sys.executable, "-m", "pip", "freeze", "-qqq"]
         )
         yield "installed_packages", installed_packages
+
+
+class TestReadExistingFileV1(TestReadExistingFile):
+    """
+    As above, but using a fixture written in version 1 of our own serialization
+    format. The fixture file can be regenerated by calling the `create_fixture`
+    class method on this class.
+    """
+
+    fixture_db_path = "matrixstore/tests/fixtures/read_existing_file_v1.sqlite"
+    fixture_json_path = "matrixstore/tests/fixtures/read_existing_file_v1.json"
@@ -141,6 +141,76 @@ class TestGrouper(SimpleTestCase):
                         round_floats(values), round_floats(expected_values)
                     )
 
+    def test_sum_by_product_matches_sum_by_looping(self):
+        """
+        Tests that both strategies used by `sum` give the same results
+        """
+        test_cases = product(self.get_group_definitions(), self.get_matrices())
+        for (group_name, group_definition), (matrix_name, matrix) in test_cases:
+            with self.subTest(matrix=matrix_name, group=group_name):
+                row_grouper = RowGrouper(group_definition)
+                for group_ids in [None, [], row_grouper.ids[::-1]]:
+                    values = row_grouper._sum_by_product(matrix, group_ids)
+                    expected = row_grouper._sum_by_looping(matrix, group_ids)
+                    self.assertEqual(
+                        round_floats(to_list_of_lists(values)),
+                        round_floats(to_list_of_lists(expected)),
+                    )
+
+    def test_sum_many_matches_sum(self):
+        """
+        Tests that `sum_many` gives the same results as calling `sum` on each
+        matrix, including where integer and float matrices are mixed
+        """
+        matrices = dict(self.get_matrices())
+        combinations = [
+            ["dense.integer", "dense.float", "dense.integer"],
+            ["sparse.integer", "sparse.float"],
+            ["sparse.integer", "dense.float"],
+            ["dense.float"],
+        ]
+        for (group_name, group_definition), names in product(
+            self.get_group_definitions(), combinations
+        ):
+            with self.subTest(group=group_name, matrices=names):
+                row_grouper = RowGrouper(group_definition)
+                for group_ids in [None, row_grouper.ids[::-1]]:
+                    values = row_grouper.sum_many(
+                        [matrices[name] for name in names], group_ids
+                    )
+                    self.assertEqual(len(values), len(names))
+                    for name, value in zip(names, values):
+                        expected = row_grouper.sum(matrices[name], group_ids)
+                        self.assertEqual(
+                            round_floats(to_list_of_lists(value)),
+                            round_floats(to_list_of_lists(expected)),
+                        )
+                        if name.endswith(".integer"):
+                            self.assertTrue(
+                                numpy.issubdtype(value.dtype, numpy.integer)
+                            )
+
+    def test_sum_has_headroom_for_small_integer_types(self):
+        group_definition = [(row, "all") for row in range(3)]
+        matrix = numpy.full((3, 2), 200, dtype=numpy.uint8)
+        row_grouper = RowGrouper(group_definition)
+        self.assertEqual(row_grouper._sum_by_looping(matrix).tolist(), [[600, 600]])
+        self.assertEqual(row_grouper._sum_by_product(matrix).tolist(), [[600, 600]])
+
+    def test_cache_key_identifies_group_configuration(self):
+        group_definition = [(row, "even" if row % 2 else "odd") for row in range(3000)]
+        self.assertEqual(
+            RowGrouper(group_definition).cache_key,
+            RowGrouper(group_definition).cache_key,
+        )
+        # Swap two rows in the middle of groups which are too large for numpy
+        # to print in full
+        moved = list(group_definition)
+        moved[1500], moved[1501] = (1500, moved[1501][1]), (1501, moved[1500][1])
+        self.assertNotEqual(
+            RowGrouper(group_definition).cache_key, RowGrouper(moved).cache_key
+        )
+
     def test_sum_one_group_with_all_group_and_matrix_type_combinations(self):
         """
         Tests the `sum_one_group` method with every combination of group type
@@ -5,44 +5,86 @@ import scipy.sparse
 
 from django.test import SimpleTestCase
 
-from matrixstore.serializer import serialize, serialize_compressed, deserialize
+from matrixstore.serializer import (
+    serialize,
+    serialize_compressed,
+    serialize_legacy,
+    deserialize,
+)
 
 
 class TestSerializer(SimpleTestCase):
     def test_simple_serialisation(self):
-        obj = {"hello": 123}
-        self.assertEqual(deserialize(serialize(obj)), obj)
+        obj = numpy.arange(12).reshape(3, 4)
+        self.assertArraysEqual(deserialize(serialize(obj)), obj)
 
     def test_simple_serialisation_with_compression(self):
-        obj = {"hello": "world" * 256}
+        obj = numpy.zeros((256, 4))
         data = serialize(obj)
         compressed_data = serialize_compressed(obj)
         self.assertLess(len(compressed_data), len(data))
-        self.assertEqual(deserialize(compressed_data), obj)
+        self.assertArraysEqual(deserialize(compressed_data), obj)
 
     def test_matrix_serialisation(self):
         obj = scipy.sparse.csc_matrix((5, 4))
         new_obj = deserialize(serialize(obj))
         self.assertTrue(numpy.array_equal(obj.todense(), new_obj.todense()))
 
+    def test_non_empty_matrix_serialisation(self):
+        obj = scipy.sparse.random(20, 6, density=0.2, format="csc", random_state=1)
+        new_obj = deserialize(serialize_compressed(obj))
+        self.assertIsInstance(new_obj, scipy.sparse.csc_matrix)
+        self.assertTrue(numpy.array_equal(obj.todense(), new_obj.todense()))
+
     def test_dtype_is_preserved(self):
         obj = scipy.sparse.csc_matrix((5, 4), dtype=numpy.uint16)
         new_obj = deserialize(serialize(obj))
         self.assertEqual(obj.dtype, new_obj.dtype)
 
+    def test_fortran_order_is_preserved(self):
+        obj = numpy.asfortranarray(numpy.arange(12, dtype=numpy.int32).reshape(3, 4))
+        new_obj = deserialize(serialize(obj))
+        self.assertArraysEqual(new_obj, obj)
+        self.assertTrue(new_obj.flags.f_contiguous)
+
+    def test_non_contiguous_arrays(self):
+        obj = numpy.arange(20).reshape(4, 5)[:, ::2]
+        self.assertArraysEqual(deserialize(serialize(obj)), obj)
+
+    def test_uncompressed_data_is_not_copied(self):
+        obj = numpy.arange(12.0).reshape(3, 4)
+        data = serialize(obj)
+        new_obj = deserialize(data)
+        self.assertTrue(numpy.shares_memory(new_obj, numpy.frombuffer(data, "u1")))
+
+    def test_unsupported_types_raise_error(self):
+        with self.assertRaises(TypeError):
+            serialize({"hello": 123})
+        with self.assertRaises(TypeError):
+            serialize(numpy.array(["a", None], dtype=object))
+
+    def test_legacy_format_can_be_read(self):
+        for obj in [numpy.arange(12).reshape(3, 4), scipy.sparse.csc_matrix((5, 4))]:
+            new_obj = deserialize(serialize_legacy(obj))
+            self.assertEqual(type(new_obj), type(obj))
+
     def test_sqlite_roundtrip(self):
-        obj = {"hello": 123}
+        obj = numpy.arange(12).reshape(3, 4)
         data = serialize(obj)
         new_data = roundtrip_through_sqlite(data)
         new_obj = deserialize(new_data)
-        self.assertEqual(new_obj, obj)
+        self.assertArraysEqual(new_obj, obj)
 
     def test_sqlite_roundtrip_with_compression(self):
-        obj = {"hello": "world" * 256}
+        obj = numpy.zeros((256, 4))
         data = serialize_compressed(obj)
         new_data = roundtrip_through_sqlite(data)
         new_obj = deserialize(new_data)
-        self.assertEqual(new_obj, obj)
+        self.assertArraysEqual(new_obj, obj)
+
+    def assertArraysEqual(self, first, second):
+        self.assertEqual(first.dtype, second.dtype)
+        self.assertTrue(numpy.array_equal(first, second))
 
 
 def roundtrip_through_sqlite(value):
@@ -1,9 +1,11 @@
 from django.test import SimpleTestCase
 
+import mock
 import numpy
 import scipy.sparse
 
-from matrixstore.sql_functions import fast_in_place_add, MatrixSum
+from matrixstore.serializer import serialize
+from matrixstore.sql_functions import fast_in_place_add, MatrixSum, sum_rows
 
 
 class TestMatrixSum(SimpleTestCase):
@@ -36,3 +38,56 @@ class TestMatrixSum(SimpleTestCase):
         self.assertEqual(
             accumulator.tolist(), [[1, 0, 2], [0, 0, 4], [1, 5, 6], [5, 5, 2]]
         )
+
+
+class TestSumRows(SimpleTestCase):
+    def test_sum_rows_in_parallel(self):
+        random = numpy.random.RandomState(42)
+        rows = []
+        for i in range(25):
+            integers = scipy.sparse.random(
+                20, 6, density=0.2, format="csc", random_state=random
+            )
+            integers.data = (integers.data * 10).astype(numpy.int_)
+            floats = random.random_sample((20, 6))
+            rows.append([serialize(integers), serialize(floats), None])
+        expected = sum_rows(rows, 3, workers=1)
+        self.assertIsNone(expected[2])
+        for workers in [2, 3, 4]:
+            totals = sum_rows(iter(rows), 3, workers=workers)
+            self.assertEqual(totals[0].dtype, expected[0].dtype)
+            self.assertEqual(totals[0].tolist(), expected[0].tolist())
+            self.assertEqual(totals[1].tobytes(), expected[1].tobytes())
+            self.assertIsNone(totals[2])
+
+    def test_sum_rows_in_parallel_is_bit_identical_for_floats(self):
+        # Values of very different magnitudes, so that summing them in a
+        # different order would give different results
+        random = numpy.random.RandomState(42)
+        rows = [
+            [serialize(random.random_sample((20, 6)) * 10.0 ** random.randint(-8, 8))]
+            for _ in range(200)
+        ]
+        expected = sum_rows(rows, 1, workers=1)[0]
+        self.assertNotEqual(
+            expected.tobytes(), sum_rows(reversed(rows), 1, workers=1)[0].tobytes()
+        )
+        for workers in [2, 3, 4]:
+            for _ in range(5):
+                totals = sum_rows(iter(rows), 1, workers=workers)
+                self.assertEqual(totals[0].tobytes(), expected.tobytes())
+
+    def test_sum_rows_does_not_start_threads_for_a_few_rows(self):
+        rows = [[serialize(numpy.ones((2, 2)))]] * 3
+        with mock.patch("matrixstore.sql_functions.ThreadPoolExecutor") as executor:
+            totals = sum_rows(iter(rows), 1, workers=4)
+        executor.assert_not_called()
+        self.assertEqual(totals[0].tolist(), [[3, 3], [3, 3]])
+
+    def test_sum_rows_with_no_rows(self):
+        self.assertEqual(sum_rows([], 2, workers=3), [None, None])
+
+    def test_sum_rows_propagates_errors(self):
+        rows = [[serialize(numpy.zeros((2, 2)))], [b"not a matrix"]] * 10
+        with self.assertRaises(Exception):
+            sum_rows(rows, 1, workers=2)
@@ -169,6 +169,7 @@ MIDDLEWARE = (
     "corsheaders.middleware.CorsPostCsrfMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
+    "matrixstore.middleware.PinMatrixStoreGenerationMiddleware",
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 # END MIDDLEWARE CONFIGURATION
@@ -330,6 +331,19 @@ SLACK_SENDING_ACTIVE = True
 
 ENABLE_CACHING = utils.get_env_setting_bool("ENABLE_CACHING", default=False)
 
+# Budget for values memoized in memory by each process (see
+# `matrixstore.memory_cache`). Once this is exceeded the least recently used
+# values get evicted.
+MEMORY_CACHE_MAX_BYTES = int(
+    utils.get_env_setting("MEMORY_CACHE_MAX_BYTES", default=str(512 * 1024 ** 2))
+)
+
+# Number of threads used to sum matrices when handling broad queries against
+# the MatrixStore (see `MatrixStore.sum_matrices`)
+MATRIXSTORE_SUM_WORKERS = int(
+    utils.get_env_setting("MATRIXSTORE_SUM_WORKERS", default="4")
+)
+
 
 # Total on-disk size of the cache. We want _some_ limit here so it doesn't grow
 # without bound, but I don't think we need to be too fussy about exactly what
@@ -388,6 +402,31 @@ CACHES = {
     }
 }
 
+# The cache, from those defined in CACHES, in which `matrixstore.cachelib`
+# stores expensive computed values like price-per-unit savings. When running
+# several app servers this can be pointed at a shared cache (e.g. memcached, or
+# Redis via django-redis, configured with a TIMEOUT of None) so that each value
+# is only computed once.
+CACHELIB_CACHE_ALIAS = utils.get_env_setting("CACHELIB_CACHE_ALIAS", default="default")
+
+# Values stored by `matrixstore.cachelib` which are larger than this many bytes
+# get LZ4 compressed. This isn't worth it for the local diskcache, where values
+# are read via memory-mapping, but is useful for caches accessed over the
+# network or which limit the size of values (memcached's default limit is 1MB).
+cachelib_compression_threshold = utils.get_env_setting(
+    "CACHELIB_COMPRESSION_THRESHOLD", default=""
+)
+CACHELIB_COMPRESSION_THRESHOLD = (
+    int(cachelib_compression_threshold) if cachelib_compression_threshold else None
+)
+
+# When a value stored by `matrixstore.cachelib` is being computed by one
+# request, other requests for it wait up to this many seconds for the result
+# before giving up and computing it themselves
+CACHELIB_LOCK_TIMEOUT = int(
+    utils.get_env_setting("CACHELIB_LOCK_TIMEOUT", default="120")
+)
+
 
 # The git sha of the currently running version of the code (will be empty in
 # development). We set this conditionally so that if it isn't defined any